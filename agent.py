@@ -1,10 +1,17 @@
 import asyncio
-from datetime import datetime, timezone
-
-from web3 import Web3
+import os
+import signal
 
+from behaviours.scheduler import BehaviourScheduler
+from handlers.executor import ExecutorPools, HandlerExecutor
+from handlers.router import HandlerRouter, ROUTING_FIRST
+from helpers.metrics import metrics
 from helpers.sa_contract_helper import SAContractHelper
-from helpers.utils import get_server_instance
+from helpers.transfer_batcher import RemoteTransferBatcher
+from helpers.utils import get_server_instance, install_event_loop
+from message import Message
+from server.ipc import IPCChannel
+from supervisor import Supervisor
 
 
 class AutonomousAgent:
@@ -14,25 +21,53 @@ class AutonomousAgent:
 
     Attributes:
         server (BaseServer): The server instance for handling communication with other agents.
-        web3 (Web3): An instance of Web3 for interacting with the blockchain.
         interactor (SAContractHelper): Helper for interacting with the agent's smart contract on the blockchain.
         handlers (list): A list of registered message handlers to process incoming messages.
+        router (HandlerRouter): The routing index selecting the handlers matching each message.
+        executors (dict): The executor running each registered handler, by handler.
+        pools (ExecutorPools): The thread and process pools handlers can be offloaded to.
         behaviours (list): A list of registered behaviors for periodic asynchronous execution.
+        scheduler (BehaviourScheduler): Runs each registered behavior as its own task at its next deadline.
+        dispatchers (int): The number of concurrent tasks dispatching incoming messages to the handlers.
+        workers (int): The number of worker processes the agent runs in.
+        worker_index (int): The index of the worker process running this copy of the agent, 0 for the primary.
+        logger (Logger): The logger of the agent, shared with its server.
+        metrics (MetricsRegistry): The metrics of the agent process, served on `METRICS_PORT` when it is set.
+        shutdown_timeout (float): The time, in seconds, the agent spends draining messages and transfers once
+            asked to stop (`SHUTDOWN_TIMEOUT`).
+        stopping (Event): Set once the agent is asked to stop.
     """
 
-    def __init__(self, provider_url: str, private_key: str):
+    def __init__(self, provider_url: str, private_key: str, dispatchers: int = None, workers: int = None):
         """
         Initializes the AutonomousAgent instance by setting up the server, blockchain connection, and contract interactor.
 
         Args:
             provider_url (str): The URL of the blockchain provider (e.g., Infura, Alchemy).
             private_key (str): The private key of the agent's Ethereum account for signing transactions.
+            dispatchers (int, optional): The number of message dispatcher tasks. Defaults to the `DISPATCHERS`
+                environment variable, or 1.
+            workers (int, optional): The number of worker processes. Defaults to the `WORKERS` environment
+                variable, or 1.
         """
         self.server = get_server_instance()
-        self.web3 = Web3(Web3.HTTPProvider(provider_url))
+        self.logger = self.server.logger
+        self.metrics = metrics
+        self.processed_total = metrics.counter("agent_messages_processed_total", "Messages dispatched to the handlers")
+        self.failed_total = metrics.counter("agent_messages_failed_total", "Messages whose processing raised")
         self.interactor = SAContractHelper(provider_url, private_key)
         self.handlers = []
+        self.router = HandlerRouter(os.getenv("HANDLER_ROUTING", "all"))
+        self.executors = {}
+        self.pools = ExecutorPools()
         self.behaviours = []
+        self.scheduler = BehaviourScheduler()
+        self.dispatchers = dispatchers or int(os.getenv("DISPATCHERS", 1))
+        self.workers = workers or int(os.getenv("WORKERS", 1))
+        self.worker_index = 0
+        self.shutdown_timeout = float(os.getenv("SHUTDOWN_TIMEOUT", 8))
+        self.stopping = asyncio.Event()
+        self.channels = []
 
     def get_message_to_process(self):
         """
@@ -44,69 +79,273 @@ class AutonomousAgent:
         if self.server.received_messages.empty():
             return None
         else:
-            return self.server.received_messages.get()
+            return self.server.received_messages.get_nowait()
+
+    async def dispatch_messages(self):
+        """
+        Waits on the server's inbox and hands every message to the handlers as soon as it arrives.
+
+        Several dispatchers can run concurrently, each one picking the next available message. A message is
+        marked done once the handlers it was offloaded to complete.
+        """
+        while True:
+            message = await self.server.received_messages.get()
+            self.processed_total.inc()
+            try:
+                pending = await self.process_message(message)
+            except Exception as e:
+                self.failed_total.inc()
+                self.print(f"Error processing message {message.fields()}: {e}")
+                pending = []
+            if pending:
+                asyncio.gather(*pending).add_done_callback(
+                    lambda _, message=message: self.server.received_messages.task_done(message))
+            else:
+                self.server.received_messages.task_done(message)
 
     def print(self, message):
         """
-        Logs a message with the server's host and port as a prefix.
+        Logs a message at info level with the server's host and port as a prefix.
 
         Args:
             message (str): The message to be logged.
         """
-
-        utc_time = datetime.now(timezone.utc)
-        local_time = utc_time.astimezone()
-        local_iso_time = local_time.isoformat().split('.')[0]
-        print(f"{self.server.host}:{self.server.port} [{local_iso_time}]: {message}")
+        self.logger.info(message)
 
     def register_behaviour(self, behaviour):
         """
-        Registers a behavior for periodic execution.
+        Registers a behavior for periodic execution on its declared schedule.
 
         Args:
             behaviour (Behaviour): The behavior instance to be registered for execution.
         """
         self.behaviours.append(behaviour)
+        self.scheduler.add(behaviour)
 
     def register_handler(self, handler):
         """
-        Registers a message handler for processing incoming messages.
+        Registers a message handler for processing incoming messages and adds its match criteria to the routing index.
 
         Args:
             handler (Handler): The handler instance to be registered for message processing.
         """
         self.handlers.append(handler)
+        self.router.add(handler)
+        self.executors[handler] = HandlerExecutor(handler, self)
 
     async def run_behaviours(self):
         """
-        Executes all registered behaviors in an infinite asynchronous loop.
+        Executes all registered behaviors on their schedules.
 
-        Each behavior's `run` method is executed asynchronously. The loop pauses for 1 second
-        between successive executions of behaviors.
+        The scheduler sleeps until the earliest behavior deadline and starts every due behavior's `run` method
+        as its own task, so a slow behavior does not hold up the others.
         """
-        while True:
-            for behaviour in self.behaviours:
-                await behaviour.run()
-            await asyncio.sleep(0.1)
+        await self.scheduler.run()
 
     def run(self):
         """
         Starts the agent by running the server and all registered behaviors within an asynchronous event loop.
 
-        This method orchestrates both communication and periodic behavior execution for the agent.
+        This method orchestrates communication, message dispatching and periodic behavior execution for the agent.
+        With several workers, a `Supervisor` forks the configured agent into worker processes instead.
+        """
+        if self.workers > 1:
+            Supervisor(self, self.workers).run()
+            return
+        self.run_loop()
+
+    def run_loop(self, *tasks):
+        """
+        Runs the agent on a new event loop of this process until it is stopped, see `serve`. The loop is uvloop's
+        when it is installed, unless `EVENT_LOOP` says otherwise.
+
+        Args:
+            *tasks: Additional coroutines to run alongside the agent.
         """
-        asyncio.gather(self.server.run(), self.run_behaviours())
-        asyncio.get_event_loop().run_forever()
+        self.print(f"Running on the {install_event_loop()} event loop")
+        asyncio.run(self.serve(*tasks))
 
-    async def process_message(self, message: str):
+    async def serve(self, *tasks):
         """
-        Processes an incoming message using all registered handlers.
+        Runs the server, behaviors, dispatchers and any additional tasks until SIGINT, SIGTERM or `stop`, then
+        shuts the agent down in order.
 
-        Each registered handler's `handle_message` method is invoked with the incoming message.
+        The transport starts listening first, then chain access is initialised in the background while the
+        dispatchers, the behaviors and the additional tasks start. With `METRICS_PORT` set, the metrics are
+        served on that port (plus the worker index) of `METRICS_HOST`, and with `METRICS_DUMP_INTERVAL` set, a
+        snapshot of them is logged every that many seconds.
 
         Args:
-            message (str): The content of the incoming message to be processed.
+            *tasks: Additional coroutines to run alongside the agent.
+        """
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, self.stop)
+        if any(handler.lane for handler in self.handlers):
+            self.server.received_messages.lanes.set_classifier(self.classify_message)
+        metrics_server = None
+        metrics_port = int(os.getenv("METRICS_PORT", 0))
+        if metrics_port:
+            metrics_server = await self.metrics.serve(os.getenv("METRICS_HOST", "127.0.0.1"),
+                                                      metrics_port + self.worker_index)
+        dump_interval = float(os.getenv("METRICS_DUMP_INTERVAL", 0))
+        if dump_interval:
+            tasks += (self.metrics.dump(self.logger, dump_interval),)
+        await self.server.run()
+        starting = loop.create_task(self.interactor.start())
+        dispatchers = [loop.create_task(self.dispatch_messages()) for _ in range(self.dispatchers)]
+        background = [loop.create_task(self.run_behaviours()), *(loop.create_task(task) for task in tasks)]
+        await self.stopping.wait()
+        try:
+            await self.shutdown(dispatchers, background)
+        finally:
+            starting.cancel()
+            if metrics_server is not None:
+                metrics_server.close()
+
+    def stop(self):
+        """
+        Asks the agent to stop. `serve` then drains the messages and transfers in flight and returns.
+        """
+        if self.stopping.is_set():
+            self.print("Already shutting down")
+            return
+        self.print(f"Shutting down, draining messages for up to {self.shutdown_timeout:g} seconds")
+        self.stopping.set()
+
+    async def shutdown(self, dispatchers: list, background: list):
+        """
+        Stops the agent in order, within `shutdown_timeout` seconds for all draining steps.
+
+        The transport stops accepting messages first, then the behaviors and additional tasks are stopped and
+        the inbox is drained by the dispatchers and handlers. A primary worker then waits for the other workers
+        to finish, since they relay messages and transfers to it. Pending transfers are submitted, the outboxes
+        are flushed until the peers acknowledge them, and the transport, chain access, ledger and handler pools
+        are closed. Messages still queued at the deadline are kept by the journals when `JOURNAL_DIR` is set,
+        and delivered after the restart.
+
+        Args:
+            dispatchers (list): The dispatcher tasks.
+            background (list): The behavior scheduler and additional tasks.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.shutdown_timeout
+
+        async def drain(step: str, awaitable):
+            try:
+                await asyncio.wait_for(awaitable, max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                self.print(f"Shutdown deadline reached while {step}")
+            except Exception as e:
+                self.print(f"Error while {step}: {e}")
+
+        await drain("closing the listener", self.server.stop_listening())
+        for task in background:
+            task.cancel()
+        if self.scheduler.tasks:
+            await drain("finishing the behaviors", asyncio.wait(list(self.scheduler.tasks)))
+        await drain("draining the inbox", self.server.received_messages.join())
+        for task in dispatchers:
+            task.cancel()
+        if self.worker_index == 0:
+            if self.channels:
+                await drain("waiting for the other workers",
+                            asyncio.gather(*(channel.closed.wait() for channel in self.channels)))
+        else:
+            for channel in self.channels:
+                channel.close()
+        await drain("submitting pending transfers", self.interactor.batcher.flush())
+        await drain("draining the outboxes", self.server.drain_outbox())
+
+        undelivered = self.server.pending_messages() + self.server.received_messages.qsize()
+        if undelivered:
+            kept = "kept in the journal" if self.server.journal_dir else "lost"
+            self.print(f"{undelivered} messages were not delivered or processed in time, they are {kept}")
+        for close in (self.server.close, self.interactor.close):
+            try:
+                await close()
+            except Exception as e:
+                self.print(f"Error while closing: {e}")
+        self.pools.shutdown()
+        self.print("Shut down")
+
+    def run_worker(self, index: int, sockets: list):
+        """
+        Runs this copy of the agent as one worker process of a multi-worker agent.
+
+        The primary worker (index 0) serves the other workers over IPC: it queues the messages they relay for
+        its peers and submits their transfers with the account's nonces. Secondary workers relay both to the
+        primary worker and do not run singleton behaviors.
+
+        Args:
+            index (int): The index of the worker.
+            sockets (list): The IPC socket pair ends of the worker: one per secondary worker in the primary
+                worker, the one to the primary worker in a secondary worker.
+        """
+        self.worker_index = index
+        self.channels = channels = [IPCChannel(sock) for sock in sockets]
+        if index == 0:
+            self.server.become_worker(index)
+            for channel in channels:
+                channel.register("send_to_outbox", self._send_relayed_message)
+                channel.register("submit_transfer", self.interactor.batcher.submit)
+        else:
+            primary = channels[0]
+            self.server.become_worker(index, relay=lambda message: primary.call("send_to_outbox", message.fields()))
+            self.interactor.batcher = RemoteTransferBatcher(primary)
+            for behaviour in self.behaviours:
+                if behaviour.singleton:
+                    self.scheduler.remove(behaviour)
+        self.run_loop(*(channel.start() for channel in channels))
+
+    async def _send_relayed_message(self, fields: dict):
+        await self.server.send_to_outbox(Message.from_dict(fields))
+
+    def classify_message(self, message: Message) -> str:
+        """
+        Picks the inbox lane of an incoming message: the highest priority lane declared by the handlers matching it.
+
+        Args:
+            message (Message): The incoming message.
+
+        Returns:
+            str: The lane name, or None if no matching handler declares a lane.
+        """
+        names = {handler.lane for handler in self.router.route(message)}
+        for lane in self.server.received_messages.lanes.lanes:
+            if lane.name in names:
+                return lane.name
+        return None
+
+    async def process_message(self, message: str) -> list:
+        """
+        Processes an incoming message using the registered handlers matching it.
+
+        The routing index selects the matching handlers in a single pass over the message. With "all" routing
+        every matching handler's `handle_message` method is invoked; with "first" routing handlers are invoked in
+        registration order until one of them reports the message as handled. Inline handlers run right away,
+        handlers with another execution mode are submitted to their executor; with "first" routing their result
+        is awaited before trying the next handler. Handlers needing chain access are submitted as well until the
+        chain access is ready, so the messages of the other handlers are not held back meanwhile.
+
+        Args:
+            message (Message): The incoming message to be processed.
+
+        Returns:
+            list: The tasks of the handlers still handling the message.
         """
-        for handler in self.handlers:
-            handler.handle_message(message)
+        pending = []
+        for handler in self.router.route(message):
+            executor = self.executors[handler]
+            if executor.inline and not executor.deferred:
+                handled = await executor.execute(message)
+            else:
+                task = await executor.submit(message)
+                if self.router.mode != ROUTING_FIRST:
+                    pending.append(task)
+                    continue
+                handled = await task
+            if handled and self.router.mode == ROUTING_FIRST:
+                break
+        return pending
 
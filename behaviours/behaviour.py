@@ -2,18 +2,38 @@ from abc import abstractmethod
 from datetime import datetime
 
 from agent import AutonomousAgent
+from behaviours.scheduler import IntervalSchedule, OVERLAP_SKIP, Schedule
 
 
 class Behaviour:
     """
     Base class for defining a behavior for an AutonomousAgent. This class provides
-    a structure for implementing guarded logic that runs asynchronously.
+    a structure for implementing guarded logic that runs asynchronously on a schedule.
+
+    Subclasses declare when they run through class attributes: `interval` (seconds between runs) and `jitter`,
+    or a `schedule` (e.g. a `CronSchedule`) which takes precedence. `overlap` decides what happens when a run is
+    due while the previous one is still in flight: "skip" (default), "queue" or "concurrent". Behaviours setting
+    `singleton` run in the primary worker only when the agent runs several worker processes. Behaviours setting
+    `uses_chain` skip their runs until the agent's chain access is ready.
 
     Attributes:
         agent (AutonomousAgent): The agent associated with this behavior.
         last_ran_at (datetime): The timestamp of the last successful run of the behavior.
+        interval (float): Seconds between two runs of the behavior.
+        jitter (float): Maximum random delay, in seconds, added to every run.
+        schedule (Schedule): An explicit schedule overriding `interval` and `jitter`.
+        overlap (str): The policy for runs that are due while the previous run is still in flight.
+        singleton (bool): Whether the behavior runs in a single worker process of a multi-worker agent.
+        uses_chain (bool): Whether the behavior needs chain access.
     """
 
+    interval: float = 1.0
+    jitter: float = 0.0
+    schedule: Schedule = None
+    overlap: str = OVERLAP_SKIP
+    singleton: bool = False
+    uses_chain: bool = False
+
     def __init__(self, agent: AutonomousAgent):
         """
         Initializes the Behaviour class.
@@ -24,18 +44,25 @@ class Behaviour:
         self.agent = agent
         self.last_ran_at = datetime.now()
 
-    @abstractmethod
+    def get_schedule(self) -> Schedule:
+        """
+        Returns the schedule the agent's scheduler uses for this behavior.
+
+        Returns:
+            Schedule: The explicit `schedule` if set, otherwise an interval schedule built from `interval`.
+        """
+        return self.schedule or IntervalSchedule(self.interval, self.jitter)
+
     def guard(self) -> bool:
         """
-        Determines whether the behavior should execute its logic.
+        Determines whether the behavior should execute its logic when its schedule is due.
 
-        This method must be implemented in subclasses. It should return a boolean
-        indicating whether the behavior is allowed to run.
+        Subclasses can override this to add conditions beyond timing. The default always allows the run.
 
         Returns:
             bool: True if the behavior's logic should execute, False otherwise.
         """
-        pass
+        return True
 
     @abstractmethod
     async def logic(self):
@@ -57,6 +84,8 @@ class Behaviour:
         If `guard()` returns True, the `logic()` method is executed, and
         the `last_ran_at` timestamp is updated to the current time.
         """
+        if self.uses_chain and not self.agent.interactor.ready.is_set():
+            return
         if self.guard():
             await self.logic()
             self.last_ran_at = datetime.now()
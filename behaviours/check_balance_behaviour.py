@@ -1,16 +1,24 @@
-import datetime
 from agent import AutonomousAgent
 from behaviours.behaviour import Behaviour
 
 
 class CheckBalanceBehaviour(Behaviour):
+    singleton = True
+    uses_chain = True
 
     def __init__(self, agent: AutonomousAgent):
         super().__init__(agent)
+        self.interval = agent.interactor.block_interval
+        self.last_balance = None
+        self.agent.interactor.balances.on_incoming(self.on_incoming)
 
-    def guard(self) -> bool:
-        return datetime.datetime.now() - self.last_ran_at >= datetime.timedelta(seconds=10)
+    async def on_incoming(self, amount: int, sender: str):
+        decimals = await self.agent.interactor.decimals()
+        self.agent.print(f"Received {amount / (10 ** decimals)} from {sender}")
 
     async def logic(self):
+        await self.agent.interactor.balances.sync()
         balance = await self.agent.interactor.check_balance()
-        self.agent.print(f"Current Balance: {balance}")
+        if balance != self.last_balance:
+            self.agent.print(f"Current Balance: {balance}")
+            self.last_balance = balance
@@ -1,4 +1,3 @@
-import datetime
 import random
 
 from agent import AutonomousAgent
@@ -9,14 +8,13 @@ word_alphabet = ["hello", "sun", "world", "space", "moon", "crypto", "sky", "oce
 
 
 class RandomMessageBehaviour(Behaviour):
+    interval = 2
+    singleton = True
 
     def __init__(self, agent: AutonomousAgent):
         super().__init__(agent)
         self.message_id = 1
 
-    def guard(self) -> bool:
-        return datetime.datetime.now() - self.last_ran_at >= datetime.timedelta(seconds=2)
-
     async def logic(self):
         word1 = random.choice(word_alphabet)
         word2 = random.choice(word_alphabet)
@@ -0,0 +1,273 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from datetime import datetime, timedelta
+
+from helpers.metrics import metrics
+
+OVERLAP_SKIP = "skip"
+OVERLAP_QUEUE = "queue"
+OVERLAP_CONCURRENT = "concurrent"
+
+
+class Schedule:
+    """
+    Base class for behaviour schedules. A schedule maps the current time on the monotonic clock to the
+    monotonic deadline of the next run.
+
+    Attributes:
+        jitter (float): Upper bound, in seconds, of a random delay added to every deadline.
+    """
+
+    def __init__(self, jitter: float = 0.0):
+        """
+        Initializes the Schedule class.
+
+        Args:
+            jitter (float, optional): Maximum random delay added to every deadline. Defaults to 0.
+        """
+        self.jitter = jitter
+
+    def next_deadline(self, now: float) -> float:
+        """
+        Computes the next deadline strictly after `now`.
+
+        Args:
+            now (float): The current (or previous deadline) time on the `time.monotonic` clock.
+
+        Returns:
+            float: The next deadline on the `time.monotonic` clock.
+        """
+        raise NotImplementedError
+
+    def _jitter(self) -> float:
+        return random.uniform(0, self.jitter) if self.jitter else 0.0
+
+
+class IntervalSchedule(Schedule):
+    """
+    Runs a behaviour every `seconds` seconds.
+    """
+
+    def __init__(self, seconds: float, jitter: float = 0.0):
+        super().__init__(jitter)
+        if seconds <= 0:
+            raise ValueError("Interval must be positive")
+        self.seconds = seconds
+
+    def next_deadline(self, now: float) -> float:
+        return now + self.seconds + self._jitter()
+
+
+class CronSchedule(Schedule):
+    """
+    Runs a behaviour on a five field cron expression: minute, hour, day of month, month and day of week.
+
+    Each field accepts `*`, single values, ranges (`a-b`), steps (`*/n`, `a-b/n`) and comma separated lists.
+    Day of week uses 0 (or 7) for Sunday. As in cron, when both day fields are restricted a day matches if
+    either of them does.
+    """
+
+    _FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str, jitter: float = 0.0):
+        super().__init__(jitter)
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression must have 5 fields: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(field, low, high) for field, (low, high) in zip(fields, self._FIELDS)
+        )
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    @staticmethod
+    def _parse(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(","):
+            step = 1
+            if "/" in part:
+                part, step = part.split("/")
+                step = int(step)
+            if part == "*":
+                start, end = low, high
+            elif "-" in part:
+                start, end = (int(value) for value in part.split("-"))
+            else:
+                start = end = int(part)
+            if start < low or end > high or start > end or step < 1:
+                raise ValueError(f"Invalid cron field: {field!r}")
+            values.update(range(start, end + 1, step))
+        return values
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day:
+            return weekday
+        if self.any_weekday:
+            return day
+        return day or weekday
+
+    def next_datetime(self, after: datetime) -> datetime:
+        """
+        Finds the first wall clock minute matching the expression strictly after `after`.
+
+        Args:
+            after (datetime): The wall clock time to search from.
+
+        Returns:
+            datetime: The next matching time.
+        """
+        moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never matches: {self.expression!r}")
+
+    def next_deadline(self, now: float) -> float:
+        wall_now = datetime.now()
+        delay = (self.next_datetime(wall_now) - wall_now).total_seconds()
+        return max(now, time.monotonic()) + delay + self._jitter()
+
+
+class _ScheduledBehaviour:
+    """
+    Book keeping for one behaviour registered with the scheduler.
+    """
+
+    def __init__(self, behaviour):
+        self.behaviour = behaviour
+        self.schedule = behaviour.get_schedule()
+        self.overlap = behaviour.overlap
+        self.running = 0
+        self.queued = 0
+        self.skipped = 0
+        self.cancelled = False
+        name = type(behaviour).__name__
+        self.duration = metrics.histogram("agent_behaviour_duration_seconds", "Duration of behaviour runs",
+                                          behaviour=name)
+        self.errors = metrics.counter("agent_behaviour_errors_total", "Behaviour runs that raised", behaviour=name)
+        metrics.gauge("agent_behaviour_skipped", "Behaviour runs skipped by the overlap policy",
+                      lambda: self.skipped, behaviour=name)
+
+
+class BehaviourScheduler:
+    """
+    Runs behaviours at their next deadline instead of polling them.
+
+    Deadlines live on a heap ordered by the monotonic clock, and a single task sleeps until the earliest one,
+    so an idle agent does not wake up at all between deadlines. Each due behaviour is started as its own task,
+    so a slow behaviour never delays another one. When a behaviour is still running at its next deadline, its
+    `overlap` policy decides whether the run is skipped, queued behind the running one, or started concurrently.
+
+    Attributes:
+        tasks (set): The behaviour runs currently in flight.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty scheduler.
+        """
+        self._heap = []
+        self._entries = {}
+        self._counter = itertools.count()
+        self._wakeup = None
+        self.tasks = set()
+
+    def add(self, behaviour):
+        """
+        Schedules a behaviour, its first run is due one schedule period from now.
+
+        Args:
+            behaviour (Behaviour): The behaviour to schedule.
+        """
+        entry = _ScheduledBehaviour(behaviour)
+        self._entries[id(behaviour)] = entry
+        self._push(entry, entry.schedule.next_deadline(time.monotonic()))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def remove(self, behaviour):
+        """
+        Stops scheduling a behaviour. Runs already in flight are left to finish.
+
+        Args:
+            behaviour (Behaviour): The behaviour to remove.
+        """
+        entry = self._entries.pop(id(behaviour), None)
+        if entry is not None:
+            entry.cancelled = True
+
+    def _push(self, entry: _ScheduledBehaviour, deadline: float):
+        heapq.heappush(self._heap, (deadline, next(self._counter), entry))
+
+    async def run(self):
+        """
+        Sleeps until the earliest deadline, starts every due behaviour and reschedules it, forever.
+        """
+        self._wakeup = asyncio.Event()
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            delay = self._heap[0][0] - time.monotonic()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            now = time.monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, entry = heapq.heappop(self._heap)
+                if entry.cancelled:
+                    continue
+                self._trigger(entry)
+                next_deadline = entry.schedule.next_deadline(deadline)
+                if next_deadline <= now:
+                    next_deadline = entry.schedule.next_deadline(now)
+                self._push(entry, next_deadline)
+
+    def _trigger(self, entry: _ScheduledBehaviour):
+        if entry.running and entry.overlap == OVERLAP_SKIP:
+            entry.skipped += 1
+            return
+        if entry.running and entry.overlap == OVERLAP_QUEUE:
+            entry.queued += 1
+            return
+        entry.running += 1
+        task = asyncio.create_task(self._run_entry(entry))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run_entry(self, entry: _ScheduledBehaviour):
+        try:
+            while True:
+                start = time.perf_counter_ns()
+                try:
+                    await entry.behaviour.run()
+                except Exception as e:
+                    entry.errors.inc()
+                    entry.behaviour.agent.print(f"Error running {type(entry.behaviour).__name__}: {e}")
+                entry.duration.record(time.perf_counter_ns() - start)
+                if not entry.queued or entry.cancelled:
+                    return
+                entry.queued -= 1
+        finally:
+            entry.running -= 1
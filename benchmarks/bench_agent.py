@@ -0,0 +1,82 @@
+"""
+Runs one agent of the loopback benchmark, configured by `benchmarks.loopback` through the environment.
+
+The sender drives messages at `BENCH_RATE` messages per second for `BENCH_DURATION` seconds, a `BENCH_CRYPTO_RATIO`
+share of them crypto messages, each stamped with its send time. The receiver records the end-to-end latency of
+every message when it is dispatched. Both agents run the regular handlers and expose their metrics on `METRICS_PORT`.
+
+Usage: python -m benchmarks.bench_agent sender|receiver
+"""
+import asyncio
+import os
+import random
+import sys
+import time
+
+from agent import AutonomousAgent
+from behaviours.check_balance_behaviour import CheckBalanceBehaviour
+from behaviours.send_message_behaviour import SendMessageBehaviour
+from handlers.crypto_handler import CryptoHandler
+from handlers.handler import Handler
+from handlers.hello_handler import HelloHandler
+from message import Message
+
+
+class LatencyProbe(Handler):
+    """
+    Records the time between the send stamp at the end of every message and its dispatch.
+    """
+
+    def __init__(self, agent: AutonomousAgent):
+        super().__init__(agent)
+        self.latency = agent.metrics.histogram("bench_latency_seconds", "End-to-end latency of benchmark messages")
+        self.received = agent.metrics.counter("bench_messages_received_total", "Benchmark messages dispatched")
+        self.last_received_at = agent.metrics.gauge("bench_last_received_at", "Wall time of the last dispatch")
+
+    def handle_message(self, message: Message) -> bool:
+        now = time.time_ns()
+        self.latency.record(now - int(message.message.rsplit(" ", 1)[-1]))
+        self.received.inc()
+        self.last_received_at.set(now / 1e9)
+        return False
+
+
+async def drive(agent: AutonomousAgent, rate: float, duration: float, crypto_ratio: float, seed: int):
+    """
+    Queues benchmark messages at a steady rate, catching up on ticks the event loop was late for.
+    """
+    sent = agent.metrics.counter("bench_messages_sent_total", "Benchmark messages queued")
+    started_at = agent.metrics.gauge("bench_started_at", "Wall time the sender started sending")
+    rng = random.Random(seed)
+    await agent.interactor.ready.wait()
+    await asyncio.sleep(float(os.getenv("BENCH_WARMUP", 1)))
+    start = time.monotonic()
+    started_at.set(time.time())
+    while (elapsed := time.monotonic() - start) < duration:
+        for _ in range(int(rate * elapsed) - sent.value):
+            kind = "crypto" if rng.random() < crypto_ratio else "hello"
+            await agent.server.send_to_outbox(Message(sent.value, f"{kind} {time.time_ns()}"))
+            sent.inc()
+        await asyncio.sleep(0.005)
+
+
+def main(role: str):
+    agent = AutonomousAgent(os.getenv("PROVIDER_URL"), os.getenv("PRIVATE_KEY"))
+    flush = SendMessageBehaviour(agent)
+    flush.interval = float(os.getenv("BENCH_FLUSH_INTERVAL", 0.01))
+    agent.register_behaviour(flush)
+    agent.register_behaviour(CheckBalanceBehaviour(agent))
+    if role == "receiver":
+        # First, so that the latency does not include the time spent in the other handlers
+        agent.register_handler(LatencyProbe(agent))
+    agent.register_handler(HelloHandler(agent))
+    agent.register_handler(CryptoHandler(agent))
+    if role == "receiver":
+        agent.run_loop()
+    else:
+        agent.run_loop(drive(agent, float(os.getenv("BENCH_RATE", 1000)), float(os.getenv("BENCH_DURATION", 10)),
+                             float(os.getenv("BENCH_CRYPTO_RATIO", 0.1)), int(os.getenv("BENCH_SEED", 1))))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
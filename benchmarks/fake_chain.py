@@ -0,0 +1,173 @@
+import asyncio
+import collections
+
+import rlp
+from aiohttp import web
+from eth_account import Account
+from eth_utils import keccak
+
+from helpers.sa_contract_helper import TRANSFER_SELECTOR
+
+DECIMALS_SELECTOR = "0x313ce567"
+BALANCE_OF_SELECTOR = "0x70a08231"
+TRANSFER_TOPIC = "0x" + keccak(text="Transfer(address,address,uint256)").hex()
+
+
+def _word(value: int) -> str:
+    return "0x" + value.to_bytes(32, "big").hex()
+
+
+def _topic(address: str) -> str:
+    return "0x" + address.lower()[2:].rjust(64, "0")
+
+
+class FakeChain:
+    """
+    A JSON-RPC stand-in for an Ethereum node with one ERC20 token, enough to run agents offline.
+
+    It answers the calls the agent makes: chain id, gas price, block number, nonces, `decimals` and `balanceOf`
+    calls, raw transfer transactions, receipts and `Transfer` logs. Every account starts with `initial_balance`
+    tokens. Transactions are recovered, their nonce checked, and mined in the next block, and blocks are produced
+    every `block_time` seconds. Every call is counted by method, single and batched alike.
+
+    Attributes:
+        decimals (int): The token decimals.
+        initial_balance (int): The token balance of an account that never transferred, in the smallest unit.
+        block_time (float): The time between two blocks, in seconds.
+        block (int): The latest block number.
+        calls (Counter): The number of calls, by JSON-RPC method.
+    """
+
+    def __init__(self, decimals: int = 18, initial_balance: int = 10 ** 24, block_time: float = 1.0):
+        self.decimals = decimals
+        self.initial_balance = initial_balance
+        self.block_time = block_time
+        self.block = 1
+        self.calls = collections.Counter()
+        self.nonces = collections.Counter()
+        self.balances = collections.defaultdict(lambda: self.initial_balance)
+        self.transactions = {}
+        # Transactions of each sender waiting for the next block
+        self._unmined = collections.Counter()
+        self.logs = []
+        self._runner = None
+        self._blocks = None
+
+    def handle(self, request: dict) -> dict:
+        """
+        Answers one JSON-RPC request.
+
+        Args:
+            request (dict): The request.
+
+        Returns:
+            dict: The response.
+        """
+        method, params = request.get("method"), request.get("params", [])
+        self.calls[method] += 1
+        try:
+            handler = getattr(self, f"_{method}", None)
+            if handler is None:
+                return {"jsonrpc": "2.0", "id": request.get("id"),
+                        "error": {"code": -32601, "message": f"Method {method} not found"}}
+            return {"jsonrpc": "2.0", "id": request.get("id"), "result": handler(*params)}
+        except Exception as e:
+            return {"jsonrpc": "2.0", "id": request.get("id"), "error": {"code": -32000, "message": str(e)}}
+
+    def _eth_chainId(self):
+        return "0x539"
+
+    def _eth_gasPrice(self):
+        return hex(10 ** 9)
+
+    def _eth_blockNumber(self):
+        return hex(self.block)
+
+    def _eth_getTransactionCount(self, address, block="latest"):
+        address = address.lower()
+        if block == "pending":
+            return hex(self.nonces[address])
+        return hex(self.nonces[address] - self._unmined[address])
+
+    def _eth_call(self, call, block="latest"):
+        data = call.get("data") or call.get("input")
+        if data.startswith(DECIMALS_SELECTOR):
+            return _word(self.decimals)
+        if data.startswith(BALANCE_OF_SELECTOR):
+            return _word(self.balances["0x" + data[-40:].lower()])
+        raise ValueError("execution reverted")
+
+    def _eth_sendRawTransaction(self, raw):
+        sender = Account.recover_transaction(raw).lower()
+        payload = bytes.fromhex(raw[2:])
+        nonce, _, _, to, _, data = rlp.decode(payload)[:6]
+        nonce = int.from_bytes(nonce, "big")
+        if nonce != self.nonces[sender]:
+            raise ValueError(f"nonce too low: next nonce {self.nonces[sender]}, tx nonce {nonce}")
+        self.nonces[sender] += 1
+        self._unmined[sender] += 1
+        tx_hash = "0x" + keccak(payload).hex()
+        self.transactions[tx_hash] = (self.block + 1, sender, "0x" + to.hex())
+        if data[:4] == TRANSFER_SELECTOR:
+            recipient = "0x" + data[16:36].hex()
+            amount = int.from_bytes(data[36:68], "big")
+            self.balances[sender] -= amount
+            self.balances[recipient] += amount
+            self.logs.append({"address": "0x" + to.hex(), "blockNumber": hex(self.block + 1),
+                              "transactionHash": tx_hash, "logIndex": "0x0", "data": _word(amount),
+                              "topics": [TRANSFER_TOPIC, _topic(sender), _topic(recipient)]})
+        return tx_hash
+
+    def _eth_getTransactionReceipt(self, tx_hash):
+        mined = self.transactions.get(tx_hash)
+        if mined is None or mined[0] > self.block:
+            return None
+        block, sender, to = mined
+        return {"transactionHash": tx_hash, "blockNumber": hex(block), "blockHash": "0x" + "00" * 32,
+                "transactionIndex": "0x0", "from": sender, "to": to, "status": "0x1", "gasUsed": "0xc350",
+                "cumulativeGasUsed": "0xc350", "effectiveGasPrice": hex(10 ** 9), "contractAddress": None,
+                "logs": [], "logsBloom": "0x" + "00" * 256, "type": "0x0"}
+
+    def _eth_getLogs(self, log_filter):
+        start, end = int(log_filter["fromBlock"], 16), int(log_filter["toBlock"], 16)
+        topics = log_filter.get("topics", [])
+
+        def matches(log):
+            if not start <= int(log["blockNumber"], 16) <= min(end, self.block):
+                return False
+            return all(topic is None or log["topics"][index] == topic for index, topic in enumerate(topics))
+
+        return [log for log in self.logs if matches(log)]
+
+    async def _handle_http(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        if isinstance(body, list):
+            return web.json_response([self.handle(item) for item in body])
+        return web.json_response(self.handle(body))
+
+    async def _produce_blocks(self):
+        while True:
+            await asyncio.sleep(self.block_time)
+            self.block += 1
+            self._unmined.clear()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8545):
+        """
+        Serves the JSON-RPC endpoint on the running event loop and starts producing blocks.
+
+        Args:
+            host (str, optional): The address to listen on. Defaults to 127.0.0.1.
+            port (int, optional): The port to listen on. Defaults to 8545.
+        """
+        app = web.Application()
+        app.router.add_post("/", self._handle_http)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self._blocks = asyncio.create_task(self._produce_blocks())
+
+    async def stop(self):
+        if self._blocks is not None:
+            self._blocks.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
@@ -0,0 +1,244 @@
+"""
+Offline two-agent loopback benchmark.
+
+Starts a `FakeChain` in process and two agents (`benchmarks.bench_agent`) as subprocesses talking over loopback,
+drives messages from the sender to the receiver at a fixed rate and mix of hello and crypto messages, and
+reports throughput, end-to-end latency quantiles, CPU and memory of each agent and RPC calls per message as one
+JSON object per run. Agent settings from the environment (INBOX_LANES, HANDLER_ROUTING, LOG_LEVEL, ...) apply to
+both agents, so the same command compares configurations and commits.
+
+With `--check` the command fails if a run lost messages, or if its crypto payouts were not merged into fewer
+transfers than payouts, which happens when the dispatchers wait for each payout before reading the next message.
+
+Usage: python -m benchmarks.loopback --mode both --rate 2000 --duration 10 --crypto-ratio 0.1 --output runs.jsonl
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+from eth_account import Account
+
+from benchmarks.fake_chain import FakeChain
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Throwaway keys of the two agents, the fake chain funds every account
+SENDER_KEY = "0x" + "11" * 32
+RECEIVER_KEY = "0x" + "22" * 32
+TOKEN_ADDRESS = "0x6B175474E89094C44Da98b954EedeAC495271d0F"
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def process_usage(pid: int) -> dict:
+    """
+    Reads the CPU time and memory of a process from /proc (Linux).
+
+    Args:
+        pid (int): The process id.
+
+    Returns:
+        dict: The CPU time in seconds and the current and peak resident set size in MiB, empty if unavailable.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/status") as status:
+            memory = dict(line.split(":", 1) for line in status if line.startswith(("VmRSS", "VmHWM")))
+    except OSError:
+        return {}
+    return {"cpu_seconds": (int(fields[11]) + int(fields[12])) / CLOCK_TICKS,
+            "rss_mib": int(memory["VmRSS"].split()[0]) / 1024, "max_rss_mib": int(memory["VmHWM"].split()[0]) / 1024}
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+async def snapshot(session: aiohttp.ClientSession, port: int, previous: dict = None) -> dict:
+    """
+    Fetches the metrics of an agent, or returns `previous` if the agent does not answer in time.
+    """
+    try:
+        async with session.get(f"http://127.0.0.1:{port}/snapshot") as response:
+            return await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+        return previous if previous is not None else {}
+
+
+async def run_once(mode: str, rate: float, duration: float, crypto_ratio: float, seed: int,
+                   drain_timeout: float) -> dict:
+    """
+    Runs one benchmark and returns its results.
+
+    Args:
+        mode (str): The server mode of both agents, "socket" or "http".
+        rate (float): The messages sent per second.
+        duration (float): The time messages are sent for, in seconds.
+        crypto_ratio (float): The share of crypto messages.
+        seed (int): The seed of the message mix.
+        drain_timeout (float): The time to wait for the receiver to catch up once sending stops, in seconds.
+
+    Returns:
+        dict: The results.
+    """
+    chain = FakeChain()
+    chain_port = free_port()
+    await chain.start("127.0.0.1", chain_port)
+    ports = {"sender": free_port(), "receiver": free_port()}
+    metrics_ports = {"sender": free_port(), "receiver": free_port()}
+    keys = {"sender": SENDER_KEY, "receiver": RECEIVER_KEY}
+    processes = {}
+    # Every run starts with empty ledgers, one per agent, outside the working directory the agents share
+    ledgers = tempfile.TemporaryDirectory(prefix="loopback-ledger-")
+    try:
+        for role, peer in (("receiver", "sender"), ("sender", "receiver")):
+            env = {**os.environ, "SERVER_MODE": mode, "HOST": "127.0.0.1", "PORT": str(ports[role]),
+                   "OUTBOX_HOST": "127.0.0.1", "OUTBOX_PORT": str(ports[peer]),
+                   "OUTBOX_PUBLIC_ADDRESS": Account.from_key(keys[peer]).address,
+                   "PROVIDER_URL": f"http://127.0.0.1:{chain_port}", "PRIVATE_KEY": keys[role],
+                   "ERC20_ADDRESS": TOKEN_ADDRESS, "TRANSFER_AMOUNT": os.getenv("TRANSFER_AMOUNT", "0.001"),
+                   "METRICS_PORT": str(metrics_ports[role]), "LOG_LEVEL": os.getenv("LOG_LEVEL", "warning"),
+                   "LEDGER_DIR": os.path.join(ledgers.name, role),
+                   "WORKERS": "1", "BENCH_RATE": str(rate), "BENCH_DURATION": str(duration),
+                   "BENCH_CRYPTO_RATIO": str(crypto_ratio), "BENCH_SEED": str(seed)}
+            processes[role] = subprocess.Popen([sys.executable, "-m", "benchmarks.bench_agent", role], cwd=ROOT,
+                                               env=env, stdout=sys.stderr)
+        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=2)) as session:
+            sender = {}
+            while not sender.get("bench_started_at"):
+                await asyncio.sleep(0.01)
+                for role, process in processes.items():
+                    if process.poll() is not None:
+                        raise RuntimeError(f"The {role} agent exited with code {process.returncode}")
+                sender = await snapshot(session, metrics_ports["sender"])
+            usage_before = {role: process_usage(process.pid) for role, process in processes.items()}
+            measured_from = time.monotonic()
+            calls_before = sum(chain.calls.values())
+            await asyncio.sleep(max(0.0, sender["bench_started_at"] + duration - time.time()))
+            sender = await snapshot(session, metrics_ports["sender"], sender)
+            deadline = time.monotonic() + drain_timeout
+            receiver = {}
+            while True:
+                receiver = await snapshot(session, metrics_ports["receiver"], receiver)
+                if receiver.get("bench_messages_received_total", 0) >= sender.get("bench_messages_sent_total", 0):
+                    break
+                if time.monotonic() > deadline:
+                    break
+                await asyncio.sleep(0.05)
+            # Let the payouts of the last crypto messages reach the chain
+            await asyncio.sleep(float(os.getenv("TRANSFER_BATCH_WAIT", 0.2)) + 0.1)
+            usage_after = {role: process_usage(process.pid) for role, process in processes.items()}
+            window = time.monotonic() - measured_from
+            receiver = await snapshot(session, metrics_ports["receiver"], receiver)
+            calls = sum(chain.calls.values()) - calls_before
+    finally:
+        for process in processes.values():
+            process.terminate()
+        for process in processes.values():
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        await chain.stop()
+        ledgers.cleanup()
+
+    sent = sender.get("bench_messages_sent_total", 0)
+    received = receiver.get("bench_messages_received_total", 0)
+    elapsed = receiver.get("bench_last_received_at", 0) - sender["bench_started_at"] if received else duration
+    latency = receiver.get("bench_latency_seconds", {})
+    agents = {}
+    for role in processes:
+        before, after = usage_before[role], usage_after[role]
+        if before and after:
+            cpu = after["cpu_seconds"] - before["cpu_seconds"]
+            agents[role] = {"cpu_seconds": round(cpu, 3), "cpu_percent": round(100 * cpu / window, 1),
+                            "rss_mib": round(after["rss_mib"], 1), "max_rss_mib": round(after["max_rss_mib"], 1)}
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "mode": mode,
+        "rate": rate,
+        "duration": duration,
+        "crypto_ratio": crypto_ratio,
+        "seed": seed,
+        # The agent's own default unless set in the environment
+        "dispatchers": int(os.getenv("DISPATCHERS", 1)),
+        "sent": sent,
+        "received": received,
+        "lost": sent - received,
+        "throughput": round(received / elapsed, 1),
+        "latency_seconds": {key: latency.get(key) for key in ("p50", "p99", "p99.9", "max")},
+        "agents": agents,
+        "rpc_calls": calls,
+        "rpc_calls_per_message": round(calls / received, 4) if received else None,
+        "transfers": {result: receiver.get(f'agent_transfers_total{{result="{result}"}}', 0)
+                      for result in ("sent", "failed")},
+        "payouts": receiver.get("agent_transfer_intents_total", 0),
+    }
+
+
+def check(result: dict) -> list:
+    """
+    Lists what is wrong with a run: lost messages, or payouts that were not batched.
+
+    Args:
+        result (dict): The results of a run.
+
+    Returns:
+        list: The problems found, empty if none.
+    """
+    problems = []
+    if result["lost"]:
+        problems.append(f"{result['lost']} messages lost")
+    transfers = result["transfers"]["sent"] + result["transfers"]["failed"]
+    if result["payouts"] > 1 and transfers >= result["payouts"]:
+        problems.append(f"{result['payouts']} payouts made {transfers} transfers, they were not batched")
+    return problems
+
+
+async def main(args) -> int:
+    modes = ("socket", "http") if args.mode == "both" else (args.mode,)
+    failed = False
+    for mode in modes:
+        result = await run_once(mode, args.rate, args.duration, args.crypto_ratio, args.seed, args.drain_timeout)
+        line = json.dumps(result)
+        print(line, flush=True)
+        if args.output:
+            with open(args.output, "a") as output:
+                output.write(line + "\n")
+        if args.check:
+            for problem in check(result):
+                print(f"Check failed in {mode} mode: {problem}", file=sys.stderr)
+                failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline two-agent loopback benchmark")
+    parser.add_argument("--mode", choices=("socket", "http", "both"), default="both")
+    parser.add_argument("--rate", type=float, default=1000, help="messages sent per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of sending")
+    parser.add_argument("--crypto-ratio", type=float, default=0.1, help="share of crypto messages")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the message mix")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for the receiver")
+    parser.add_argument("--output", help="file to append the results to, one JSON object per line")
+    parser.add_argument("--check", action="store_true", help="fail if messages are lost or payouts are not batched")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -2,25 +2,43 @@ import os
 
 from agent import AutonomousAgent
 from handlers.handler import Handler
+from helpers.receipt_tracker import OUTCOMES
+from helpers.transfer_ledger import transfer_key
 from message import Message
 
 
 class CryptoHandler(Handler):
+    keywords = ("crypto",)
+    lane = "high"
+    uses_chain = True
+    # Payouts wait for their batch to fill, run them off the dispatcher with room for several batches
+    execution = "async"
+    concurrency = 1000
+    timeout = 60.0
 
     def __init__(self, agent: AutonomousAgent):
         super().__init__(agent)
         self.amount = float(os.getenv('TRANSFER_AMOUNT'))
         self.to_address = os.getenv("OUTBOX_PUBLIC_ADDRESS")
 
-    def handle_message(self, message: Message) -> bool:
-        if "crypto" in message.message.lower():
-            decimals = self.agent.interactor.decimals
-            amount = int(self.amount * (10 ** decimals))
-            self.agent.print(f"Crypto message received: {message.__dict__}\n sending {amount} to {self.to_address}")
-            sent = self.agent.interactor.send_token(self.to_address, amount)
-            if sent:
-                self.agent.print(f"sent {amount} to address {self.to_address}")
-            else:
-                self.agent.print(f"failed to handle crypto message {message.__dict__}")
-            return True
-        return False
+    async def handle_message(self, message: Message) -> bool:
+        decimals = await self.agent.interactor.decimals()
+        amount = int(self.amount * (10 ** decimals))
+        self.agent.print(f"Crypto message received: {message.fields()}\n sending {amount} to {self.to_address}")
+        sent = await self.agent.interactor.batcher.submit(self.to_address, amount,
+                                                          key=transfer_key(message.sender, message.id))
+        if sent:
+            self.agent.print(f"sent {amount} to address {self.to_address} in transaction {sent}")
+            settled = self.agent.interactor.receipts.watch(sent)
+            if settled is not None:
+                settled.add_done_callback(self.report_outcome)
+        else:
+            self.agent.print(f"failed to handle crypto message {message.fields()}")
+        return True
+
+    def report_outcome(self, settled):
+        if settled.cancelled():
+            # No longer followed, the agent is shutting down
+            return
+        state, tx_hash = settled.result()
+        self.agent.print(f"transfer {tx_hash} {OUTCOMES[state]}")
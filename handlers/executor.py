@@ -0,0 +1,191 @@
+import asyncio
+import inspect
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from helpers.metrics import metrics
+from message import Message
+
+# How a handler's handle_message is run
+EXECUTION_INLINE = "inline"
+EXECUTION_ASYNC = "async"
+EXECUTION_THREAD = "thread"
+EXECUTION_PROCESS = "process"
+EXECUTION_MODES = (EXECUTION_INLINE, EXECUTION_ASYNC, EXECUTION_THREAD, EXECUTION_PROCESS)
+
+
+def _run_in_process(handler, message: Message):
+    return handler.handle_message(message)
+
+
+class ExecutorPools:
+    """
+    The thread and process pools shared by the handlers of an agent, created on first use.
+
+    Attributes:
+        threads (int): The size of the thread pool, `HANDLER_THREADS` or the executor default.
+        processes (int): The size of the process pool, `HANDLER_PROCESSES` or the number of CPUs.
+    """
+
+    def __init__(self, threads: int = None, processes: int = None):
+        self.threads = threads or int(os.getenv("HANDLER_THREADS", 0)) or None
+        self.processes = processes or int(os.getenv("HANDLER_PROCESSES", 0)) or os.cpu_count()
+        self._thread_pool = None
+        self._process_pool = None
+
+    @property
+    def thread_pool(self) -> ThreadPoolExecutor:
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(self.threads, thread_name_prefix="handler")
+        return self._thread_pool
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        if self._process_pool is None:
+            # Spawned rather than forked, the agent's process runs an event loop and threads
+            self._process_pool = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("spawn"))
+        return self._process_pool
+
+    def shutdown(self):
+        for pool in (self._thread_pool, self._process_pool):
+            if pool is not None:
+                pool.shutdown(wait=False, cancel_futures=True)
+
+
+class HandlerExecutor:
+    """
+    Runs the `handle_message` calls of one handler according to its execution mode and limits.
+
+    Inline handlers run in the dispatcher that routed the message, as before. The other modes run every call as
+    a task of its own, so the dispatcher moves on to the next message: `async` awaits a coroutine on the event
+    loop, `thread` runs a blocking `handle_message` in the agent's thread pool, and `process` runs it in the
+    agent's process pool, on a copy of the handler without its agent. At most `concurrency` calls run at once
+    and at most `queue_size` more wait for a slot; `submit` waits while the queue is full, which holds back the
+    dispatchers. A call running longer than `timeout` is abandoned and reported as unhandled, although a thread
+    or process cannot be interrupted and finishes in the background. Calls of a handler declaring `uses_chain`
+    are submitted as tasks waiting for the agent's chain access until it is ready, whatever their mode.
+
+    Attributes:
+        handler (Handler): The handler.
+        agent (AutonomousAgent): The agent the handler belongs to.
+        execution (str): The execution mode, one of `EXECUTION_MODES`.
+        timeout (float): The maximum time, in seconds, awaited for a call, or None.
+        queue_size (int): The maximum number of calls waiting for a slot, 0 for unbounded.
+        waiting (int): The number of calls waiting for a slot.
+        running (int): The number of calls running.
+        duration (Histogram): The duration of the handler's calls, reported as
+            `agent_handler_duration_seconds{handler=...}` along with error and timeout counters.
+    """
+
+    def __init__(self, handler, agent):
+        """
+        Args:
+            handler (Handler): The handler, declaring `execution`, `concurrency`, `queue_size` and `timeout`.
+            agent (AutonomousAgent): The agent the handler belongs to.
+
+        Raises:
+            ValueError: If the execution mode is unknown.
+        """
+        self.handler = handler
+        self.agent = agent
+        self.execution = handler.execution or EXECUTION_INLINE
+        if self.execution not in EXECUTION_MODES:
+            raise ValueError(f"Unknown execution mode {self.execution}, expected one of {', '.join(EXECUTION_MODES)}")
+        self.timeout = handler.timeout
+        self.queue_size = handler.queue_size
+        self.waiting = 0
+        self.running = 0
+        self._slots = asyncio.Semaphore(handler.concurrency) if handler.concurrency else None
+        self._room = asyncio.Event()
+        self._room.set()
+        name = type(handler).__name__
+        self.duration = metrics.histogram("agent_handler_duration_seconds", "Duration of handle_message calls",
+                                          handler=name)
+        self.errors = metrics.counter("agent_handler_errors_total", "handle_message calls that raised", handler=name)
+        self.timeouts = metrics.counter("agent_handler_timeouts_total", "handle_message calls that timed out",
+                                        handler=name)
+        metrics.gauge("agent_handler_waiting", "Messages waiting for a handler slot", lambda: self.waiting,
+                      handler=name)
+        metrics.gauge("agent_handler_running", "Messages being handled", lambda: self.running, handler=name)
+
+    @property
+    def inline(self) -> bool:
+        return self.execution == EXECUTION_INLINE
+
+    @property
+    def deferred(self) -> bool:
+        """
+        Whether calls have to wait for the agent's chain access, and so cannot run in the dispatcher right now.
+        """
+        return self.handler.uses_chain and not self.agent.interactor.ready.is_set()
+
+    async def submit(self, message: Message) -> asyncio.Task:
+        """
+        Queues a call of the handler, waiting while its queue is full.
+
+        Args:
+            message (Message): The message to handle.
+
+        Returns:
+            Task: The call, resolving to the value returned by `handle_message`, or False if it failed.
+        """
+        while self.queue_size and self.waiting >= self.queue_size:
+            self._room.clear()
+            await self._room.wait()
+        self.waiting += 1
+        return asyncio.create_task(self._run(message))
+
+    async def _run(self, message: Message):
+        try:
+            if self.handler.uses_chain:
+                await self.agent.interactor.ready.wait()
+            if self._slots is None:
+                return await self._start(message)
+            async with self._slots:
+                return await self._start(message)
+        except Exception as e:
+            self.agent.print(f"Error in {type(self.handler).__name__} processing message {message.fields()}: {e}")
+            return False
+
+    async def _start(self, message: Message):
+        self.waiting -= 1
+        self._room.set()
+        self.running += 1
+        try:
+            return await self.execute(message)
+        finally:
+            self.running -= 1
+
+    async def execute(self, message: Message):
+        """
+        Calls the handler right away, in its execution mode.
+
+        Args:
+            message (Message): The message to handle.
+
+        Returns:
+            The value returned by `handle_message`, or False if the call timed out.
+        """
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter_ns()
+        try:
+            if self.execution == EXECUTION_THREAD:
+                call = loop.run_in_executor(self.agent.pools.thread_pool, self.handler.handle_message, message)
+            elif self.execution == EXECUTION_PROCESS:
+                call = loop.run_in_executor(self.agent.pools.process_pool, _run_in_process, self.handler, message)
+            else:
+                call = self.handler.handle_message(message)
+                if not inspect.isawaitable(call):
+                    return call
+            return await asyncio.wait_for(call, self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts.inc()
+            self.agent.print(f"{type(self.handler).__name__} timed out after {self.timeout}s on message {message.id}")
+            return False
+        except Exception:
+            self.errors.inc()
+            raise
+        finally:
+            self.duration.record(time.perf_counter_ns() - start)
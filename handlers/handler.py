@@ -9,12 +9,39 @@ class Handler:
 
     This class serves as a blueprint for implementing custom message handling logic.
     Subclasses should implement the `handle_message` method to define specific
-    behavior for processing messages.
+    behavior for processing messages, and declare which messages they are interested in
+    through class attributes. The agent compiles these criteria into a single routing index
+    and only calls `handle_message` for matching messages; a handler declaring no keywords,
+    prefixes or patterns receives every message.
 
     Attributes:
         agent (AutonomousAgent): The agent associated with this handler.
+        keywords (tuple): Case-insensitive words, any of which the message text must contain.
+        prefixes (tuple): Case-insensitive prefixes, any of which the message text must start with.
+        patterns (tuple): Regular expressions (strings or compiled), any of which must match the message text.
+        predicates (tuple): Callables taking the Message, all of which must return True.
+        execution (str): How `handle_message` is run: "inline" in the dispatcher (the default), "async" as a
+            task of its own, "thread" in the agent's thread pool, or "process" in the agent's process pool.
+        concurrency (int): The maximum number of messages handled at once outside the dispatcher, 0 for no limit.
+        queue_size (int): The maximum number of messages waiting for the handler before the dispatchers wait,
+            0 for no limit.
+        timeout (float): The maximum time, in seconds, a message is awaited for, or None.
+        lane (str): The inbox lane of the messages matching the handler, or None for the lowest priority lane.
+        uses_chain (bool): Whether the handler needs chain access. Until the agent's chain access is ready, its
+            messages wait in the background instead of holding back the dispatchers.
     """
 
+    keywords: tuple = ()
+    prefixes: tuple = ()
+    patterns: tuple = ()
+    predicates: tuple = ()
+    execution: str = None
+    concurrency: int = 0
+    queue_size: int = 100
+    timeout: float = None
+    lane: str = None
+    uses_chain: bool = False
+
     def __init__(self, agent: AutonomousAgent):
         """
         Initializes the Handler class.
@@ -24,13 +51,20 @@ class Handler:
         """
         self.agent = agent
 
+    def __getstate__(self):
+        # Handlers running in the process pool are sent there without their agent
+        return {**self.__dict__, "agent": None}
+
     @abstractmethod
     def handle_message(self, message: Message) -> bool:
         """
-        Processes a message sent to the agent.
+        Processes a message sent to the agent and matched by the handler's criteria.
 
         This method must be implemented in subclasses. It defines the logic for
-        handling incoming messages from other agents or systems.
+        handling incoming messages from other agents or systems. It may be implemented
+        as a coroutine (`async def`) when it needs to await I/O such as chain calls. Handlers running in the
+        thread or process pool implement it as a plain blocking method; in the process pool it has no agent, and
+        its return value must be picklable.
 
         Args:
             message (Message): The content of the message being handled.
@@ -0,0 +1,171 @@
+import re
+
+ROUTING_ALL = "all"
+ROUTING_FIRST = "first"
+
+
+class KeywordAutomaton:
+    """
+    An Aho-Corasick automaton finding every keyword contained in a text in a single pass over the text,
+    regardless of how many keywords are registered.
+    """
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+    def add(self, keyword: str, value):
+        """
+        Adds a keyword to the automaton. `build` must be called before searching again.
+
+        Args:
+            keyword (str): The keyword to find.
+            value: The value reported when the keyword is found.
+        """
+        state = 0
+        for char in keyword:
+            nxt = self._goto[state].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+        self._out[state] = self._out[state] + (value,)
+
+    def build(self):
+        """
+        Computes the failure links, merging the outputs of every state with those of its suffixes.
+        """
+        queue = list(self._goto[0].values())
+        for state in queue:
+            self._fail[state] = 0
+        for state in queue:
+            for char, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[nxt] = self._goto[fail].get(char, 0)
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def search(self, text: str) -> set:
+        """
+        Finds the values of every keyword contained in `text`.
+
+        Args:
+            text (str): The text to search.
+
+        Returns:
+            set: The values of the keywords found.
+        """
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class HandlerRouter:
+    """
+    Compiles the match criteria declared by handlers into one routing index, so that each message is scanned
+    once instead of once per handler.
+
+    Keywords (case-insensitive substrings) are indexed in an Aho-Corasick automaton and prefixes in a trie, so
+    their cost does not grow with the number of handlers. Regular expressions are searched only for handlers
+    declaring them, and predicates only filter handlers that already matched. Handlers declaring no keywords,
+    prefixes or patterns match every message.
+
+    Attributes:
+        mode (str): "all" to run every matching handler, "first" to stop at the first one that handles the message.
+        handlers (list): The registered handlers, in registration order.
+    """
+
+    def __init__(self, mode: str = ROUTING_ALL):
+        """
+        Initializes an empty router.
+
+        Args:
+            mode (str, optional): The routing semantics, "all" or "first". Defaults to "all".
+        """
+        if mode not in (ROUTING_ALL, ROUTING_FIRST):
+            raise ValueError(f"Unknown routing mode: {mode}")
+        self.mode = mode
+        self.handlers = []
+        self._compiled = False
+
+    def add(self, handler):
+        """
+        Registers a handler and marks the index for recompilation.
+
+        Args:
+            handler (Handler): The handler to route messages to.
+        """
+        self.handlers.append(handler)
+        self._compiled = False
+
+    def compile(self):
+        """
+        Builds the keyword automaton, the prefix trie and the regex and predicate tables from the handlers.
+        """
+        self._keywords = KeywordAutomaton()
+        self._prefixes = {}
+        self._patterns = []
+        self._predicates = {}
+        self._catch_all = set()
+        for index, handler in enumerate(self.handlers):
+            for keyword in handler.keywords:
+                self._keywords.add(keyword.lower(), index)
+            for prefix in handler.prefixes:
+                node = self._prefixes
+                for char in prefix.lower():
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(index)
+            for pattern in handler.patterns:
+                self._patterns.append((index, re.compile(pattern) if isinstance(pattern, str) else pattern))
+            if handler.predicates:
+                self._predicates[index] = handler.predicates
+            if not (handler.keywords or handler.prefixes or handler.patterns):
+                self._catch_all.add(index)
+        self._keywords.build()
+        self._compiled = True
+
+    def route(self, message) -> list:
+        """
+        Finds the handlers matching a message.
+
+        Args:
+            message (Message): The message to route.
+
+        Returns:
+            list: The matching handlers, in registration order.
+        """
+        if not self._compiled:
+            self.compile()
+        text = message.message
+        lowered = text.lower()
+        matched = self._keywords.search(lowered)
+        matched.update(self._catch_all)
+        node = self._prefixes
+        for char in lowered:
+            node = node.get(char)
+            if node is None:
+                break
+            matched.update(node.get(None, ()))
+        for index, pattern in self._patterns:
+            if index not in matched and pattern.search(text):
+                matched.add(index)
+        handlers = []
+        for index in sorted(matched):
+            predicates = self._predicates.get(index)
+            if predicates and not all(predicate(message) for predicate in predicates):
+                continue
+            handlers.append(self.handlers[index])
+        return handlers
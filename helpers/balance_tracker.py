@@ -0,0 +1,147 @@
+import inspect
+import json
+import os
+
+# keccak("Transfer(address,address,uint256)")
+TRANSFER_TOPIC = "0xddf252ad1be2c89b69c2b068fc378daa952ba7f163c4a11628f55a4df523b3ef"
+
+
+class BalanceTracker:
+    """
+    Keeps the ERC20 balance of an address up to date in memory by following the `Transfer` logs touching it.
+
+    Each `sync` scans the blocks since the last one applied with chunked `eth_getLogs` range queries (incoming and
+    outgoing transfers in one JSON-RPC batch) and applies the deltas locally. A full `balanceOf` read is only
+    made on the first sync and every `reconcile_every` blocks, to correct any drift such as a reorg. The last
+    applied block and the balance can be persisted to `cursor_path` so a restarted agent resumes its scan.
+
+    Attributes:
+        helper (SAContractHelper): The contract helper used for chain access.
+        address (str): The tracked address, None until `track` is called.
+        balance (int): The tracked balance in the smallest unit, None before the first sync.
+        block (int): The last block applied to `balance`.
+        chunk_size (int): The maximum number of blocks per `eth_getLogs` query (`LOG_CHUNK_SIZE`).
+        reconcile_every (int): Blocks between two full `balanceOf` reads (`BALANCE_RECONCILE_BLOCKS`).
+        cursor_path (str): The file persisting the cursor (`BALANCE_CURSOR_PATH`), None to keep it in memory.
+    """
+
+    def __init__(self, helper, address: str = None, cursor_path: str = None, chunk_size: int = None,
+                 reconcile_every: int = None):
+        """
+        Initializes the BalanceTracker and, when the address is given, loads its persisted cursor, if any.
+
+        Args:
+            helper (SAContractHelper): The contract helper used for chain access.
+            address (str, optional): The tracked address. Defaults to the address passed to `track` later.
+            cursor_path (str, optional): Defaults to `BALANCE_CURSOR_PATH`, or no persistence.
+            chunk_size (int, optional): Defaults to `LOG_CHUNK_SIZE`, or 2000 blocks.
+            reconcile_every (int, optional): Defaults to `BALANCE_RECONCILE_BLOCKS`, or 1000 blocks.
+        """
+        self.helper = helper
+        self.address = None
+        self.cursor_path = cursor_path or os.getenv("BALANCE_CURSOR_PATH")
+        self.chunk_size = chunk_size or int(os.getenv("LOG_CHUNK_SIZE", 2000))
+        self.reconcile_every = reconcile_every or int(os.getenv("BALANCE_RECONCILE_BLOCKS", 1000))
+        self.balance = None
+        self.block = None
+        self.reconciled_at = None
+        self._listeners = []
+        self._topic = None
+        if address is not None:
+            self.track(address)
+
+    def track(self, address: str):
+        """
+        Sets the tracked address, once it is known, and loads its persisted cursor, if any.
+
+        Args:
+            address (str): The tracked address.
+        """
+        self.address = address
+        self._topic = "0x" + address[2:].lower().rjust(64, "0")
+        self._load_cursor()
+
+    def on_incoming(self, callback):
+        """
+        Registers a callback invoked for every incoming transfer, once its block range is applied to the balance.
+        An exception raised by the callback is reported and does not stop the sync.
+
+        Args:
+            callback (Callable): Called (or awaited, if it is a coroutine function) with the amount received and
+                the sender's address.
+        """
+        self._listeners.append(callback)
+
+    async def sync(self) -> int:
+        """
+        Brings the balance up to the latest block.
+
+        Returns:
+            int: The balance in the smallest unit.
+        """
+        latest = await self.helper.latest_block()
+        if self.balance is None or latest - self.reconciled_at >= self.reconcile_every:
+            await self.reconcile(latest)
+            return self.balance
+        while self.block < latest:
+            start = self.block + 1
+            end = min(latest, self.block + self.chunk_size)
+            await self._apply_range(start, end)
+        self._save_cursor()
+        return self.balance
+
+    async def reconcile(self, block: int):
+        """
+        Replaces the tracked balance with a full `balanceOf` read.
+
+        Args:
+            block (int): The block the balance is read at.
+        """
+        self.balance = await self.helper.call(
+            self.helper.contract.functions.balanceOf(self.address).call(block_identifier=block)
+        )
+        self.block = self.reconciled_at = block
+        self._save_cursor()
+
+    async def _apply_range(self, start: int, end: int):
+        log_filter = {"fromBlock": hex(start), "toBlock": hex(end), "address": self.helper.contract.address}
+        incoming, outgoing = await self.helper.call(self.helper.provider.make_batch_request([
+            ("eth_getLogs", [{**log_filter, "topics": [TRANSFER_TOPIC, None, self._topic]}]),
+            ("eth_getLogs", [{**log_filter, "topics": [TRANSFER_TOPIC, self._topic]}]),
+        ]))
+        for response in (incoming, outgoing):
+            if "error" in response:
+                raise RuntimeError(f"eth_getLogs failed: {response['error']}")
+        received = [(int(log["data"], 16), "0x" + log["topics"][1][-40:]) for log in incoming["result"]]
+        self.balance += sum(amount for amount, _ in received)
+        self.balance -= sum(int(log["data"], 16) for log in outgoing["result"])
+        # Applied before the listeners run, so a failing listener cannot get the range applied twice
+        self.block = end
+        for amount, sender in received:
+            for callback in self._listeners:
+                try:
+                    result = callback(amount, sender)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception as e:
+                    print(f"Error in incoming transfer listener for {amount} from {sender}: {e}")
+
+    def _load_cursor(self):
+        if not self.cursor_path or not os.path.exists(self.cursor_path):
+            return
+        with open(self.cursor_path) as cursor_file:
+            cursor = json.load(cursor_file)
+        if cursor.get("address", "").lower() == self.address.lower():
+            self.balance = cursor["balance"]
+            self.block = cursor["block"]
+            self.reconciled_at = cursor["reconciled_at"]
+
+    def _save_cursor(self):
+        if not self.cursor_path:
+            return
+        cursor = {"address": self.address, "balance": self.balance, "block": self.block,
+                  "reconciled_at": self.reconciled_at}
+        tmp_path = f"{self.cursor_path}.tmp"
+        with open(tmp_path, "w") as cursor_file:
+            json.dump(cursor, cursor_file)
+        os.replace(tmp_path, self.cursor_path)
@@ -0,0 +1,223 @@
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def parse_level(name: str) -> int:
+    """
+    Converts a level name to its level.
+
+    Args:
+        name (str): One of "debug", "info", "warning" and "error", in any case.
+
+    Returns:
+        int: The level.
+
+    Raises:
+        ValueError: If the name is unknown.
+    """
+    level = LEVELS.get(name.lower())
+    if level is None:
+        raise ValueError(f"Unknown log level {name}, expected one of {', '.join(LEVELS)}")
+    return level
+
+
+def get_writer():
+    """
+    Returns the log writer of the process, created on first use from `LOG_FORMAT` and `LOG_BUFFER`.
+
+    Returns:
+        LogWriter: The writer.
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = LogWriter(int(os.getenv("LOG_BUFFER", 10000)), os.getenv("LOG_FORMAT", "text") == "json")
+    return _writer
+
+
+def flush_logs():
+    """
+    Writes the buffered records of the process, if any, before it exits.
+    """
+    if _writer is not None:
+        _writer.flush()
+    sys.stdout.flush()
+
+
+class LogWriter:
+    """
+    Writes log records to standard output in batches, from a background thread, so that logging does not block
+    the event loop on stdout.
+
+    Records are formatted by the logging thread and appended to a bounded buffer, which the writer thread swaps
+    out and writes in one call whenever it is woken. Records arriving while the buffer is full are dropped and
+    counted, and the count is reported in the output. The timestamp is formatted once per second. The buffer is
+    flushed at exit, and a forked child starts with an empty buffer and its own writer thread.
+
+    Attributes:
+        capacity (int): The maximum number of buffered records.
+        json_lines (bool): Whether records are written as JSON objects, one per line, instead of text.
+        dropped (int): The number of records dropped because the buffer was full.
+    """
+
+    def __init__(self, capacity: int = 10000, json_lines: bool = False):
+        """
+        Args:
+            capacity (int, optional): The maximum number of buffered records. Defaults to 10000.
+            json_lines (bool, optional): Whether to write JSON lines. Defaults to False.
+        """
+        self.capacity = capacity
+        self.json_lines = json_lines
+        self.dropped = 0
+        self._second = None
+        self._timestamp = None
+        self._reset()
+        atexit.register(self.flush)
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._records = []
+        self._lock = threading.Lock()
+        self._output_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def timestamp(self) -> str:
+        """
+        Returns the current local time in ISO format, to the second.
+        """
+        second = int(time.time())
+        if second != self._second:
+            self._timestamp = datetime.fromtimestamp(second).isoformat()
+            self._second = second
+        return self._timestamp
+
+    def format(self, level: int, source: str, message: str, fields: dict) -> str:
+        """
+        Formats a record as a line of output.
+
+        Args:
+            level (int): The level of the record.
+            source (str): The component the record comes from.
+            message (str): The message.
+            fields (dict): Additional structured fields.
+
+        Returns:
+            str: The line, including the line break.
+        """
+        if self.json_lines:
+            record = {"time": self.timestamp(), "level": LEVEL_NAMES.get(level, level), "source": source,
+                      "message": message, **fields}
+            return json.dumps(record, default=str) + "\n"
+        if fields:
+            message = f"{message} " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return f"{source} [{self.timestamp()}]: {message}\n"
+
+    def write(self, line: str):
+        """
+        Buffers a formatted line for the writer thread.
+
+        Args:
+            line (str): The line, including the line break.
+        """
+        with self._lock:
+            if len(self._records) >= self.capacity:
+                self.dropped += 1
+                return
+            self._records.append(line)
+            wake = len(self._records) == 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+        if wake:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the buffered records right away.
+        """
+        with self._output_lock:
+            with self._lock:
+                records, self._records = self._records, []
+                dropped, self.dropped = self.dropped, 0
+            if dropped:
+                records.append(self.format(WARNING, "logger", f"Dropped {dropped} log records", {}))
+            if records:
+                sys.stdout.write("".join(records))
+                sys.stdout.flush()
+
+
+class Logger:
+    """
+    Logs the records of one component at or above a minimum level.
+
+    Records below the level are discarded before their message is formatted, so messages should pass their
+    arguments separately, `%` style: `logger.debug("Received message: %s", message.fields())`.
+
+    Attributes:
+        source (str): The component the records come from, written before each message.
+        level (int): The minimum level of the records, `LOG_LEVEL` by default.
+    """
+
+    def __init__(self, source: str, level: int = None):
+        """
+        Args:
+            source (str): The component the records come from.
+            level (int, optional): The minimum level. Defaults to the `LOG_LEVEL` environment variable, or info.
+        """
+        self.source = source
+        self.level = level if level is not None else parse_level(os.getenv("LOG_LEVEL", "info"))
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def log(self, level: int, message: str, *args, **fields):
+        """
+        Logs a record.
+
+        Args:
+            level (int): The level of the record.
+            message (str): The message, formatted with `args` when there are any.
+            *args: The arguments of the message.
+            **fields: Additional structured fields, written as `key=value` or as JSON keys.
+        """
+        if level < self.level:
+            return
+        if args:
+            message = message % args
+        writer = get_writer()
+        writer.write(writer.format(level, self.source, message, fields))
+
+    def debug(self, message: str, *args, **fields):
+        self.log(DEBUG, message, *args, **fields)
+
+    def info(self, message: str, *args, **fields):
+        self.log(INFO, message, *args, **fields)
+
+    def warning(self, message: str, *args, **fields):
+        self.log(WARNING, message, *args, **fields)
+
+    def error(self, message: str, *args, **fields):
+        self.log(ERROR, message, *args, **fields)
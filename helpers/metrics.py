@@ -0,0 +1,279 @@
+import asyncio
+import json
+
+# Histogram resolution: every power of two is split into 2 ** SUB_BUCKET_BITS buckets (about 6% relative error)
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Durations are recorded in nanoseconds, up to 2 ** MAX_BITS (about 18 minutes)
+MAX_BITS = 40
+LAST_BUCKET = (MAX_BITS - SUB_BUCKET_BITS + 2) * SUB_BUCKETS - 1
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    """
+    A monotonically increasing count.
+    """
+
+    __slots__ = ("value",)
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: int = 1):
+        self.value += amount
+
+    def samples(self, name: str, labels: dict) -> list:
+        return [(name, labels, self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """
+    A value that goes up and down, either set by the code or read from `function` when collected.
+    """
+
+    __slots__ = ("value", "function")
+    kind = "gauge"
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+    def samples(self, name: str, labels: dict) -> list:
+        return [(name, labels, self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    """
+    An HDR-style histogram of durations, recorded in nanoseconds into log-linear buckets.
+
+    Recording is a few integer operations and a list increment, without allocation. Each power of two is split
+    into `SUB_BUCKETS` linear buckets, so quantiles are accurate to about 6% over the whole range, from
+    nanoseconds to minutes. The histogram is exposed as a Prometheus summary of `QUANTILES`, in seconds.
+
+    Attributes:
+        count (int): The number of recorded durations.
+        total (int): The sum of the recorded durations, in nanoseconds.
+        max (int): The longest recorded duration, in nanoseconds.
+    """
+
+    __slots__ = ("counts", "count", "total", "max")
+    kind = "summary"
+
+    def __init__(self):
+        self.counts = [0] * (LAST_BUCKET + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, nanoseconds: int):
+        """
+        Records a duration.
+
+        Args:
+            nanoseconds (int): The duration, typically a difference of `time.perf_counter_ns()` readings.
+        """
+        if nanoseconds >= SUB_BUCKETS:
+            shift = nanoseconds.bit_length() - SUB_BUCKET_BITS - 1
+            index = ((shift + 1) << SUB_BUCKET_BITS) + (nanoseconds >> shift) - SUB_BUCKETS
+            if index > LAST_BUCKET:
+                index = LAST_BUCKET
+        else:
+            index = nanoseconds if nanoseconds > 0 else 0
+        self.counts[index] += 1
+        self.count += 1
+        self.total += nanoseconds
+        if nanoseconds > self.max:
+            self.max = nanoseconds
+
+    @staticmethod
+    def _upper_bound(index: int) -> int:
+        if index < SUB_BUCKETS:
+            return index
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        return ((index & (SUB_BUCKETS - 1)) + SUB_BUCKETS + 1) << shift
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns a quantile of the recorded durations.
+
+        Args:
+            q (float): The quantile, between 0 and 1.
+
+        Returns:
+            float: The upper bound of the bucket holding the quantile, in seconds, capped at the maximum.
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self._upper_bound(index), self.max) / 1e9
+        return self.max / 1e9
+
+    def samples(self, name: str, labels: dict) -> list:
+        samples = [(name, {**labels, "quantile": str(q)}, self.quantile(q)) for q in QUANTILES]
+        samples.append((f"{name}_sum", labels, self.total / 1e9))
+        samples.append((f"{name}_count", labels, self.count))
+        return samples
+
+    def snapshot(self) -> dict:
+        return {"count": self.count, "max": self.max / 1e9,
+                **{f"p{str(q * 100).rstrip('0').rstrip('.')}": self.quantile(q) for q in QUANTILES}}
+
+
+class MetricsRegistry:
+    """
+    The metrics of an agent process, by name and labels.
+
+    Instrumented code asks the registry for its metrics once, keeps them, and updates them directly on the hot
+    path, so an update costs an attribute access rather than a lookup. Gauges may instead read their value from
+    a function when collected, which keeps queue depths off the hot path entirely.
+
+    Attributes:
+        help (dict): The help text of each metric name.
+    """
+
+    def __init__(self):
+        self.help = {}
+        self._metrics = {}
+
+    def _get(self, cls, name: str, help: str, labels: dict, *args):
+        key = (name, tuple(labels.items()))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = self._metrics[key] = cls(*args)
+            if help:
+                self.help.setdefault(name, help)
+        return metric
+
+    def counter(self, name: str, help: str = "", **labels) -> Counter:
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name: str, help: str = "", function=None, **labels) -> Gauge:
+        gauge = self._get(Gauge, name, help, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, help: str = "", **labels) -> Histogram:
+        return self._get(Histogram, name, help, labels)
+
+    def unregister(self, name: str, **labels):
+        """
+        Removes a metric, for example the gauges of a peer that is gone.
+        """
+        self._metrics.pop((name, tuple(labels.items())), None)
+
+    def render(self) -> str:
+        """
+        Renders every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: The exposition.
+        """
+        lines = []
+        described = set()
+        for (name, labels), metric in sorted(self._metrics.items(), key=lambda item: item[0]):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append(f"# HELP {name} {self.help[name]}")
+                lines.append(f"# TYPE {name} {metric.kind}")
+            try:
+                samples = metric.samples(name, dict(labels))
+            except Exception:
+                continue
+            for sample, sample_labels, value in samples:
+                lines.append(f"{sample}{_labels(sample_labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """
+        Returns the current value of every metric.
+
+        Returns:
+            dict: The values, by metric name followed by its labels.
+        """
+        snapshot = {}
+        for (name, labels), metric in self._metrics.items():
+            try:
+                snapshot[name + _labels(dict(labels))] = metric.snapshot()
+            except Exception:
+                continue
+        return snapshot
+
+    async def serve(self, host: str, port: int):
+        """
+        Serves `GET /metrics` in the Prometheus format and `GET /snapshot` as JSON.
+
+        Args:
+            host (str): The address to listen on.
+            port (int): The port to listen on.
+
+        Returns:
+            Server: The listening server.
+        """
+        return await asyncio.start_server(self._handle_scrape, host, port)
+
+    async def _handle_scrape(self, reader, writer):
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b"/"
+            if path.startswith(b"/snapshot"):
+                status, content_type, body = "200 OK", "application/json", json.dumps(self.snapshot())
+            elif path.startswith(b"/metrics") or path == b"/":
+                status, content_type, body = "200 OK", "text/plain; version=0.0.4", self.render()
+            else:
+                status, content_type, body = "404 Not Found", "text/plain", "Not found\n"
+            body = body.encode("utf-8")
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                         f"Connection: close\r\n\r\n".encode("ascii") + body)
+            await writer.drain()
+        except Exception:
+            pass
+        finally:
+            writer.close()
+
+    async def dump(self, logger, interval: float):
+        """
+        Logs a snapshot of every metric every `interval` seconds, forever.
+
+        Args:
+            logger (Logger): The logger to write the snapshots to.
+            interval (float): The time between two snapshots, in seconds.
+        """
+        while True:
+            await asyncio.sleep(interval)
+            logger.info("Metrics snapshot %s", json.dumps(self.snapshot()))
+
+
+metrics = MetricsRegistry()
+
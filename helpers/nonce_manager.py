@@ -0,0 +1,90 @@
+import asyncio
+
+NONCE_ERRORS = ("nonce too low", "nonce too high", "invalid nonce", "already known",
+                "replacement transaction underpriced", "known transaction")
+
+
+def is_nonce_error(error: Exception) -> bool:
+    """
+    Tells whether a transaction submission failed because of its nonce.
+
+    Args:
+        error (Exception): The error raised by the node.
+
+    Returns:
+        bool: True if the node rejected the transaction's nonce.
+    """
+    message = str(error).lower()
+    return any(reason in message for reason in NONCE_ERRORS)
+
+
+class NonceManager:
+    """
+    Hands out transaction nonces from a local counter so that concurrent transactions get distinct nonces
+    without asking the node for every transaction.
+
+    The counter is synchronised with the node's pending transaction count on startup and whenever the node rejects
+    a nonce. A submission failing for another reason, such as a timeout or a rate limit, releases its nonces
+    instead: they are handed out again first, which closes the gap without winding the counter back over the
+    nonces other callers still have in flight.
+
+    Attributes:
+        fetch (Callable): A coroutine function returning the account's pending transaction count.
+    """
+
+    def __init__(self, fetch):
+        """
+        Initializes the NonceManager, the first nonce is fetched lazily.
+
+        Args:
+            fetch (Callable): A coroutine function returning the account's pending transaction count.
+        """
+        self.fetch = fetch
+        self._next = None
+        self._released = []
+        self._lock = asyncio.Lock()
+
+    async def sync(self):
+        """
+        Resets the local counter to the node's pending transaction count.
+        """
+        async with self._lock:
+            self._next = await self.fetch()
+            self._released.clear()
+
+    async def next(self) -> int:
+        """
+        Reserves the next nonce.
+
+        Returns:
+            int: A nonce no other caller has been given since the last sync.
+        """
+        return (await self.reserve(1))[0]
+
+    async def reserve(self, count: int) -> list:
+        """
+        Reserves a block of nonces, released ones first and then consecutive ones from the counter.
+
+        Args:
+            count (int): The number of nonces to reserve.
+
+        Returns:
+            list: Nonces no other caller holds, in increasing order.
+        """
+        async with self._lock:
+            if self._next is None:
+                self._next = await self.fetch()
+            nonces, self._released = self._released[:count], self._released[count:]
+            fresh = count - len(nonces)
+            nonces.extend(range(self._next, self._next + fresh))
+            self._next += fresh
+            return nonces
+
+    def release(self, nonces):
+        """
+        Gives back nonces that were reserved but not used, to be handed out again before new ones.
+
+        Args:
+            nonces (Iterable): The unused nonces.
+        """
+        self._released = sorted(set(self._released).union(nonce for nonce in nonces if nonce < self._next))
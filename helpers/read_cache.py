@@ -0,0 +1,109 @@
+import asyncio
+
+from helpers.metrics import metrics
+
+
+class ReadCache:
+    """
+    A read-through cache for contract view calls.
+
+    Values are keyed by (contract, function, args) plus the block they were read at. Immutable values such as
+    `decimals` are pinned for the lifetime of the process; mutable values such as `balanceOf` are dropped when a
+    new block is observed or when `invalidate` is called, e.g. after this agent sends a transfer. Concurrent reads
+    of the same key share a single in-flight request.
+
+    Attributes:
+        block (int): The latest block observed, mutable values are only served for this block.
+        hits (Counter): Reads served from the cache, `agent_read_cache_total{result="hit"}`.
+        misses (Counter): Reads that went to the node, `agent_read_cache_total{result="miss"}`.
+        coalesced (Counter): Reads that joined an identical read already in flight,
+            `agent_read_cache_total{result="coalesced"}`.
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty cache.
+        """
+        self.block = None
+        self.hits = metrics.counter("agent_read_cache_total", "Contract reads by cache outcome", result="hit")
+        self.misses = metrics.counter("agent_read_cache_total", result="miss")
+        self.coalesced = metrics.counter("agent_read_cache_total", result="coalesced")
+        self._pinned = {}
+        self._values = {}
+        self._inflight = {}
+        self._generation = 0
+        metrics.gauge("agent_read_cache_size", "Contract reads cached",
+                      lambda: len(self._values) + len(self._pinned))
+
+    def set_block(self, number: int):
+        """
+        Records the latest block, dropping mutable values read at older blocks.
+
+        Args:
+            number (int): The latest block number.
+        """
+        if number != self.block:
+            self.block = number
+            self.invalidate()
+
+    def invalidate(self):
+        """
+        Drops every mutable value, including the results of reads still in flight.
+        """
+        self._values.clear()
+        self._generation += 1
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: Hits, misses, coalesced reads and the number of cached values.
+        """
+        return {
+            "hits": self.hits.value,
+            "misses": self.misses.value,
+            "coalesced": self.coalesced.value,
+            "size": len(self._values) + len(self._pinned),
+        }
+
+    async def get(self, key: tuple, fetch, pinned: bool = False):
+        """
+        Returns a cached value, fetching it if needed.
+
+        Args:
+            key (tuple): (contract address, function name, args) identifying the read.
+            fetch (Callable): A coroutine function performing the read on a miss.
+            pinned (bool, optional): True for values that never change. Defaults to False.
+
+        Returns:
+            Any: The value of the read.
+        """
+        store = self._pinned if pinned else self._values
+        key = key if pinned else key + (self.block,)
+        if key in store:
+            self.hits.inc()
+            return store[key]
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced.inc()
+            return await asyncio.shield(inflight)
+        self.misses.inc()
+        generation = self._generation
+        result = asyncio.get_running_loop().create_future()
+        self._inflight[key] = result
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            result.cancel()
+            raise
+        except Exception as e:
+            result.set_exception(e)
+            result.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        if pinned or generation == self._generation:
+            store[key] = value
+        result.set_result(value)
+        return value
@@ -0,0 +1,255 @@
+import asyncio
+import os
+import time
+
+from helpers.metrics import metrics
+from helpers.nonce_manager import is_nonce_error
+from helpers.transfer_ledger import STATE_CONFIRMED, STATE_FAILED, STATE_REVERTED, STATE_SENT
+
+# Blocks a mined nonce may go without a receipt for any of its transactions before they count as dropped
+DROP_BLOCKS = 3
+OUTCOMES = {STATE_CONFIRMED: "confirmed", STATE_REVERTED: "reverted", STATE_FAILED: "dropped", STATE_SENT: "timeout"}
+
+
+class _PendingTransaction:
+    """
+    A transfer waiting for its receipt, with every transaction hash submitted for its nonce.
+    """
+
+    def __init__(self, nonce: int, to_address: str, amount: int, gas_price: int, tx_hash: str, future):
+        self.nonce = nonce
+        self.to_address = to_address
+        self.amount = amount
+        self.gas_price = gas_price
+        self.tx_hashes = [tx_hash]
+        self.future = future
+        self.submitted_block = None
+        self.submitted_at = time.monotonic()
+        self.replacements = 0
+        self.receipt = None
+        self.missing = 0
+
+
+class ReceiptTracker:
+    """
+    Follows the transfers sent by the account until they are confirmed, reverted or dropped, checking them all
+    together once per block.
+
+    Transfers are kept in a table by nonce. On every new block, a single `eth_getTransactionCount` at the latest
+    block tells which nonces were mined, and the receipts of the newly mined transfers only are fetched in one
+    JSON-RPC batch (`batch_size` receipts per request). A receipt is fetched once more when its transfer reaches
+    `confirmations` blocks, to catch a reorg. Transfers still waiting are therefore free to track, and the RPC
+    cost per block stays flat however many are in flight.
+
+    A transfer not mined after `replace_blocks` blocks is replaced: signed again with the same nonce, recipient
+    and amount at a gas price raised by `gas_bump`, and at least the node's current price, up to
+    `max_replacements` times. Whichever of its transactions is mined settles it. A transfer whose nonce was mined
+    without any of its transactions is dropped. One still waiting after `timeout_blocks` blocks is no longer
+    followed.
+
+    Attributes:
+        helper (SAContractHelper): The contract helper used for chain access.
+        confirmations (int): The blocks a transfer must be buried under, its own included, to be confirmed
+            (`RECEIPT_CONFIRMATIONS`).
+        replace_blocks (int): The blocks a transfer waits before each replacement (`RECEIPT_REPLACE_BLOCKS`).
+        max_replacements (int): The maximum replacements of a transfer (`RECEIPT_MAX_REPLACEMENTS`).
+        gas_bump (float): The factor a replacement raises the gas price by (`RECEIPT_GAS_BUMP`).
+        timeout_blocks (int): The blocks after which an unmined transfer is given up (`RECEIPT_TIMEOUT_BLOCKS`).
+        batch_size (int): The maximum receipts fetched per batch request (`RECEIPT_BATCH_SIZE`).
+        block (int): The last block checked.
+    """
+
+    def __init__(self, helper, confirmations: int = None, replace_blocks: int = None, max_replacements: int = None,
+                 gas_bump: float = None, timeout_blocks: int = None, batch_size: int = None):
+        """
+        Initializes an empty ReceiptTracker.
+
+        Args:
+            helper (SAContractHelper): The contract helper used for chain access.
+            confirmations (int, optional): Defaults to `RECEIPT_CONFIRMATIONS`, or 1.
+            replace_blocks (int, optional): Defaults to `RECEIPT_REPLACE_BLOCKS`, or 20.
+            max_replacements (int, optional): Defaults to `RECEIPT_MAX_REPLACEMENTS`, or 3.
+            gas_bump (float, optional): Defaults to `RECEIPT_GAS_BUMP`, or 1.125.
+            timeout_blocks (int, optional): Defaults to `RECEIPT_TIMEOUT_BLOCKS`, or 100.
+            batch_size (int, optional): Defaults to `RECEIPT_BATCH_SIZE`, or 100.
+        """
+        self.helper = helper
+        self.confirmations = confirmations or int(os.getenv("RECEIPT_CONFIRMATIONS", 1))
+        self.replace_blocks = replace_blocks or int(os.getenv("RECEIPT_REPLACE_BLOCKS", 20))
+        self.max_replacements = (max_replacements if max_replacements is not None
+                                 else int(os.getenv("RECEIPT_MAX_REPLACEMENTS", 3)))
+        self.gas_bump = gas_bump or float(os.getenv("RECEIPT_GAS_BUMP", 1.125))
+        self.timeout_blocks = timeout_blocks or int(os.getenv("RECEIPT_TIMEOUT_BLOCKS", 100))
+        self.batch_size = batch_size or int(os.getenv("RECEIPT_BATCH_SIZE", 100))
+        self.block = None
+        self._pending = {}
+        self._by_hash = {}
+        self._task = None
+        self.replaced = metrics.counter("agent_transfer_replacements_total", "Stuck transfers signed again")
+        self.latency = metrics.histogram("agent_transfer_confirmation_seconds",
+                                         "Time from submitting a transfer to its confirmation")
+        metrics.gauge("agent_transfers_pending", "Transfers waiting for their receipt", lambda: len(self._pending))
+
+    def track(self, tx_hash: str, nonce: int, to_address: str, amount: int, gas_price: int) -> asyncio.Future:
+        """
+        Starts following a submitted transfer.
+
+        Args:
+            tx_hash (str): The transaction hash, as a hexadecimal string.
+            nonce (int): The nonce of the transaction.
+            to_address (str): The recipient's Ethereum address, to sign replacements.
+            amount (int): The amount of tokens sent, in the smallest unit.
+            gas_price (int): The gas price of the transaction, in wei.
+
+        Returns:
+            Future: Resolved with the outcome of the transfer, see `watch`.
+        """
+        existing = self._pending.get(nonce)
+        if existing is not None and not existing.future.done():
+            # The nonce was handed out again after a resync, the earlier transfer can no longer be mined
+            self._settle(existing, STATE_FAILED)
+        future = asyncio.get_running_loop().create_future()
+        entry = _PendingTransaction(nonce, to_address, amount, gas_price, tx_hash, future)
+        entry.submitted_block = self.block
+        self._pending[nonce] = entry
+        self._by_hash[tx_hash] = entry
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+        return future
+
+    def watch(self, tx_hash: str) -> asyncio.Future:
+        """
+        Returns the future of a tracked transfer, for callers to await or add callbacks to.
+
+        The future resolves with a (state, transaction hash) tuple: `STATE_CONFIRMED` or `STATE_REVERTED` with
+        the hash of the mined transaction, which differs from `tx_hash` if a replacement was mined,
+        `STATE_FAILED` if the transfer was dropped, or `STATE_SENT` if it was given up with its outcome unknown.
+
+        Args:
+            tx_hash (str): The hash the transfer was submitted with, or of one of its replacements.
+
+        Returns:
+            Future: The outcome of the transfer.
+            None: If the transaction is not tracked by this process.
+        """
+        entry = self._by_hash.get(tx_hash)
+        return entry.future if entry is not None else None
+
+    async def run(self):
+        """
+        Checks the tracked transfers on every new block, until none is left.
+        """
+        while self._pending:
+            try:
+                block = await self.helper.latest_block()
+                if self.block is None or block > self.block:
+                    await self.check(block)
+            except Exception as e:
+                print(f"Error checking transfer receipts: {e}")
+            if self._pending:
+                await asyncio.sleep(self.helper.block_interval)
+
+    def close(self):
+        """
+        Stops following the transfers, cancelling their futures. Their ledger keys stay recorded as sent.
+        """
+        if self._task is not None:
+            self._task.cancel()
+        for entry in self._pending.values():
+            entry.future.cancel()
+        self._pending.clear()
+        self._by_hash.clear()
+
+    async def check(self, block: int):
+        """
+        Settles the transfers mined or confirmed by a block and replaces the stuck ones.
+
+        Args:
+            block (int): The latest block number.
+        """
+        self.block = block
+        for entry in self._pending.values():
+            if entry.submitted_block is None:
+                entry.submitted_block = block
+        mined_count = await self.helper.call(
+            self.helper.web3.eth.get_transaction_count(self.helper.account.address, "latest"))
+        lookups = []
+        for entry in self._pending.values():
+            if entry.nonce >= mined_count:
+                continue
+            if entry.receipt is None:
+                lookups.extend((entry, tx_hash) for tx_hash in entry.tx_hashes)
+            elif block - int(entry.receipt["blockNumber"], 16) + 1 >= self.confirmations:
+                lookups.append((entry, entry.receipt["transactionHash"]))
+        receipts = await self._fetch_receipts([tx_hash for _, tx_hash in lookups]) if lookups else []
+
+        found = {}
+        for (entry, _), receipt in zip(lookups, receipts):
+            found.setdefault(entry.nonce, [entry, None])
+            if receipt is not None:
+                found[entry.nonce][1] = receipt
+        for entry, receipt in found.values():
+            if receipt is None:
+                entry.receipt = None
+                entry.missing += 1
+                if entry.missing >= DROP_BLOCKS:
+                    self._settle(entry, STATE_FAILED)
+                continue
+            if entry.receipt is not None and receipt.get("blockHash") != entry.receipt.get("blockHash"):
+                # Reorganised into another block, confirmations start over
+                entry.receipt = receipt
+                continue
+            entry.receipt, entry.missing = receipt, 0
+            if block - int(receipt["blockNumber"], 16) + 1 >= self.confirmations:
+                self._settle(entry, STATE_CONFIRMED if int(receipt.get("status", "0x1"), 16) else STATE_REVERTED)
+
+        for entry in list(self._pending.values()):
+            if entry.nonce < mined_count:
+                continue
+            waited = block - entry.submitted_block
+            if waited >= self.timeout_blocks:
+                self._settle(entry, STATE_SENT)
+            elif entry.replacements < self.max_replacements and waited >= self.replace_blocks * (entry.replacements + 1):
+                await self._replace(entry)
+
+    async def _fetch_receipts(self, tx_hashes: list) -> list:
+        chunks = [tx_hashes[start:start + self.batch_size] for start in range(0, len(tx_hashes), self.batch_size)]
+        responses = await asyncio.gather(*(
+            self.helper.call(self.helper.provider.make_batch_request(
+                [("eth_getTransactionReceipt", [tx_hash]) for tx_hash in chunk]))
+            for chunk in chunks
+        ))
+        return [response.get("result") for chunk in responses for response in chunk]
+
+    async def _replace(self, entry: _PendingTransaction):
+        entry.replacements += 1
+        try:
+            market = await self.helper.call(self.helper.web3.eth.gas_price)
+            gas_price = max(int(entry.gas_price * self.gas_bump), market)
+            raw_tx = self.helper.sign_transfer(entry.to_address, entry.amount, entry.nonce, gas_price)
+            tx_hash = self.helper.web3.to_hex(await self.helper.call(self.helper.web3.eth.send_raw_transaction(raw_tx)))
+        except Exception as e:
+            if not is_nonce_error(e):
+                print(f"Error replacing transfer with nonce {entry.nonce}: {e}")
+            return
+        # Later transfers would get stuck at the old price as well
+        self.helper.gas_price = max(self.helper.gas_price, market)
+        entry.gas_price = gas_price
+        entry.tx_hashes.append(tx_hash)
+        self._by_hash[tx_hash] = entry
+        self.replaced.inc()
+        print(f"Replaced stuck transfer with nonce {entry.nonce} by {tx_hash} at {gas_price} wei per gas")
+
+    def _settle(self, entry: _PendingTransaction, state: int):
+        del self._pending[entry.nonce]
+        for tx_hash in entry.tx_hashes:
+            self._by_hash.pop(tx_hash, None)
+        tx_hash = entry.receipt["transactionHash"] if entry.receipt is not None else entry.tx_hashes[-1]
+        metrics.counter("agent_transfer_receipts_total", "Transfers settled by outcome", result=OUTCOMES[state]).inc()
+        if state == STATE_CONFIRMED:
+            self.latency.record(int((time.monotonic() - entry.submitted_at) * 1e9))
+        else:
+            print(f"Transfer of {entry.amount} to {entry.to_address} with nonce {entry.nonce} {OUTCOMES[state]}: "
+                  f"{tx_hash}")
+        if not entry.future.done():
+            entry.future.set_result((state, tx_hash))
@@ -0,0 +1,291 @@
+import asyncio
+import os
+import time
+from urllib.parse import urlsplit
+
+from aiohttp import ClientConnectionError, ClientConnectorError, ClientResponseError, ClientTimeout
+from web3.providers.async_base import AsyncJSONBaseProvider
+from web3.providers.rpc import AsyncHTTPProvider
+
+from helpers.metrics import metrics
+
+# Calls that change the chain: they are served first from the budget and only retried on another endpoint when
+# the first one certainly did not receive them
+WRITE_METHODS = frozenset(("eth_sendRawTransaction", "eth_sendTransaction"))
+# HTTP statuses telling that the endpoint refused the call without processing it
+REFUSED_STATUSES = frozenset((429, 503))
+# JSON-RPC error code and messages of providers rejecting a call over their rate limit
+LIMIT_ERROR_CODE = -32005
+LIMIT_ERRORS = ("rate limit", "limit exceeded", "too many requests", "exceeded the quota")
+# Weight of the latest sample in the moving average of an endpoint's latency, and the latency assumed before it
+EWMA_ALPHA = 0.2
+INITIAL_LATENCY = 0.1
+
+
+class EndpointRefused(Exception):
+    """
+    Raised when an endpoint answers a call with a rate limit error.
+    """
+
+
+def parse_endpoints(spec: str) -> list:
+    """
+    Parses a list of RPC endpoints.
+
+    Args:
+        spec (str): Comma separated `url|weight|rate` entries, the weight (default 1) and rate limit in calls per
+            second (default 0, unlimited) being optional, e.g. "https://a.example/key|3|25,https://b.example".
+
+    Returns:
+        list: (url, weight, rate) tuples.
+    """
+    endpoints = []
+    for entry in (spec or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        url, *options = entry.split("|")
+        weight = float(options[0]) if len(options) > 0 and options[0] else 1.0
+        rate = float(options[1]) if len(options) > 1 and options[1] else 0.0
+        endpoints.append((url.strip(), weight, rate))
+    return endpoints
+
+
+def is_limit_error(response: dict) -> bool:
+    """
+    Tells whether a JSON-RPC response is a provider refusing the call over its rate limit or quota.
+    """
+    error = response.get("error") if isinstance(response, dict) else None
+    if not isinstance(error, dict):
+        return False
+    message = str(error.get("message", "")).lower()
+    return error.get("code") == LIMIT_ERROR_CODE or any(reason in message for reason in LIMIT_ERRORS)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled at `rate` tokens per second up to `capacity` tokens.
+
+    Attributes:
+        rate (float): The tokens added per second.
+        capacity (float): The maximum number of tokens.
+        tokens (float): The tokens available at the last refill.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._refilled_at = time.monotonic()
+
+    def refill(self) -> float:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        return self.tokens
+
+    def wait_time(self, tokens: float = 1, floor: float = 0) -> float:
+        """
+        Returns the time, in seconds, until `tokens` can be taken while leaving at least `floor` tokens.
+        """
+        missing = min(tokens + floor, self.capacity) - self.refill()
+        return missing / self.rate if missing > 0 else 0.0
+
+    async def acquire(self, tokens: float = 1, floor: float = 0):
+        """
+        Takes `tokens`, waiting until they are available above `floor`.
+
+        Args:
+            tokens (float, optional): The tokens to take. Defaults to 1.
+            floor (float, optional): The tokens that must remain afterwards, reserved for other callers.
+        """
+        while (wait := self.wait_time(tokens, floor)) > 0:
+            await asyncio.sleep(wait)
+        self.tokens -= min(tokens, self.capacity)
+
+
+class Endpoint:
+    """
+    One RPC endpoint of an `EndpointPool`, with its rate limit, load and health.
+
+    Attributes:
+        url (str): The endpoint URL.
+        name (str): The index and host of the endpoint, used as metric label so that keys in URLs stay private.
+        weight (float): The relative share of calls the endpoint takes at equal latency.
+        bucket (TokenBucket): The endpoint's rate limit, None if unlimited.
+        provider (AsyncHTTPProvider): The provider making the HTTP calls.
+        outstanding (int): The number of calls in flight.
+        latency (float): The exponentially weighted moving average of the call latency, in seconds.
+        failures (int): The number of consecutive failed calls.
+        ejected_until (float): The `time.monotonic()` time the endpoint is ejected until.
+    """
+
+    def __init__(self, index: int, url: str, weight: float, rate: float, timeout: float):
+        self.url = url
+        self.name = f"{index}:{urlsplit(url).hostname}"
+        self.weight = weight if weight > 0 else 1.0
+        self.bucket = TokenBucket(rate, max(rate, 1.0)) if rate > 0 else None
+        self.provider = AsyncHTTPProvider(url, request_kwargs={"timeout": ClientTimeout(total=timeout)},
+                                          exception_retry_configuration=None)
+        self.outstanding = 0
+        self.latency = INITIAL_LATENCY
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.calls = metrics.counter("agent_rpc_endpoint_calls_total", "RPC calls by endpoint", endpoint=self.name)
+        self.errors = metrics.counter("agent_rpc_endpoint_errors_total", "Failed RPC calls by endpoint",
+                                      endpoint=self.name)
+        metrics.gauge("agent_rpc_endpoint_latency_seconds", "Moving average of the RPC latency by endpoint",
+                      lambda: self.latency, endpoint=self.name)
+        metrics.gauge("agent_rpc_endpoint_outstanding", "RPC calls in flight by endpoint",
+                      lambda: self.outstanding, endpoint=self.name)
+        metrics.gauge("agent_rpc_endpoint_ejected", "Whether the endpoint is ejected",
+                      lambda: int(self.ejected_until > time.monotonic()), endpoint=self.name)
+
+    def score(self) -> float:
+        """
+        Returns the expected cost of sending a call to the endpoint now: its latency scaled by its load and
+        weight, plus the wait for its rate limit. Lower is better.
+        """
+        wait = self.bucket.wait_time() if self.bucket is not None else 0.0
+        return self.latency * (self.outstanding + 1) / self.weight + wait
+
+
+class EndpointPool(AsyncJSONBaseProvider):
+    """
+    A web3 provider spreading calls over several RPC endpoints, within their rate limits and a global budget.
+
+    Every call goes to the healthy endpoint with the lowest score: its moving average latency scaled by its
+    calls in flight and divided by its weight, plus the wait for its token bucket. An endpoint failing
+    `eject_failures` calls in a row (connection errors, timeouts, HTTP 429/5xx or rate limit errors) is ejected
+    for `eject_time` seconds, and one more failure after it comes back ejects it again. A read that fails on one
+    endpoint is retried on the next one; a write is only retried when the endpoint refused it (connection
+    refused, HTTP 429/503), so that a transaction that may have been received is never sent twice. When every
+    endpoint is ejected, calls go to the one coming back first.
+
+    The global budget allows `budget` calls per minute, counting every call of a batch. Reads leave
+    `write_reserve` of it to writes, so transfers keep going when reads exhaust the budget.
+
+    Attributes:
+        endpoints (list): The endpoints.
+        eject_failures (int): Consecutive failures ejecting an endpoint (`RPC_EJECT_FAILURES`).
+        eject_time (float): Seconds an endpoint stays ejected (`RPC_EJECT_TIME`).
+        budget (TokenBucket): The global per-minute call budget (`RPC_BUDGET_PER_MINUTE`), None if unlimited.
+        write_reserve (float): The share of the budget reserved for writes (`RPC_WRITE_RESERVE`).
+    """
+
+    def __init__(self, endpoints: list, timeout: float, eject_failures: int = None, eject_time: float = None,
+                 budget: int = None, write_reserve: float = None):
+        """
+        Args:
+            endpoints (list): (url, weight, rate) tuples, see `parse_endpoints`.
+            timeout (float): The timeout, in seconds, of an HTTP call.
+            eject_failures (int, optional): Defaults to `RPC_EJECT_FAILURES`, or 3.
+            eject_time (float, optional): Defaults to `RPC_EJECT_TIME`, or 30 seconds.
+            budget (int, optional): Defaults to `RPC_BUDGET_PER_MINUTE`, or 0 for no budget.
+            write_reserve (float, optional): Defaults to `RPC_WRITE_RESERVE`, or 0.1.
+
+        Raises:
+            ValueError: If there is no endpoint.
+        """
+        super().__init__()
+        if not endpoints:
+            raise ValueError("No RPC endpoint configured, set PROVIDER_URL or PROVIDER_URLS")
+        self.endpoints = [Endpoint(index, url, weight, rate, timeout)
+                          for index, (url, weight, rate) in enumerate(endpoints)]
+        self.eject_failures = eject_failures or int(os.getenv("RPC_EJECT_FAILURES", 3))
+        self.eject_time = eject_time if eject_time is not None else float(os.getenv("RPC_EJECT_TIME", 30))
+        budget = budget if budget is not None else int(os.getenv("RPC_BUDGET_PER_MINUTE", 0))
+        self.budget = TokenBucket(budget / 60, budget) if budget else None
+        self.write_reserve = write_reserve if write_reserve is not None else float(os.getenv("RPC_WRITE_RESERVE", 0.1))
+        if self.budget is not None:
+            metrics.gauge("agent_rpc_budget_remaining", "Calls left in the RPC budget", self.budget.refill)
+
+    def __str__(self) -> str:
+        return f"RPC pool of {', '.join(endpoint.name for endpoint in self.endpoints)}"
+
+    async def cache_async_session(self, session):
+        """
+        Makes every endpoint use the shared keep-alive connection pool.
+        """
+        for endpoint in self.endpoints:
+            await endpoint.provider.cache_async_session(session)
+        return session
+
+    def pick(self, exclude: list = ()) -> Endpoint:
+        """
+        Picks the endpoint for the next call.
+
+        Args:
+            exclude (list, optional): Endpoints already tried for this call.
+
+        Returns:
+            Endpoint: The healthy endpoint with the lowest score, or the endpoint coming back first if none is
+                healthy.
+        """
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in self.endpoints if endpoint not in exclude] or self.endpoints
+        healthy = [endpoint for endpoint in candidates if endpoint.ejected_until <= now]
+        if not healthy:
+            return min(candidates, key=lambda endpoint: endpoint.ejected_until)
+        return min(healthy, key=Endpoint.score)
+
+    async def make_request(self, method, params):
+        return await self._call(method in WRITE_METHODS, 1,
+                                lambda endpoint: endpoint.provider.make_request(method, params))
+
+    async def make_batch_request(self, requests: list) -> list:
+        return await self._call(any(method in WRITE_METHODS for method, _ in requests), len(requests),
+                                lambda endpoint: endpoint.provider.make_batch_request(requests))
+
+    async def is_connected(self, show_traceback: bool = False) -> bool:
+        for endpoint in self.endpoints:
+            if await endpoint.provider.is_connected(show_traceback):
+                return True
+        return False
+
+    async def _call(self, write: bool, calls: int, request):
+        if self.budget is not None:
+            await self.budget.acquire(calls, 0 if write else self.write_reserve * self.budget.capacity)
+        tried = []
+        while True:
+            endpoint = self.pick(tried)
+            tried.append(endpoint)
+            try:
+                return await self._call_endpoint(endpoint, calls, request)
+            except Exception as e:
+                if len(tried) >= len(self.endpoints) or (write and not self._refused(e)):
+                    raise
+
+    async def _call_endpoint(self, endpoint: Endpoint, calls: int, request):
+        if endpoint.bucket is not None:
+            await endpoint.bucket.acquire(calls)
+        endpoint.outstanding += 1
+        endpoint.calls.inc(calls)
+        start = time.monotonic()
+        try:
+            response = await request(endpoint)
+        except (ClientConnectionError, ClientResponseError, asyncio.TimeoutError, OSError) as e:
+            if not isinstance(e, ClientResponseError) or e.status == 429 or e.status >= 500:
+                self._failed(endpoint)
+            raise
+        finally:
+            endpoint.outstanding -= 1
+        responses = response if isinstance(response, list) else [response]
+        if any(is_limit_error(item) for item in responses):
+            self._failed(endpoint)
+            raise EndpointRefused(f"Rate limited by RPC endpoint {endpoint.name}")
+        endpoint.latency += EWMA_ALPHA * (time.monotonic() - start - endpoint.latency)
+        endpoint.failures = 0
+        return response
+
+    def _failed(self, endpoint: Endpoint):
+        endpoint.errors.inc()
+        endpoint.failures += 1
+        if endpoint.failures >= self.eject_failures:
+            endpoint.ejected_until = time.monotonic() + self.eject_time
+
+    @staticmethod
+    def _refused(error: Exception) -> bool:
+        if isinstance(error, ClientResponseError):
+            return error.status in REFUSED_STATUSES
+        return isinstance(error, (ClientConnectorError, EndpointRefused))
@@ -1,82 +1,423 @@
+import asyncio
 import os
+import threading
+import time
+from decimal import Decimal
 
-from eth_account import Account
-from web3 import Web3
-
+from helpers.balance_tracker import BalanceTracker
+from helpers.metrics import metrics
+from helpers.nonce_manager import NonceManager, is_nonce_error
+from helpers.read_cache import ReadCache
+from helpers.receipt_tracker import ReceiptTracker
+from helpers.transfer_batcher import TransferBatcher
+from helpers.transfer_ledger import TransferLedger
 from helpers.utils import erc20_abi
 
+# First four bytes of keccak("transfer(address,uint256)")
+TRANSFER_SELECTOR = bytes.fromhex("a9059cbb")
+# Attributes built by `SAContractHelper.load`, on first use
+CHAIN_ATTRIBUTES = ("provider", "web3", "account", "contract")
+
+
+def encode_transfer(to_address: str, amount: int) -> bytes:
+    """
+    ABI encodes the calldata of an ERC20 `transfer` call without going through the contract object.
+
+    Args:
+        to_address (str): The recipient's Ethereum address.
+        amount (int): The amount of tokens to send, in the smallest unit.
+
+    Returns:
+        bytes: The calldata.
+    """
+    from eth_utils import to_canonical_address
+    return TRANSFER_SELECTOR + to_canonical_address(to_address).rjust(32, b"\0") + amount.to_bytes(32, "big")
+
 
 class SAContractHelper:
     """
     A helper class for interacting with an ERC20 smart contract. This includes functionalities such as sending tokens,
     checking balances, and initializing with blockchain provider details.
 
+    All chain access is asynchronous: calls go through a single `AsyncWeb3` provider backed by a shared keep-alive
+    connection pool, at most `concurrency` calls are in flight at once, and every call is bounded by `timeout`.
+    The provider is an `EndpointPool` balancing the calls over the endpoints of `PROVIDER_URLS`, or over the
+    single `provider_url` when it is unset, within their rate limits and the global RPC budget.
+
+    Transfers are built and signed locally: nonces come from a local `NonceManager`, the chain id and gas price
+    are fetched once on `start`, and the calldata is encoded by hand, so each transfer costs exactly one
+    `eth_sendRawTransaction` round-trip and many transfers can be in flight at once. Their receipts are checked
+    together once per block by a `ReceiptTracker`.
+
+    The chain libraries (`web3`, `eth_account`) are only imported by `load`, which `start` runs in a thread so
+    that the agent's listener comes up without waiting for them. The provider, web3, account and contract
+    attributes are built on first use if `load` has not run yet, and `ready` is set once `start` completes.
+
     Attributes:
-        web3 (Web3): An instance of Web3 for interacting with the blockchain.
+        provider_url (str): The URL of the blockchain provider, used when `PROVIDER_URLS` is unset.
+        provider (EndpointPool): The provider shared by every call.
+        web3 (AsyncWeb3): An instance of AsyncWeb3 for interacting with the blockchain.
         account (Account): The Ethereum account derived from the provided private key.
         private_key (str): The private key used to sign transactions.
-        contract (Contract): An instance of the ERC20 token contract for interaction.
-        decimals (int): The number of decimal places the ERC20 token supports.
+        contract (AsyncContract): An instance of the ERC20 token contract for interaction.
+        concurrency (int): The maximum number of RPC calls in flight at once.
+        timeout (float): The timeout, in seconds, of a single RPC call.
+        nonces (NonceManager): The local nonce counter of the account.
+        chain_id (int): The chain id, fetched on `start`.
+        gas_price (int): The gas price in wei, `GAS_PRICE_GWEI` if set, otherwise fetched on `start`.
+        gas_limit (int): The gas limit of a transfer, `TRANSFER_GAS` or 100000.
+        batcher (TransferBatcher): Coalesces transfer intents into merged, batch submitted transfers.
+        ledger (TransferLedger): The idempotency ledger of the transfers requested by messages.
+        cache (ReadCache): Block-aware cache of contract view calls, invalidated by new blocks and sent transfers.
+        block_interval (float): Minimum time, in seconds, between two `eth_blockNumber` polls (`BLOCK_INTERVAL`).
+        balances (BalanceTracker): The account's balance, kept up to date from its `Transfer` logs.
+        receipts (ReceiptTracker): Follows every submitted transfer until it is confirmed, reverted or dropped,
+            replacing the stuck ones.
+        transfers_sent (Counter): The number of transfers submitted, `agent_transfers_total{result="sent"}`.
+        transfers_failed (Counter): The number of transfers that failed, `agent_transfers_total{result="failed"}`.
+        ready (Event): Set once `start` has loaded the chain libraries and initialised chain access.
     """
 
-    def __init__(self, provider_url: str, private_key: str):
+    def __init__(self, provider_url: str, private_key: str, concurrency: int = None, timeout: float = None):
         """
         Initializes the SAContractHelper with the blockchain provider, ERC20 token details, and account credentials.
 
+        No network call is made and no chain library is imported here, the connection pool is opened by `start`.
+
         Args:
             provider_url (str): The URL of the blockchain provider (e.g., Infura, Alchemy).
             private_key (str): The private key of the Ethereum account.
+            concurrency (int, optional): Maximum concurrent RPC calls. Defaults to `RPC_CONCURRENCY`, or 16.
+            timeout (float, optional): Per call timeout in seconds. Defaults to `RPC_TIMEOUT`, or 10.
         """
-        self.web3 = Web3(Web3.HTTPProvider(provider_url))
-        self.account = Account.from_key(private_key)
+        self.concurrency = concurrency or int(os.getenv("RPC_CONCURRENCY", 16))
+        self.timeout = timeout or float(os.getenv("RPC_TIMEOUT", 10))
+        self.provider_url = provider_url
         self.private_key = private_key
-        self.contract = self.web3.eth.contract(address=os.getenv("ERC20_ADDRESS"), abi=erc20_abi)
-        self.decimals = self.contract.functions.decimals().call()
+        self.token_address = os.getenv("ERC20_ADDRESS")
+        self.nonces = NonceManager(self._fetch_nonce)
+        self.chain_id = None
+        self.gas_price = int(Decimal(os.getenv("GAS_PRICE_GWEI")) * 10 ** 9) if os.getenv("GAS_PRICE_GWEI") else None
+        self.gas_limit = int(os.getenv("TRANSFER_GAS", 100000))
+        self.batcher = TransferBatcher(self)
+        self.ledger = TransferLedger()
+        self.cache = ReadCache()
+        self.block_interval = float(os.getenv("BLOCK_INTERVAL", 2))
+        self._block_checked_at = None
+        self._block_refresh = None
+        self.balances = BalanceTracker(self)
+        self.receipts = ReceiptTracker(self)
+        self.ready = asyncio.Event()
+        self._limiter = asyncio.Semaphore(self.concurrency)
+        self._session = None
+        self._load_lock = threading.Lock()
+        # RPC duration histogram and error counter, by method
+        self._rpc_metrics = {}
+        self.transfers_sent = metrics.counter("agent_transfers_total", "ERC20 transfers by result", result="sent")
+        self.transfers_failed = metrics.counter("agent_transfers_total", result="failed")
+
+    def __getattr__(self, name: str):
+        # Only called for missing attributes: builds the chain objects the first time one of them is used
+        if name not in CHAIN_ATTRIBUTES:
+            raise AttributeError(f"{type(self).__name__!r} object has no attribute {name!r}")
+        self.load()
+        return self.__dict__[name]
+
+    def load(self):
+        """
+        Imports the chain libraries and builds the provider, web3 instance, account and token contract, once.
 
-    def send_token(self, to_address: str, amount: int) -> str:
+        Thread safe: `start` calls it from a worker thread, and an early use of a chain attribute on the event
+        loop waits for that call instead of loading a second time.
+        """
+        with self._load_lock:
+            if "web3" in self.__dict__:
+                return
+            from eth_account import Account
+            from web3 import AsyncWeb3
+
+            from helpers.rpc_pool import EndpointPool, parse_endpoints
+
+            endpoints = parse_endpoints(os.getenv("PROVIDER_URLS")) or parse_endpoints(self.provider_url)
+            self.provider = EndpointPool(endpoints, self.timeout)
+            self.account = Account.from_key(self.private_key)
+            self.balances.track(self.account.address)
+            web3 = AsyncWeb3(self.provider)
+            # Transactions are signed locally with the chain id fetched by `start`, the validation middleware would
+            # call eth_chainId again before every eth_call
+            web3.middleware_onion.remove("validation")
+            self.contract = web3.eth.contract(address=self.token_address, abi=erc20_abi)
+            self.web3 = web3
+
+    async def start(self):
+        """
+        Loads the chain libraries in a worker thread, opens the shared keep-alive connection pool used by the
+        provider and fetches the token decimals, the chain id, the gas price and the account's nonce, then sets
+        `ready`, whether or not the chain could be reached.
+        """
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.load)
+            if self._session is None:
+                from aiohttp import ClientSession, ClientTimeout, TCPConnector
+                self._session = ClientSession(
+                    connector=TCPConnector(limit=self.concurrency),
+                    timeout=ClientTimeout(total=self.timeout),
+                    raise_for_status=True,
+                )
+                await self.provider.cache_async_session(self._session)
+            await asyncio.gather(self.decimals(), self._load_transaction_params(), self.nonces.sync())
+        except Exception as e:
+            print(f"Error initialising chain access: {e}")
+        finally:
+            self.ready.set()
+
+    async def close(self):
+        """
+        Stops following transfer receipts and closes the connection pool and the transfer ledger.
+        """
+        self.receipts.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        await self.ledger.close()
+
+    async def call(self, awaitable):
+        """
+        Awaits an RPC call within the concurrency limit and the per call timeout.
+
+        The duration of the call, including the wait for a slot, is reported as
+        `agent_rpc_duration_seconds{method=...}`, and failures as `agent_rpc_errors_total{method=...}`.
+
+        Args:
+            awaitable (Awaitable): The pending web3 call.
+
+        Returns:
+            Any: The result of the call.
+
+        Raises:
+            asyncio.TimeoutError: If the call takes longer than `timeout`.
+        """
+        method = getattr(awaitable, "__name__", "call")
+        instruments = self._rpc_metrics.get(method)
+        if instruments is None:
+            instruments = self._rpc_metrics[method] = (
+                metrics.histogram("agent_rpc_duration_seconds", "Duration of RPC calls", method=method),
+                metrics.counter("agent_rpc_errors_total", "RPC calls that failed or timed out", method=method),
+            )
+        start = time.perf_counter_ns()
+        try:
+            async with self._limiter:
+                return await asyncio.wait_for(awaitable, self.timeout)
+        except Exception:
+            instruments[1].inc()
+            raise
+        finally:
+            instruments[0].record(time.perf_counter_ns() - start)
+
+    async def latest_block(self) -> int:
+        """
+        Returns the latest block number, polling the node at most once every `block_interval` seconds.
+
+        A new block number invalidates the mutable values of the read cache.
+
+        Returns:
+            int: The latest known block number.
+        """
+        now = time.monotonic()
+        if self._block_checked_at is None or now - self._block_checked_at >= self.block_interval:
+            if self._block_refresh is None:
+                self._block_refresh = asyncio.ensure_future(self.call(self.web3.eth.block_number))
+            refresh = self._block_refresh
+            try:
+                self.cache.set_block(await asyncio.shield(refresh))
+                self._block_checked_at = now
+            finally:
+                if self._block_refresh is refresh:
+                    self._block_refresh = None
+        return self.cache.block
+
+    def _invalidate_reads(self):
+        # A transfer changes balances once mined, so drop cached reads and poll the block number on the next read
+        self.cache.invalidate()
+        self._block_checked_at = None
+
+    async def decimals(self) -> int:
+        """
+        Retrieves the number of decimal places the ERC20 token supports. The value is fetched once and pinned.
+
+        Returns:
+            int: The token decimals.
+        """
+        return await self.cache.get(
+            (self.contract.address, "decimals", ()),
+            lambda: self.call(self.contract.functions.decimals().call()),
+            pinned=True,
+        )
+
+    async def balance_of(self, address: str) -> int:
+        """
+        Retrieves the ERC20 token balance of an address at the latest block, served from the read cache when the
+        block has not changed.
+
+        Args:
+            address (str): The Ethereum address.
+
+        Returns:
+            int: The balance, in the smallest unit.
+        """
+        block = await self.latest_block()
+        return await self.cache.get(
+            (self.contract.address, "balanceOf", (address,)),
+            lambda: self.call(self.contract.functions.balanceOf(address).call(block_identifier=block)),
+        )
+
+    async def _fetch_nonce(self) -> int:
+        return await self.call(self.web3.eth.get_transaction_count(self.account.address, 'pending'))
+
+    async def _load_transaction_params(self):
+        if self.chain_id is None:
+            self.chain_id = await self.call(self.web3.eth.chain_id)
+        if self.gas_price is None:
+            self.gas_price = await self.call(self.web3.eth.gas_price)
+
+    def sign_transfer(self, to_address: str, amount: int, nonce: int, gas_price: int = None) -> bytes:
+        """
+        Builds and signs an ERC20 transfer locally, without any RPC call.
+
+        Args:
+            to_address (str): The recipient's Ethereum address.
+            amount (int): The amount of tokens to send, in the smallest unit.
+            nonce (int): The nonce of the transaction.
+            gas_price (int, optional): The gas price in wei. Defaults to `gas_price`.
+
+        Returns:
+            bytes: The raw signed transaction.
+        """
+        tx = {
+            'to': self.contract.address,
+            'data': encode_transfer(to_address, amount),
+            'value': 0,
+            'gas': self.gas_limit,
+            'gasPrice': gas_price or self.gas_price,
+            'nonce': nonce,
+            'chainId': self.chain_id,
+        }
+        return self.account.sign_transaction(tx).raw_transaction
+
+    async def _submit_transfer(self, to_address: str, amount: int, retry: bool = True) -> str:
+        if self.chain_id is None or self.gas_price is None:
+            await self._load_transaction_params()
+        nonce = await self.nonces.next()
+        raw_tx = self.sign_transfer(to_address, amount, nonce)
+        try:
+            tx_hash = self.web3.to_hex(await self.call(self.web3.eth.send_raw_transaction(raw_tx)))
+        except Exception as e:
+            if not is_nonce_error(e):
+                self.nonces.release([nonce])
+                raise
+            await self.nonces.sync()
+            if retry:
+                return await self._submit_transfer(to_address, amount, retry=False)
+            raise
+        self._invalidate_reads()
+        self.receipts.track(tx_hash, nonce, to_address, amount, self.gas_price)
+        return tx_hash
+
+    async def send_token(self, to_address: str, amount: int) -> str:
         """
         Sends ERC20 tokens to a specified address.
 
+        A nonce rejected by the node triggers a resync of the local counter and one retry, after any other failure
+        the nonce is released to the next transfer. The submitted transfer
+        is followed by `receipts`, whose `watch` gives its outcome.
+
         Args:
             to_address (str): The recipient's Ethereum address.
             amount (int): The amount of tokens to send, in the smallest unit (e.g., wei for Ether).
 
         Returns:
             str: The transaction hash of the token transfer transaction as a hexadecimal string.
-
-        Raises:
-            Exception: If there is an error during the transaction.
+            None: If an error occurs during the transaction.
         """
         try:
-            tx = self.contract.functions.transfer(to_address, amount).build_transaction({
-                'from': self.account.address,
-                'nonce': self.web3.eth.get_transaction_count(self.account.address),
-                'gas': 100000,
-                'gasPrice': self.web3.to_wei('20', 'gwei')
-            })
-
-            signed_tx = self.web3.eth.account.sign_transaction(tx, self.private_key)
-            tx_hash = self.web3.eth.send_raw_transaction(signed_tx.raw_transaction)
-            return self.web3.to_hex(tx_hash)
+            tx_hash = await self._submit_transfer(to_address, amount)
+            self.transfers_sent.inc()
+            return tx_hash
         except Exception as e:
-            print("Error in ERC20 token transfer, Check your eth & dai balance and if your tenderly "
-                  "limit is not exhausted\n", e)
+            self.transfers_failed.inc()
+            print("Error in ERC20 token transfer, Check your eth & dai balance and the RPC endpoints' "
+                  "limits and health\n", e)
             return None
 
+    async def send_tokens(self, transfers: list) -> list:
+        """
+        Sends several ERC20 transfers with consecutive nonces in a single JSON-RPC batch request.
+
+        Transfers rejected because of their nonce are resubmitted individually after resyncing the nonce counter,
+        the nonces of transfers failing otherwise are released. Submitted transfers are followed by `receipts`.
+
+        Args:
+            transfers (list): (to_address, amount) pairs.
+
+        Returns:
+            list: For each transfer, its transaction hash as a hexadecimal string, or None if it failed.
+        """
+        if len(transfers) == 1:
+            return [await self.send_token(*transfers[0])]
+        if self.chain_id is None or self.gas_price is None:
+            await self._load_transaction_params()
+        nonces = await self.nonces.reserve(len(transfers))
+        requests = [
+            ("eth_sendRawTransaction", [self.web3.to_hex(self.sign_transfer(to_address, amount, nonce))])
+            for (to_address, amount), nonce in zip(transfers, nonces)
+        ]
+        try:
+            responses = await self.call(self.provider.make_batch_request(requests))
+        except Exception as e:
+            if is_nonce_error(e):
+                await self.nonces.sync()
+            else:
+                self.nonces.release(nonces)
+            self.transfers_failed.inc(len(transfers))
+            print("Error in batched ERC20 token transfer, Check your eth & dai balance and the RPC endpoints' "
+                  "limits and health\n", e)
+            return [None] * len(transfers)
+        tx_hashes = [response.get("result") for response in responses]
+        self.transfers_sent.inc(len(transfers) - tx_hashes.count(None))
+        self._invalidate_reads()
+        for (to_address, amount), nonce, tx_hash in zip(transfers, nonces, tx_hashes):
+            if tx_hash is not None:
+                self.receipts.track(tx_hash, nonce, to_address, amount, self.gas_price)
+        if None in tx_hashes:
+            rejected = [index for index, response in enumerate(responses) if response.get("result") is None and
+                        is_nonce_error(Exception((response.get("error") or {}).get("message")))]
+            self.nonces.release(nonce for index, (nonce, tx_hash) in enumerate(zip(nonces, tx_hashes))
+                                if tx_hash is None and index not in rejected)
+            if rejected:
+                await self.nonces.sync()
+            for index, response in enumerate(responses):
+                if tx_hashes[index] is not None:
+                    continue
+                if index in rejected:
+                    tx_hashes[index] = await self.send_token(*transfers[index])
+                else:
+                    self.transfers_failed.inc()
+                    print(f"Error in ERC20 token transfer to {transfers[index][0]}: {response.get('error')}")
+        return tx_hashes
+
     async def check_balance(self) -> float:
         """
-        Retrieves the account's ERC20 token balance.
+        Retrieves the account's ERC20 token balance as tracked in memory by `balances`, syncing it first if it
+        has never been synced.
 
         Returns:
             float: The token balance in human-readable format (adjusted for token decimals).
             None: If an error occurs during the balance retrieval.
-
-        Raises:
-            Exception: If there is an issue accessing the token contract or performing the call.
         """
         try:
-            balance = self.contract.functions.balanceOf(self.account.address).call()
-            decimals = self.contract.functions.decimals().call()
+            if self.balances.balance is None:
+                await self.balances.sync()
+            balance, decimals = self.balances.balance, await self.decimals()
             human_readable_balance = balance / (10 ** decimals)
             return human_readable_balance
         except Exception as e:
@@ -0,0 +1,175 @@
+import asyncio
+import os
+
+from helpers.metrics import metrics
+from helpers.transfer_ledger import STATE_CONFIRMED, STATE_FAILED, STATE_SENT
+
+
+class TransferBatcher:
+    """
+    A batching stage in front of `SAContractHelper` that coalesces token transfers.
+
+    Transfer intents are accumulated until `max_batch_size` intents are waiting or the oldest one has waited
+    `max_wait` seconds. Intents to the same recipient are then merged into a single transfer, and the signed
+    transfers of the batch are submitted in one JSON-RPC batch request. Every intent gets back the transaction
+    hash of the transfer it was merged into.
+
+    Intents submitted with a key go through the helper's `TransferLedger` first: an intent whose key was already
+    paid gets back the transaction hash of the earlier transfer instead of paying again, a duplicate of an intent
+    still in flight waits for it, and the ledger is synced to disk before a batch is submitted. Once the transfer
+    is settled by the helper's `ReceiptTracker`, its keys are recorded as confirmed, reverted or failed.
+
+    Attributes:
+        helper (SAContractHelper): The contract helper signing and submitting the transfers.
+        max_batch_size (int): The number of waiting intents that triggers an immediate flush.
+        max_wait (float): The maximum time, in seconds, an intent waits before being flushed.
+        intents (Counter): The number of intents submitted, `agent_transfer_intents_total`. Compared with
+            `agent_transfers_total`, it shows how many intents each transfer carries.
+        duplicates (Counter): The number of intents skipped because of their key,
+            `agent_transfer_duplicates_total`.
+    """
+
+    def __init__(self, helper, max_batch_size: int = None, max_wait: float = None):
+        """
+        Initializes the TransferBatcher.
+
+        Args:
+            helper (SAContractHelper): The contract helper signing and submitting the transfers.
+            max_batch_size (int, optional): Defaults to `TRANSFER_BATCH_SIZE`, or 100.
+            max_wait (float, optional): Defaults to `TRANSFER_BATCH_WAIT`, or 0.2 seconds.
+        """
+        self.helper = helper
+        self.max_batch_size = max_batch_size or int(os.getenv("TRANSFER_BATCH_SIZE", 100))
+        self.max_wait = max_wait if max_wait is not None else float(os.getenv("TRANSFER_BATCH_WAIT", 0.2))
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+        self._in_flight = {}
+        self.intents = metrics.counter("agent_transfer_intents_total", "Transfer intents submitted to the batcher")
+        self.duplicates = metrics.counter("agent_transfer_duplicates_total",
+                                          "Transfer intents skipped because their key was already paid")
+
+    async def submit(self, to_address: str, amount: int, key: str = None) -> str:
+        """
+        Queues a transfer intent and waits for the transfer it is merged into to be submitted.
+
+        Args:
+            to_address (str): The recipient's Ethereum address.
+            amount (int): The amount of tokens to send, in the smallest unit.
+            key (str, optional): The idempotency key of the intent, see `transfer_key`. Without a key the
+                intent is always paid.
+
+        Returns:
+            str: The transaction hash of the merged transfer, or of the earlier transfer paying the same key.
+            None: If the transfer could not be submitted, or the key is pending from before a restart.
+        """
+        self.intents.inc()
+        if key is not None:
+            in_flight = self._in_flight.get(key)
+            if in_flight is not None:
+                self.duplicates.inc()
+                return await asyncio.shield(in_flight)
+            paid = self.helper.ledger.claim(key)
+            if paid is not None:
+                self.duplicates.inc()
+                state, tx_hash = paid
+                return tx_hash if state in (STATE_SENT, STATE_CONFIRMED) else None
+        loop = asyncio.get_running_loop()
+        result = loop.create_future()
+        if key is not None:
+            self._in_flight[key] = result
+            result.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        self._pending.append((to_address, amount, result, key))
+        if len(self._pending) >= self.max_batch_size or self.max_wait <= 0:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush_pending)
+        # A caller giving up, such as a handler timing out, must not cancel the transfer for duplicates waiting on it
+        return await asyncio.shield(result)
+
+    async def flush(self):
+        """
+        Submits every waiting intent now and waits for all batches in flight.
+        """
+        self._flush_pending()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: list):
+        merged = {}
+        for to_address, amount, result, key in batch:
+            entry = merged.setdefault(to_address.lower(), [to_address, 0, []])
+            entry[1] += amount
+            entry[2].append((result, key))
+        transfers = list(merged.values())
+        ledger = self.helper.ledger
+        try:
+            await ledger.sync()
+            tx_hashes = await self.helper.send_tokens([(to_address, amount) for to_address, amount, _ in transfers])
+        except Exception as e:
+            print(f"Error in batched ERC20 token transfer: {e}")
+            tx_hashes = [None] * len(transfers)
+        for (_, _, results), tx_hash in zip(transfers, tx_hashes):
+            keys = [key for _, key in results if key is not None]
+            for result, key in results:
+                if key is not None:
+                    ledger.record(key, STATE_SENT if tx_hash else STATE_FAILED, tx_hash)
+                if not result.done():
+                    result.set_result(tx_hash)
+            settled = self.helper.receipts.watch(tx_hash) if tx_hash and keys else None
+            if settled is not None:
+                settled.add_done_callback(lambda future, keys=keys: self._record_outcome(keys, future))
+
+    def _record_outcome(self, keys: list, settled: asyncio.Future):
+        # Transfers no longer followed, or given up with their outcome unknown, stay sent: paying them again could
+        # pay twice
+        if settled.cancelled():
+            return
+        state, tx_hash = settled.result()
+        if state == STATE_SENT:
+            return
+        for key in keys:
+            self.helper.ledger.record(key, state, tx_hash)
+
+
+class RemoteTransferBatcher:
+    """
+    Stands in for the `TransferBatcher` of a secondary worker process, handing transfer intents to the batcher
+    of the primary worker, which owns the account's nonces.
+
+    Attributes:
+        channel (IPCChannel): The channel to the primary worker.
+    """
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def submit(self, to_address: str, amount: int, key: str = None) -> str:
+        """
+        Queues a transfer intent in the primary worker, which owns the ledger, and waits for the transfer it is
+        merged into.
+
+        Args:
+            to_address (str): The recipient's Ethereum address.
+            amount (int): The amount of tokens to send, in the smallest unit.
+            key (str, optional): The idempotency key of the intent.
+
+        Returns:
+            str: The transaction hash of the merged transfer.
+            None: If the transfer could not be submitted.
+        """
+        return await self.channel.call("submit_transfer", to_address, amount, key)
+
+    async def flush(self):
+        pass
@@ -0,0 +1,330 @@
+import asyncio
+import hashlib
+import json
+import mmap
+import os
+import struct
+from collections import OrderedDict
+
+from helpers.logger import Logger
+
+# Ledger record: digest of the transfer key, state, transaction hash (zeros until known)
+RECORD = struct.Struct("16sB32s")
+KEY_SIZE = 16
+NO_TX_HASH = bytes(32)
+
+# The intent is recorded and its transfer not submitted yet, or its outcome is unknown after a crash
+STATE_PENDING = 1
+STATE_SENT = 2
+STATE_FAILED = 3
+STATE_CONFIRMED = 4
+STATE_REVERTED = 5
+
+# The directory of the ledger when `LEDGER_DIR` is unset, and the value of `LEDGER_DIR` keeping it in memory only
+DEFAULT_DIRECTORY = "ledger"
+IN_MEMORY = "memory"
+
+INDEX_NAME = "ledger.index"
+LOG_NAME = "ledger.log"
+# The log being merged into the index by a compaction in progress
+MERGING_LOG_NAME = "ledger.merging.log"
+
+
+def transfer_key(peer: str, message_id) -> str:
+    """
+    Returns the idempotency key of the transfer requested by a message.
+
+    Args:
+        peer (str): The name of the peer the message came from, None if unknown.
+        message_id: The id of the message.
+
+    Returns:
+        str: The key.
+    """
+    return json.dumps([peer or "", message_id])
+
+
+def _fsync(fd: int):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _merge_index(index, count: int, records: dict, path: str):
+    # Writes the sorted index `index` (`count` records, or None) merged with `records` to `path`
+    with open(path, "wb") as index_file:
+        copied = 0
+        for digest, (state, tx_hash) in sorted(records.items()):
+            if index is not None:
+                low, high = copied, count
+                while low < high:
+                    middle = (low + high) // 2
+                    if index[middle * RECORD.size:middle * RECORD.size + KEY_SIZE] < digest:
+                        low = middle + 1
+                    else:
+                        high = middle
+                offset = low * RECORD.size
+                index_file.write(index[copied * RECORD.size:offset])
+                found = low < count and index[offset:offset + KEY_SIZE] == digest
+                copied = low + 1 if found else low
+            index_file.write(RECORD.pack(digest, state, tx_hash))
+        if index is not None:
+            index_file.write(index[copied * RECORD.size:count * RECORD.size])
+        index_file.flush()
+        os.fsync(index_file.fileno())
+
+
+class TransferLedger:
+    """
+    An idempotency ledger of transfers, recording for every key (peer, message id) its intent, the transaction
+    hash it was paid with and its final status, so that a message replayed, retransmitted or reusing the id of
+    an earlier message never pays for a second transfer.
+
+    Keys are stored as 16-byte digests in fixed-size records. Recent records live in a dict, the hot tier, and
+    are appended to `ledger.log`. Once `compact_records` keys accumulate there, they are merged into
+    `ledger.index`, a file of records sorted by digest and looked up by binary search through `mmap`. The merge
+    runs in a thread: the log is set aside as `ledger.merging.log` and its keys stay readable from memory while
+    new ones go to a fresh log, so recording a payout never waits for the index to be rewritten. A lookup is a
+    dict probe followed, for keys not seen recently, by about log2(n) 16-byte comparisons, a few microseconds
+    for millions of keys, and nothing is loaded at startup beyond the logs.
+    The ledger is kept on disk by default, since duplicate protection is only worth having across restarts. When
+    explicitly kept in memory, it only remembers the `cache_size` most recently used keys, until the process exits.
+
+    Attributes:
+        directory (str): The directory holding the ledger files (`LEDGER_DIR`), None when kept in memory.
+        compact_records (int): Keys in the log that trigger a merge into the index (`LEDGER_COMPACT_RECORDS`).
+        cache_size (int): Keys kept by an in-memory ledger (`LEDGER_CACHE_SIZE`).
+        logger (Logger): The logger of the ledger, reporting failed compactions.
+    """
+
+    def __init__(self, directory: str = None, compact_records: int = None, cache_size: int = None):
+        """
+        Opens the ledger, replaying its log.
+
+        Args:
+            directory (str, optional): Defaults to `LEDGER_DIR`, or `ledger` in the working directory. `memory`
+                keeps the ledger in memory only.
+            compact_records (int, optional): Defaults to `LEDGER_COMPACT_RECORDS`, or 100000.
+            cache_size (int, optional): Defaults to `LEDGER_CACHE_SIZE`, or 100000.
+        """
+        directory = directory or os.getenv("LEDGER_DIR") or DEFAULT_DIRECTORY
+        self.directory = None if directory == IN_MEMORY else directory
+        self.compact_records = compact_records or int(os.getenv("LEDGER_COMPACT_RECORDS", 100000))
+        self.cache_size = cache_size or int(os.getenv("LEDGER_CACHE_SIZE", 100000))
+        self.logger = Logger("transfer_ledger")
+        # Least recently used first, for the eviction of an in-memory ledger
+        self._recent = OrderedDict()
+        self._index = None
+        self._index_file = None
+        self._count = 0
+        self._log = None
+        self._merging = {}
+        self._merging_log = None
+        self._compaction = None
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._open_index()
+            self._replay_log(MERGING_LOG_NAME)
+            self._replay_log(LOG_NAME)
+            self._log = open(os.path.join(self.directory, LOG_NAME), "ab")
+            if os.path.exists(os.path.join(self.directory, MERGING_LOG_NAME)):
+                # Stopped during a compaction, finish it before taking new records
+                self.compact()
+
+    def _open_index(self):
+        path = os.path.join(self.directory, INDEX_NAME)
+        if not os.path.exists(path) or os.path.getsize(path) < RECORD.size:
+            return
+        self._index_file = open(path, "rb")
+        self._index = mmap.mmap(self._index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._count = len(self._index) // RECORD.size
+
+    def _close_index(self):
+        if self._index is not None:
+            self._index.close()
+            self._index_file.close()
+        self._index = self._index_file = None
+        self._count = 0
+
+    def _replay_log(self, name: str):
+        path = os.path.join(self.directory, name)
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as log:
+            data = log.read()
+        whole = len(data) - len(data) % RECORD.size
+        for digest, state, tx_hash in RECORD.iter_unpack(data[:whole]):
+            self._recent[digest] = (state, tx_hash)
+        if whole < len(data):
+            # A torn write at the tail of the log, drop it
+            with open(path, "r+b") as log:
+                log.truncate(whole)
+
+    def _search(self, digest: bytes) -> int:
+        index, size = self._index, RECORD.size
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            offset = middle * size
+            if index[offset:offset + KEY_SIZE] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _lookup(self, digest: bytes):
+        entry = self._recent.get(digest)
+        if entry is not None and self._log is None:
+            self._recent.move_to_end(digest)
+        entry = entry or self._merging.get(digest)
+        if entry is not None or self._index is None:
+            return entry
+        position = self._search(digest)
+        offset = position * RECORD.size
+        if position < self._count and self._index[offset:offset + KEY_SIZE] == digest:
+            _, state, tx_hash = RECORD.unpack_from(self._index, offset)
+            return state, tx_hash
+        return None
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode("utf-8"), digest_size=KEY_SIZE).digest()
+
+    @staticmethod
+    def _entry(entry) -> tuple:
+        state, tx_hash = entry
+        return state, "0x" + tx_hash.hex() if tx_hash != NO_TX_HASH else None
+
+    def get(self, key: str) -> tuple:
+        """
+        Looks up a transfer.
+
+        Args:
+            key (str): The transfer key, see `transfer_key`.
+
+        Returns:
+            tuple: The state of the transfer and its transaction hash, or None if unknown.
+            None: If the key was never recorded.
+        """
+        entry = self._lookup(self._digest(key))
+        return self._entry(entry) if entry is not None else None
+
+    def claim(self, key: str) -> tuple:
+        """
+        Records the intent of a transfer unless one was already recorded for the key.
+
+        A key whose transfer failed to be submitted can be claimed again, since it did not pay anything.
+
+        Args:
+            key (str): The transfer key, see `transfer_key`.
+
+        Returns:
+            None: If the intent was recorded and the transfer should be made.
+            tuple: The state and transaction hash of the transfer already recorded for the key.
+        """
+        digest = self._digest(key)
+        entry = self._lookup(digest)
+        if entry is not None and entry[0] != STATE_FAILED:
+            return self._entry(entry)
+        self._write(digest, STATE_PENDING, NO_TX_HASH)
+        return None
+
+    def record(self, key: str, state: int, tx_hash: str = None):
+        """
+        Records the new state of a transfer.
+
+        Args:
+            key (str): The transfer key, see `transfer_key`.
+            state (int): One of the `STATE_` constants.
+            tx_hash (str, optional): The transaction hash of the transfer, as a hexadecimal string.
+        """
+        self._write(self._digest(key), state, bytes.fromhex(tx_hash[2:]) if tx_hash else NO_TX_HASH)
+
+    def _write(self, digest: bytes, state: int, tx_hash: bytes):
+        self._recent[digest] = (state, tx_hash)
+        if self._log is None:
+            self._recent.move_to_end(digest)
+            if len(self._recent) > self.cache_size:
+                self._recent.popitem(last=False)
+            return
+        self._log.write(RECORD.pack(digest, state, tx_hash))
+        if len(self._recent) >= self.compact_records and self._compaction is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.compact()
+            else:
+                self._compaction = loop.create_task(self._compact_in_background())
+
+    async def sync(self):
+        """
+        Waits until every record written so far is on disk. Intents are synced before their transfers are sent.
+        """
+        if self._log is None:
+            return
+        self._log.flush()
+        logs = [self._log] + ([self._merging_log] if self._merging_log is not None else [])
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(loop.run_in_executor(None, _fsync, os.dup(log.fileno())) for log in logs))
+
+    def _set_log_aside(self):
+        # Moves the log and its keys aside for merging, new records go to a fresh log
+        self._log.flush()
+        self._log.close()
+        os.replace(os.path.join(self.directory, LOG_NAME), os.path.join(self.directory, MERGING_LOG_NAME))
+        self._merging_log = open(os.path.join(self.directory, MERGING_LOG_NAME), "rb")
+        self._log = open(os.path.join(self.directory, LOG_NAME), "wb")
+        self._merging, self._recent = self._recent, OrderedDict()
+
+    def _install_index(self):
+        path = os.path.join(self.directory, INDEX_NAME)
+        self._close_index()
+        os.replace(f"{path}.tmp", path)
+        self._open_index()
+        self._merging_log.close()
+        self._merging_log = None
+        os.remove(os.path.join(self.directory, MERGING_LOG_NAME))
+        self._merging = {}
+
+    async def _compact_in_background(self):
+        try:
+            self._set_log_aside()
+            await asyncio.get_running_loop().run_in_executor(
+                None, _merge_index, self._index, self._count, self._merging,
+                os.path.join(self.directory, f"{INDEX_NAME}.tmp"))
+            self._install_index()
+        except Exception as e:
+            self.logger.error("Error compacting the transfer ledger, its log keeps growing: %s", e)
+        finally:
+            self._compaction = None
+
+    def compact(self):
+        """
+        Merges the records of the logs into the sorted index right away and truncates the log.
+        """
+        if self._log is None or self._compaction is not None or not (self._recent or self._merging):
+            return
+        if not os.path.exists(os.path.join(self.directory, MERGING_LOG_NAME)):
+            self._set_log_aside()
+        elif self._merging_log is None:
+            self._merging_log = open(os.path.join(self.directory, MERGING_LOG_NAME), "rb")
+        records = {**self._merging, **self._recent}
+        _merge_index(self._index, self._count, records, os.path.join(self.directory, f"{INDEX_NAME}.tmp"))
+        self._install_index()
+        self._log.close()
+        self._log = open(os.path.join(self.directory, LOG_NAME), "wb")
+        self._recent.clear()
+
+    async def close(self):
+        """
+        Waits for a compaction in progress, then flushes the log and closes the ledger files.
+        """
+        if self._compaction is not None:
+            await asyncio.shield(self._compaction)
+        if self._log is not None:
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self._log.close()
+            self._log = None
+        self._close_index()
@@ -1,7 +1,7 @@
+import asyncio
 import os
 
-from server.http_server_impl import HTTPServerImpl
-from server.socket_server_impl import SocketServerImpl
+from server.base_server import BaseServer
 
 erc20_abi = [
     {
@@ -18,7 +18,7 @@ erc20_abi = [
 ]
 
 
-def get_server_instance() -> HTTPServerImpl | SocketServerImpl:
+def get_server_instance() -> BaseServer:
     mode = os.getenv("SERVER_MODE", "socket")
     host = os.getenv("HOST")
     port = os.getenv("PORT")
@@ -26,7 +26,34 @@ def get_server_instance() -> HTTPServerImpl | SocketServerImpl:
     peer_port = os.getenv("OUTBOX_PORT")
     os.getenv("OUTBOX_PORT")
     print(f"Starting server on {mode}://{host}:{port}")
+    # Only the selected transport is imported
     if mode == "http":
+        from server.http_server_impl import HTTPServerImpl
         return HTTPServerImpl(host, port, peer_host, peer_port)
     else:
+        from server.socket_server_impl import SocketServerImpl
         return SocketServerImpl(host, port, peer_host, peer_port)
+
+
+def install_event_loop() -> str:
+    """
+    Selects the event loop `asyncio.run` creates from `EVENT_LOOP`: "uvloop", "asyncio", or "auto" (the default)
+    for uvloop when it is installed.
+
+    Returns:
+        str: The name of the selected event loop.
+
+    Raises:
+        ImportError: If `EVENT_LOOP` is "uvloop" and uvloop is not installed.
+    """
+    choice = os.getenv("EVENT_LOOP", "auto")
+    if choice == "asyncio":
+        return choice
+    try:
+        import uvloop
+    except ImportError:
+        if choice == "uvloop":
+            raise
+        return "asyncio"
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    return "uvloop"
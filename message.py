@@ -1,4 +1,69 @@
+import json
+
+
 class Message:
-    def __init__(self, id, message):
+    """
+    A message exchanged between agents.
+
+    Messages are slotted, since millions of them pass through a long-running agent, and cache their wire
+    encodings: a message queued for several peers, persisted in their outboxes and sent again after a
+    reconnect is serialized once. A message must not be changed once it is sent.
+    """
+
+    __slots__ = ("id", "message", "destination", "sender", "priority", "_json", "_frame")
+
+    def __init__(self, id, message, destination=None, sender=None, priority=None):
         self.id = id
         self.message = message
+        # The peer name, list of peer names or "*" the message is sent to, None for every peer
+        self.destination = destination
+        # The name of the peer the message was received from, when the transport knows it
+        self.sender = sender
+        # The name of the inbox lane the receiver queues the message in, None to let the receiver classify it
+        self.priority = priority
+        # The encodings of `to_json` and `server.framing.encode_message`, once computed
+        self._json = None
+        self._frame = None
+
+    @classmethod
+    def from_dict(cls, fields: dict, sender: str = None) -> "Message":
+        """
+        Builds a received message from its wire fields.
+
+        The sender is never taken from the fields: it keys the transfers paid for the message, so only the
+        transport may tell it, and a peer cannot pass its messages off as another peer's.
+
+        Args:
+            fields (dict): The fields, as returned by `to_dict`.
+            sender (str, optional): The name of the peer the message was received from, as known to the transport.
+
+        Returns:
+            Message: The message.
+        """
+        return cls(fields["id"], fields["message"], fields.get("destination"), sender, fields.get("priority"))
+
+    def to_dict(self) -> dict:
+        """
+        Returns the fields sent over the wire. The destination and sender are known from the connection.
+        """
+        if self.priority is not None:
+            return {"id": self.id, "message": self.message, "priority": self.priority}
+        return {"id": self.id, "message": self.message}
+
+    def to_json(self) -> bytes:
+        """
+        Returns the fields sent over the wire as UTF-8 JSON, encoded on the first call only.
+        """
+        if self._json is None:
+            self._json = json.dumps(self.to_dict()).encode("utf-8")
+        return self._json
+
+    def fields(self) -> dict:
+        """
+        Returns every field of the message, including its destination and sender.
+        """
+        return {"id": self.id, "message": self.message, "destination": self.destination, "sender": self.sender,
+                "priority": self.priority}
+
+    # Handlers written for the unslotted message read its fields through `__dict__`
+    __dict__ = property(fields)
@@ -1,27 +1,68 @@
-import queue
+import asyncio
+import os
 from abc import abstractmethod
 
+from helpers.logger import Logger
+from helpers.metrics import metrics
 from message import Message
-from datetime import datetime, timezone
+from server.inbox import Inbox
+from server.journal import Journal
+from server.lanes import inbox_lanes
+from server.outbox import Outbox
+from server.overflow import queue_limits
+from server.peers import DEFAULT_PEER, Peer, PeerRegistry, parse_peers
+
+
+def remote_sender(host: str) -> str:
+    """
+    Returns the sender of the messages of a peer that does not tell its name, from its remote address.
+
+    Only the host is used: the port of the peer's connection changes when it reconnects, and a message it sends
+    again must keep its sender.
+
+    Args:
+        host (str): The remote address of the connection.
+
+    Returns:
+        str: The sender.
+    """
+    return f"address:{host}"
 
 
 class BaseServer:
     """
     A base class for creating servers with message queuing and peer-to-peer communication capabilities.
     This class defines the basic structure for managing received and sent messages, along with attributes 
-    for server and peer connection details. It includes an abstract method for sending messages, 
-    which must be implemented by subclasses.
+    for server and peer connection details. Subclasses implement the transport that delivers the outbox of
+    each peer.
+
+    Peers are registered from the `PEERS` environment variable (`name=host:port,...`), plus a peer named
+    `outbox` for the legacy `peer_host` and `peer_port`. Every peer has its own outbox, and `send_to_outbox`
+    queues a message in the outboxes of the peers its destination resolves to: a peer name, a list of peer
+    names, or every peer. The peer class is taken from `peer_class`, which transports override to keep their
+    connection state on the peer.
+
+    When the `JOURNAL_DIR` environment variable is set, all queues are backed by a persistent journal in that
+    directory, so queued messages survive a restart and are delivered at least once. Their capacities and
+    overflow policies are read from `INBOX_CAPACITY`, `INBOX_OVERFLOW`, `OUTBOX_CAPACITY` and `OUTBOX_OVERFLOW`.
 
     Attributes:
         host (str): The host address of this server.
         port (int): The port number on which this server is running.
-        peer_host (str): The host address of the peer server to connect to as a client.
-        peer_port (int): The port number of the peer server to connect to as a client.
-        received_messages (Queue): A queue to store messages received by the server.
-        sent_messages (Queue): A queue to store messages to be sent by the server.
-        is_connected (bool): A flag indicating whether the server is connected to a peer.
+        name (str): The name this agent introduces itself with to its peers, `AGENT_NAME` or `host:port`.
+        received_messages (Inbox): An awaitable queue to store messages received by the server.
+        peers (PeerRegistry): The peers messages are sent to, each with an outbox of messages waiting until the
+            peer acknowledges them.
+        worker_index (int): The index of the worker process running the server, None outside a multi-worker agent.
+        reuse_port (bool): Whether the listening socket is shared with the other worker processes.
+        relay (Callable): When set, `send_to_outbox` hands messages to this coroutine function instead of
+            queuing them, so secondary workers send through the primary worker.
+        logger (Logger): The logger of the server and its agent, with the host and port as source.
+        received_total (Counter): The number of messages received, `agent_messages_received_total`.
     """
 
+    peer_class = Peer
+
     def __init__(self, host, port, peer_host=None, peer_port=None):
         """
         Initializes the BaseServer with server and peer connection details.
@@ -34,35 +75,157 @@ class BaseServer:
         """
         self.host = host
         self.port = int(port)
-        self.peer_host = peer_host
-        self.peer_port = int(peer_port) if peer_port else None
-        self.received_messages = queue.Queue()
-        self.sent_messages = queue.Queue()
-        self.is_connected = False
+        self.name = os.getenv("AGENT_NAME") or f"{host}:{port}"
+        self.logger = Logger(f"{self.host}:{self.port}")
+        self.journal_dir = os.getenv("JOURNAL_DIR")
+        self.received_messages = Inbox(Journal(os.path.join(self.journal_dir, "inbox")) if self.journal_dir else None,
+                                       *queue_limits("INBOX"), inbox_lanes())
+        self.received_total = metrics.counter("agent_messages_received_total", "Messages received from peers")
+        metrics.gauge("agent_inbox_dropped", "Messages dropped by the overflow policy of the inbox",
+                      lambda: self.received_messages.dropped)
+        for lane in self.received_messages.lanes.lanes:
+            metrics.gauge("agent_inbox_depth", "Messages waiting in the inbox lane",
+                          lambda name=lane.name: len(self.received_messages.lanes.lane(name)), lane=lane.name)
+            metrics.gauge("agent_inbox_max_wait_seconds", "Longest time a message waited in the inbox lane",
+                          lambda name=lane.name: self.received_messages.lanes.lane(name).max_wait, lane=lane.name)
+        self.peers = PeerRegistry()
+        if peer_host and peer_port:
+            self.add_peer(DEFAULT_PEER, peer_host, peer_port)
+        for name, host, port in parse_peers(os.getenv("PEERS")):
+            self.add_peer(name, host, port)
+        self.worker_index = None
+        self.reuse_port = False
+        self.relay = None
+
+    @property
+    def is_connected(self) -> bool:
+        """Whether the server is connected to at least one peer."""
+        return any(peer.is_connected for peer in self.peers)
+
+    def add_peer(self, name: str, host: str, port: int) -> Peer:
+        """
+        Registers a peer with its own outbox.
+
+        Args:
+            name (str): The name messages address the peer with.
+            host (str): The host address of the peer's server.
+            port (int): The port number of the peer's server.
+
+        Returns:
+            Peer: The registered peer.
+        """
+        journal = None
+        if self.journal_dir:
+            journal = Journal(os.path.join(self.journal_dir, "outbox" if name == DEFAULT_PEER else f"outbox-{name}"))
+        peer = self.peer_class(name, host, port, Outbox(journal, *queue_limits("OUTBOX")))
+        self.peers.add(peer)
+        return peer
+
+    def become_worker(self, index: int, relay=None):
+        """
+        Prepares the server to run in one of several forked worker processes listening on the same port.
+
+        Every worker listens with `SO_REUSEPORT`, so the kernel spreads incoming connections across them. The
+        primary worker (index 0) keeps the peers and queues inherited from the supervisor. Secondary workers do
+        not connect to peers: their outgoing messages are relayed to the primary worker, and they start with an
+        inbox of their own, journaled in a directory of their own.
+
+        Args:
+            index (int): The index of the worker.
+            relay (Callable, optional): The coroutine function relaying messages to the primary worker, required
+                for secondary workers.
+        """
+        self.worker_index = index
+        self.reuse_port = True
+        self.logger.source = f"{self.host}:{self.port}#{index}"
+        if index == 0:
+            return
+        for peer in self.peers:
+            peer.remove_metrics()
+            if peer.outbox.journal is not None:
+                peer.outbox.journal.close()
+        if self.received_messages.journal is not None:
+            self.received_messages.journal.close()
+        self.peers = PeerRegistry()
+        self.relay = relay
+        self.received_messages = Inbox(
+            Journal(os.path.join(self.journal_dir, f"inbox-{index}")) if self.journal_dir else None,
+            *queue_limits("INBOX"), inbox_lanes())
 
     def print(self, message):
         """
-        Logs a message with the server's host and port as a prefix.
+        Logs a message at info level with the server's host and port as a prefix.
 
         Args:
             message (str): The message to be logged.
         """
+        self.logger.info(message)
 
-        utc_time = datetime.now(timezone.utc)
-        local_time = utc_time.astimezone()
-        local_iso_time = local_time.isoformat().split('.')[0]
-        print(f"{self.host}:{self.port} [{local_iso_time}]: {message}")
-
-    @abstractmethod
     async def send_to_outbox(self, message: Message):
         """
-        Abstract method for sending a message to the outbox queue. This method must be implemented 
-        by subclasses to define specific behavior for message handling.
+        Queues a message in the outbox of every peer its destination resolves to. Messages for unknown peers
+        are dropped.
 
         Args:
             message (Message): The message object to send to the outbox.
+        """
+        if self.relay is not None:
+            await self.relay(message)
+            return
+        peers, unknown = self.peers.resolve(message.destination)
+        if unknown:
+            self.print(f"Dropping message {message.id} for unknown peers: {', '.join(map(str, unknown))}")
+        for peer in peers:
+            await peer.outbox.put(message)
+        if peers:
+            self.logger.debug("Saved message to outbox queue: %s", message.fields())
+
+    @abstractmethod
+    async def flush_outbox(self):
+        """
+        Abstract method sending the queued messages of every peer. This method must be implemented by
+        subclasses.
 
         Raises:
             NotImplementedError: If the method is not implemented in the subclass.
         """
         pass
+
+    def pending_messages(self) -> int:
+        """
+        Returns the number of messages their peers did not acknowledge yet.
+
+        Returns:
+            int: The number of messages waiting in the outboxes or in flight.
+        """
+        return sum(peer.outbox.qsize() for peer in self.peers)
+
+    async def drain_outbox(self):
+        """
+        Flushes the outboxes until every peer acknowledged its messages. Callers bound the wait with a timeout.
+        """
+        while self.pending_messages():
+            await self.flush_outbox()
+            await asyncio.sleep(0.01)
+
+    @abstractmethod
+    async def stop_listening(self):
+        """
+        Abstract method refusing new messages, so that the inbox can be drained before the agent exits. Messages
+        the peers sent and were not acknowledged stay in their outboxes. This method must be implemented by
+        subclasses.
+
+        Raises:
+            NotImplementedError: If the method is not implemented in the subclass.
+        """
+        pass
+
+    async def close(self):
+        """
+        Closes the journals of the inbox and outboxes. Transports extend it to close their connections.
+        """
+        for peer in self.peers:
+            if peer.outbox.journal is not None:
+                peer.outbox.journal.close()
+        if self.received_messages.journal is not None:
+            self.received_messages.journal.close()
@@ -0,0 +1,153 @@
+import json
+import struct
+
+from message import Message
+
+# Sent by a v2 server as soon as a connection is accepted, and echoed by a v2 client to select framing
+PROTOCOL_MAGIC = b"SAv2"
+
+# Frame header: payload length, frame type
+HEADER = struct.Struct("!IB")
+MESSAGE_ID = struct.Struct("!q")
+ACK_COUNT = struct.Struct("!Q")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# Payload: 8 byte signed message id followed by the UTF-8 message text
+FRAME_MESSAGE = 1
+# Payload: the message as a JSON object, for ids or texts the compact form cannot carry
+FRAME_JSON = 2
+# Sent back by the receiver. Payload: the number of message frames received and persisted on the connection
+FRAME_ACK = 3
+# Sent back by the receiver. Payload: the total number of message frames the receiver accepts on the connection
+FRAME_CREDIT = 4
+# Sent by the client after selecting framing, and answered by the server. Payload: the UTF-8 agent name
+FRAME_HELLO = 5
+# Health check sent by the client and answered with a PONG frame. No payload
+FRAME_PING = 6
+FRAME_PONG = 7
+# Credit granted by receivers whose inbox is unbounded
+UNLIMITED_CREDIT = 2 ** 64 - 1
+
+_ID_RANGE = range(-2 ** 63, 2 ** 63)
+
+
+def encode_frame(kind: int, payload: bytes) -> bytes:
+    """
+    Prefixes a payload with its frame header.
+
+    Args:
+        kind (int): The frame type.
+        payload (bytes): The frame payload.
+
+    Returns:
+        bytes: The frame.
+    """
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def encode_ack(count: int) -> bytes:
+    """
+    Encodes a cumulative acknowledgement frame.
+
+    Args:
+        count (int): The number of message frames received on the connection so far.
+
+    Returns:
+        bytes: The frame.
+    """
+    return encode_frame(FRAME_ACK, ACK_COUNT.pack(count))
+
+
+def encode_credit(limit: int) -> bytes:
+    """
+    Encodes a flow control frame granting the sender credit.
+
+    Args:
+        limit (int): The total number of message frames the sender may send on the connection.
+
+    Returns:
+        bytes: The frame.
+    """
+    return encode_frame(FRAME_CREDIT, ACK_COUNT.pack(limit))
+
+
+def encode_message(message: Message) -> bytes:
+    """
+    Encodes a message as a single frame, using the compact binary form whenever possible. The frame is cached
+    by the message, so a message sent to several peers or sent again is encoded once.
+
+    Args:
+        message (Message): The message to encode.
+
+    Returns:
+        bytes: The frame.
+    """
+    frame = message._frame
+    if frame is None:
+        if (type(message.id) is int and message.id in _ID_RANGE and type(message.message) is str
+                and message.priority is None):
+            frame = encode_frame(FRAME_MESSAGE, MESSAGE_ID.pack(message.id) + message.message.encode("utf-8"))
+        else:
+            frame = encode_frame(FRAME_JSON, message.to_json())
+        message._frame = frame
+    return frame
+
+
+def decode_message(kind: int, payload: bytes) -> Message:
+    """
+    Decodes the payload of a message frame.
+
+    Args:
+        kind (int): The frame type.
+        payload (bytes): The frame payload.
+
+    Returns:
+        Message: The decoded message.
+
+    Raises:
+        ValueError: If the frame type is not a message frame.
+    """
+    if kind == FRAME_MESSAGE:
+        return Message(id=MESSAGE_ID.unpack_from(payload)[0], message=payload[MESSAGE_ID.size:].decode("utf-8"))
+    if kind == FRAME_JSON:
+        return Message.from_dict(json.loads(payload))
+    raise ValueError(f"Unknown frame type {kind}")
+
+
+class FrameDecoder:
+    """
+    Incrementally splits a byte stream into frames, without scanning the payloads.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        """
+        Adds received bytes and returns every frame they complete.
+
+        Args:
+            data (bytes): Bytes read from the stream.
+
+        Returns:
+            list: (frame type, payload) tuples, in stream order.
+
+        Raises:
+            ValueError: If a frame is larger than `MAX_FRAME_SIZE`.
+        """
+        buffer = self._buffer
+        buffer += data
+        frames = []
+        offset = 0
+        size = len(buffer)
+        while size - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(buffer, offset)
+            if length > MAX_FRAME_SIZE:
+                raise ValueError(f"Frame of {length} bytes exceeds the maximum frame size")
+            end = offset + HEADER.size + length
+            if end > size:
+                break
+            frames.append((kind, bytes(buffer[offset + HEADER.size:end])))
+            offset = end
+        del buffer[:offset]
+        return frames
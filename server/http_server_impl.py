@@ -1,67 +1,280 @@
+import asyncio
 import json
-import http.server
-import socketserver
-import threading
-import requests  # For sending HTTP POST requests
+import os
+import time
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, web
+
 from message import Message
-from server.base_server import BaseServer
+from server.base_server import BaseServer, remote_sender
+from server.outbox import Outbox
+from server.peers import Peer
+
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+CREDIT_HEADER = "X-Credit"
+AGENT_NAME_HEADER = "X-Agent-Name"
+
+
+class HTTPPeer(Peer):
+    """
+    A peer messages are sent to over the pooled HTTP client.
+
+    Attributes:
+        supports_batch (bool): Whether the peer offers the batch endpoint.
+        credit (int): The number of messages the peer accepts. 0 until the peer is polled, None once the peer
+            turns out not to limit the sender.
+        retry_at (float): The monotonic time before which the peer is not contacted after a failure.
+    """
+
+    def __init__(self, name: str, host: str, port: int, outbox: Outbox):
+        super().__init__(name, host, port, outbox)
+        self.supports_batch = True
+        self.credit = 0
+        self.retry_at = 0.0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
 
 
 class HTTPServerImpl(BaseServer):
+    """
+    HTTP transport running on the agent's event loop.
+
+    The server accepts concurrent HTTP/1.1 keep-alive connections and exposes two endpoints: `POST /` takes a
+    single JSON message, and `POST /batch` takes either a JSON array of messages or an NDJSON stream with one
+    message per line. The outbox of every peer is flushed through one pooled keep-alive client, shared by all
+    peers, that sends it as NDJSON batches of up to `batch_size` messages, several batches in flight at once.
+    Peers that do not offer the batch endpoint are sent one message per request. Requests carry the agent name
+    in an `X-Agent-Name` header, which the receiver records as the sender of the messages.
+
+    A 200 response acknowledges the messages of a request: the receiver only answers once they are persisted in
+    its inbox, and the sender keeps them in its outbox until then, putting them back if the request fails. A
+    batch response lists the positions of malformed messages the receiver rejected, which are dropped. A peer
+    whose requests fail is skipped for an exponentially growing delay. At most `max_inbound` requests are served
+    at once, others are answered with 503.
+
+    When the inbox is bounded, every response carries an `X-Credit` header with the number of messages the
+    receiver can still take, and `GET /credit` returns it. The sender sends no more messages than its last known
+    credit, and polls `GET /credit` before its first flush and on each flush once the credit is used up. A full
+    inbox with the `block` policy holds requests until it drains.
+    """
+
+    peer_class = HTTPPeer
 
     def __init__(self, host, port, peer_host=None, peer_port=None):
         super().__init__(host, port, peer_host, peer_port)
+        self.batch_size = int(os.getenv("HTTP_BATCH_SIZE", 500))
+        self.pool_size = int(os.getenv("HTTP_POOL_SIZE", 8))
+        self.timeout = float(os.getenv("HTTP_TIMEOUT", 10))
+        self.max_inbound = int(os.getenv("MAX_INBOUND_CONNECTIONS", 256))
+        self.inbound = 0
+        self.app = web.Application(middlewares=[self.limit_inbound])
+        self.app.router.add_post("/", self.handle_message)
+        self.app.router.add_post("/batch", self.handle_batch)
+        self.app.router.add_get("/credit", self.handle_credit)
+        self.runner = None
+        self.session = None
 
-        # Custom HTTP server to hold a reference to the parent BaseServer
-        class CustomHTTPServer(socketserver.TCPServer):
-            def __init__(self, server_address, RequestHandlerClass, base_server):
-                super().__init__(server_address, RequestHandlerClass)
-                self.base_server = base_server
-
-        # Custom RequestHandler that interacts with BaseServer
-        class RequestHandler(http.server.BaseHTTPRequestHandler):
-            def do_POST(self):
-                try:
-                    content_length = int(self.headers['Content-Length'])
-                    post_data = self.rfile.read(content_length)
-                    message = json.loads(post_data.decode('utf-8').rstrip())
-                    # Access BaseServer through CustomHTTPServer
-                    self.server.base_server.received_messages.put(Message(**message))
-                    self.send_response(200)
-                    self.end_headers()
-                except Exception as e:
-                    self.send_error(500, f"Error receiving message: {e}")
-
-        # Use the custom HTTP server to include a reference to the parent
-        self.httpd = CustomHTTPServer((self.host, self.port), RequestHandler, self)
-
-    def start_server(self):
+    async def start_server(self):
         """Starts the server to listen for incoming connections."""
-        server_thread = threading.Thread(target=self.httpd.serve_forever)
-        server_thread.start()
+        # Requests in progress when the agent stops get as long as a client waits for them
+        self.runner = web.AppRunner(self.app, access_log=None, shutdown_timeout=self.timeout)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port, reuse_port=self.reuse_port or None).start()
         self.print(f'Server started and listening at {self.host}:{self.port}')
 
-    async def send_to_outbox(self, message: Message):
-        message_str = json.dumps(message.__dict__)
-        self.sent_messages.put(message_str)
-        self.print(f"Saved message to outbox queue: {message_str}")
+    @web.middleware
+    async def limit_inbound(self, request: web.Request, handler):
+        """Refuses requests beyond `max_inbound` concurrent requests."""
+        if self.inbound >= self.max_inbound:
+            return web.Response(status=503, text="Too many concurrent requests")
+        self.inbound += 1
+        try:
+            return await handler(request)
+        finally:
+            self.inbound -= 1
+
+    async def handle_message(self, request: web.Request) -> web.Response:
+        """Receives a single JSON message."""
+        try:
+            message = Message.from_dict(json.loads(await request.read()), self.request_sender(request))
+            await self.received_messages.writable()
+            self.received_messages.put(message)
+            self.received_total.inc()
+            await self.received_messages.sync()
+        except Exception as e:
+            return web.Response(status=400, text=f"Error receiving message: {e}")
+        return web.Response(headers=self.credit_headers())
+
+    async def handle_batch(self, request: web.Request) -> web.Response:
+        """
+        Receives a JSON array or an NDJSON stream of messages.
+
+        Every message is parsed before any is queued. Malformed messages are skipped and their positions returned
+        in `rejected`, so the sender drops them and keeps none of the valid ones back. A bounded inbox with the
+        `block` policy takes only as many messages as it has room for: `received` counts the messages taken from
+        the start of the batch, and the sender sends the rest again later.
+        """
+        try:
+            body = await request.read()
+            if request.content_type == NDJSON_CONTENT_TYPE:
+                entries = [line for line in body.splitlines() if line.strip()]
+            else:
+                entries = json.loads(body)
+                if not isinstance(entries, list):
+                    raise ValueError("expected a JSON array of messages")
+        except Exception as e:
+            return web.Response(status=400, text=f"Error receiving messages: {e}")
+        sender = self.request_sender(request)
+        await self.received_messages.writable()
+        room = self.received_messages.room()
+        messages, rejected, received = [], [], 0
+        for index, entry in enumerate(entries):
+            if room is not None and len(messages) >= room:
+                break
+            received = index + 1
+            try:
+                messages.append(Message.from_dict(json.loads(entry) if isinstance(entry, bytes) else entry, sender))
+            except Exception:
+                rejected.append(index)
+        for message in messages:
+            self.received_messages.put(message)
+        self.received_total.inc(len(messages))
+        await self.received_messages.sync()
+        return web.json_response({"received": received, "rejected": rejected}, headers=self.credit_headers())
+
+    def request_sender(self, request: web.Request) -> str:
+        """Returns the sender of the messages of a request: its `X-Agent-Name`, or its remote address."""
+        return request.headers.get(AGENT_NAME_HEADER) or remote_sender(request.remote or "unknown")
+
+    async def handle_credit(self, request: web.Request) -> web.Response:
+        """Returns the number of messages the inbox can still take, null when it is unbounded."""
+        return web.json_response({"credit": self.received_messages.free()}, headers=self.credit_headers())
+
+    def credit_headers(self) -> dict:
+        free = self.received_messages.free()
+        return {} if free is None else {CREDIT_HEADER: str(free)}
 
     async def flush_outbox(self):
-        """Sends all messages in the outbox to the peer."""
+        """Sends all messages in the outboxes of the peers, in concurrent NDJSON batches."""
+        if self.session is None:
+            self.session = ClientSession(
+                connector=TCPConnector(limit=self.pool_size),
+                timeout=ClientTimeout(total=self.timeout),
+                headers={AGENT_NAME_HEADER: self.name},
+            )
+        await asyncio.gather(*(self.flush_peer(peer) for peer in self.peers))
+
+    async def flush_peer(self, peer: HTTPPeer):
+        """Sends the messages in the outbox of a peer, as many as it has credit for."""
+        if peer.outbox.empty() or time.monotonic() < peer.retry_at:
+            return
+        if peer.credit == 0:
+            await self._poll_credit(peer)
+        remaining = peer.credit
+        if remaining == 0:
+            return
+        await peer.outbox.sync()
+        batches = []
+        while not peer.outbox.empty() and remaining != 0:
+            size = self.batch_size if remaining is None else min(self.batch_size, remaining)
+            batches.append(peer.outbox.take(size))
+            if remaining is not None:
+                remaining -= len(batches[-1])
+        if peer.credit is not None:
+            peer.credit = remaining
+        await asyncio.gather(*(self._send_batch(peer, batch) for batch in batches))
+
+    async def _poll_credit(self, peer: HTTPPeer):
         try:
-            while not self.sent_messages.empty():
-                message = self.sent_messages.get()
-                if self.peer_host and self.peer_port:
-                    url = f"http://{self.peer_host}:{self.peer_port}"
-                    response = requests.post(url, json=json.loads(message))
-                    if response.status_code == 200:
-                        self.print(f"Sent message to agent from outbox queue: {message}")
-                    else:
-                        self.print(f"Failed to send message: {message.__dict__}, error code: {response.status_code}")
+            async with self.session.get(f"{peer.url}/credit") as response:
+                # Peers without flow control do not limit the sender
+                peer.credit = (await response.json())["credit"] if response.status == 200 else None
         except Exception as e:
-            self.print(f"Failed to establish connection with server")
-            self.is_connected = False
+            self.print(f"Failed to get credit from peer {peer.name}: {e}")
+            self._peer_failed(peer)
+
+    def _update_credit(self, peer: HTTPPeer, response):
+        credit = response.headers.get(CREDIT_HEADER)
+        peer.credit = int(credit) if credit is not None else None
+
+    def _peer_failed(self, peer: HTTPPeer):
+        peer.is_connected = False
+        peer.retry_at = time.monotonic() + peer.backoff.next()
+
+    def _peer_succeeded(self, peer: HTTPPeer):
+        peer.is_connected = True
+        peer.backoff.reset()
+
+    async def _send_batch(self, peer: HTTPPeer, batch: list):
+        pending = batch
+        try:
+            if peer.supports_batch:
+                body = b"\n".join([message.to_json() for _, message in batch])
+                async with self.session.post(f"{peer.url}/batch", data=body,
+                                             headers={"Content-Type": NDJSON_CONTENT_TYPE}) as response:
+                    if response.status == 200:
+                        self._update_credit(peer, response)
+                        self._peer_succeeded(peer)
+                        result = await response.json(content_type=None)
+                        received, rejected = result.get("received", len(batch)), result.get("rejected") or []
+                        # The peer's inbox had no room for the rest, they are sent again once it grants credit
+                        peer.outbox.requeue(batch[received:])
+                        peer.outbox.ack(batch[:received])
+                        peer.sent_total.inc(received - len(rejected))
+                        for index in rejected:
+                            self.print(f"Peer {peer.name} rejected message: {batch[index][1].to_json()}")
+                        self.logger.debug("Sent %d messages to agent %s from outbox queue", received, peer.name)
+                        return
+                    if response.status not in (404, 405):
+                        self.print(f"Failed to send {len(batch)} messages to {peer.name}, error code: {response.status}")
+                        self._settle_failed(peer, batch, response.status)
+                        return
+                self.print(f"Peer {peer.name} does not support batched messages, sending one message per request")
+                peer.supports_batch = False
+            for index, entry in enumerate(batch):
+                pending = batch[index:]
+                message = entry[1].to_json()
+                async with self.session.post(peer.url, data=message,
+                                             headers={"Content-Type": "application/json"}) as response:
+                    if response.status != 200:
+                        self.print(f"Failed to send message: {message}, error code: {response.status}")
+                        self._settle_failed(peer, [entry], response.status)
+                        continue
+                    self._update_credit(peer, response)
+                peer.outbox.ack([entry])
+                peer.sent_total.inc()
+                self.logger.debug("Sent message to agent %s from outbox queue: %s", peer.name, message)
+            self._peer_succeeded(peer)
+        except Exception as e:
+            self.print(f"Failed to establish connection with server {peer.name}: {e}")
+            self._peer_failed(peer)
+            peer.outbox.requeue(pending)
+
+    def _settle_failed(self, peer: HTTPPeer, entries: list, status: int):
+        # The peer rejected the messages themselves, retrying would fail again
+        if 400 <= status < 500:
+            peer.outbox.ack(entries)
+        else:
+            self._peer_failed(peer)
+            peer.outbox.requeue(entries)
+
+    async def stop_listening(self):
+        """Stops accepting requests, waiting for the requests in progress and closing idle connections."""
+        if self.runner is not None:
+            runner, self.runner = self.runner, None
+            await runner.cleanup()
+
+    async def close(self):
+        """Closes the client connections to the peers."""
+        await self.stop_listening()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        await super().close()
 
     async def run(self):
         """Starts the server and attempts to connect to the peer."""
-        self.start_server()
+        self.received_messages.bind()
+        await self.start_server()
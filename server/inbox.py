@@ -0,0 +1,229 @@
+import asyncio
+import threading
+
+from server.journal import Journal, dump_message, load_message
+from server.lanes import PriorityLanes
+from server.overflow import OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, OVERFLOW_SPILL, SpillFile
+
+
+class Inbox:
+    """
+    An awaitable queue of received messages that wakes waiting consumers the moment a message is enqueued.
+
+    Transports running on the agent's event loop (socket mode) enqueue directly, while transports running on
+    their own threads (HTTP mode) are bridged onto the loop with `call_soon_threadsafe`, so `put` is safe to call
+    from anywhere.
+
+    With a journal, every received message is persisted until a consumer reports it processed with `task_done`,
+    and unprocessed messages are restored when the agent restarts. Transports call `sync` before acknowledging
+    messages to the peer.
+
+    A bounded inbox holds at most `capacity` messages in memory, and a message arriving while it is full is
+    handled according to the `overflow` policy: `block` accepts it but transports stop reading from the peer
+    until `writable` returns, `drop_oldest` and `drop_newest` discard a message, and `spill` appends it to a
+    `SpillFile` that refills the inbox as it drains. Transports grant peers credit for `free` more messages.
+
+    Messages are queued in `PriorityLanes`, so consumers get them by priority rather than strictly in arrival
+    order, and `drop_oldest` discards the oldest message of the lowest priority lane.
+
+    Attributes:
+        loop (AbstractEventLoop): The event loop the consumers run on, bound on first use.
+        journal (Journal): The persistent journal behind the inbox, or None to keep it in memory only.
+        capacity (int): The maximum number of queued messages, 0 for unbounded.
+        overflow (str): The overflow policy, one of `server.overflow.OVERFLOW_POLICIES`.
+        dropped (int): The number of messages discarded by the overflow policy.
+        lanes (PriorityLanes): The lanes the messages are queued in.
+    """
+
+    def __init__(self, journal: Journal = None, capacity: int = 0, overflow: str = OVERFLOW_BLOCK,
+                 lanes: PriorityLanes = None):
+        """
+        Initializes an unbound inbox, restoring the unprocessed messages of the journal.
+
+        Args:
+            journal (Journal, optional): The persistent journal. Defaults to None.
+            capacity (int, optional): The maximum number of queued messages. Defaults to 0, unbounded.
+            overflow (str, optional): The overflow policy. Defaults to `block`.
+            lanes (PriorityLanes, optional): The lanes. Defaults to a single lane, first-in first-out.
+        """
+        self.lanes = lanes or PriorityLanes()
+        self._thread_id = None
+        self._seqs = {}
+        self._space = asyncio.Event()
+        self._space.set()
+        self._unfinished = 0
+        self._finished = asyncio.Event()
+        self._finished.set()
+        self.loop = None
+        self.journal = journal
+        self.capacity = capacity
+        self.overflow = overflow
+        self.spill = SpillFile() if capacity and overflow == OVERFLOW_SPILL else None
+        self.dropped = 0
+        if journal is not None:
+            # Restored messages were accepted before the restart, they are never dropped
+            for seq, payload in journal.unacked():
+                if self.spill is not None and self.lanes.qsize() >= capacity:
+                    self.spill.append(seq, payload)
+                    continue
+                message = load_message(payload)
+                self._seqs[id(message)] = seq
+                self._queue(message)
+            self._update_space()
+
+    def bind(self, loop: asyncio.AbstractEventLoop = None):
+        """
+        Binds the inbox to the event loop its consumers run on.
+
+        Args:
+            loop (AbstractEventLoop, optional): The loop to bind to. Defaults to the running loop.
+        """
+        self.loop = loop or asyncio.get_running_loop()
+        self._thread_id = threading.get_ident()
+
+    def put(self, message):
+        """
+        Enqueues a message and wakes one waiting consumer. Safe to call from any thread.
+
+        Args:
+            message (Message): The received message.
+        """
+        if self.loop is None or threading.get_ident() == self._thread_id:
+            self._put(message)
+        else:
+            self.loop.call_soon_threadsafe(self._put, message)
+
+    def _put(self, message):
+        if self.capacity and (self.lanes.qsize() >= self.capacity or self.spill):
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                self.dropped += 1
+                return
+            if self.overflow == OVERFLOW_DROP_OLDEST:
+                self.task_done(self.lanes.evict())
+                self.dropped += 1
+            elif self.overflow == OVERFLOW_SPILL:
+                payload = dump_message(message)
+                self.spill.append(self.journal.append(payload) if self.journal is not None else None, payload)
+                self._update_space()
+                return
+        if self.journal is not None:
+            self._seqs[id(message)] = self.journal.append(dump_message(message))
+        self._queue(message)
+        self._update_space()
+
+    def _refill(self):
+        if self.spill:
+            for seq, payload in self.spill.pop(self.capacity - self.lanes.qsize()):
+                message = load_message(payload)
+                if seq is not None:
+                    self._seqs[id(message)] = seq
+                self._queue(message)
+        self._update_space()
+
+    def _queue(self, message):
+        self.lanes.put_nowait(message)
+        self._unfinished += 1
+        self._finished.clear()
+
+    def _update_space(self):
+        if self.free():
+            self._space.set()
+        else:
+            self._space.clear()
+
+    def free(self):
+        """
+        Returns the number of messages the inbox can take before it overflows.
+
+        Returns:
+            int: The free capacity, or None if the inbox is unbounded.
+        """
+        if not self.capacity:
+            return None
+        return max(self.capacity - self.qsize(), 0)
+
+    def room(self):
+        """
+        Returns the number of messages a transport may put now: the free capacity with the `block` policy, which
+        must not be overshot, and no limit with the others, which handle the overflow themselves.
+
+        Returns:
+            int: The number of messages, or None if there is no limit.
+        """
+        return self.free() if self.overflow == OVERFLOW_BLOCK else None
+
+    async def wait_for_room(self):
+        """
+        Waits until the inbox has room for at least one more message, whatever its overflow policy.
+        """
+        while self.capacity and not self.free():
+            self._space.clear()
+            await self._space.wait()
+
+    async def writable(self):
+        """
+        Waits until the inbox accepts another message without overflowing. Only the `block` policy waits, the
+        others always accept messages.
+        """
+        if self.overflow == OVERFLOW_BLOCK:
+            await self.wait_for_room()
+
+    async def sync(self):
+        """
+        Waits until every message put so far is persisted. Returns immediately without a journal.
+        """
+        if self.journal is not None:
+            await self.journal.sync()
+
+    async def get(self):
+        """
+        Waits for and returns the next message.
+
+        Returns:
+            Message: The next message of the lanes.
+        """
+        if self.loop is None:
+            self.bind()
+        message = await self.lanes.get()
+        self._refill()
+        return message
+
+    def get_nowait(self):
+        """
+        Returns the next message without waiting.
+
+        Returns:
+            Message: The next message of the lanes.
+
+        Raises:
+            asyncio.QueueEmpty: If the inbox is empty.
+        """
+        message = self.lanes.get_nowait()
+        self._refill()
+        return message
+
+    def task_done(self, message):
+        """
+        Reports a message as processed, so that it is not restored after a restart.
+
+        Args:
+            message (Message): A message returned by `get` or `get_nowait`.
+        """
+        seq = self._seqs.pop(id(message), None)
+        if seq is not None:
+            self.journal.ack(seq)
+        self._unfinished -= 1
+        if self._unfinished <= 0 and not self.spill:
+            self._finished.set()
+
+    async def join(self):
+        """
+        Waits until every queued message, spilled ones included, is reported processed with `task_done`.
+        """
+        await self._finished.wait()
+
+    def empty(self) -> bool:
+        return self.lanes.empty()
+
+    def qsize(self) -> int:
+        return self.lanes.qsize() + (len(self.spill) if self.spill is not None else 0)
@@ -0,0 +1,122 @@
+import asyncio
+import itertools
+import json
+import socket
+
+from server.framing import FrameDecoder, encode_frame
+
+# Frame types of the channel. Payloads are JSON objects
+IPC_REQUEST = 1
+IPC_RESPONSE = 2
+
+
+class IPCChannel:
+    """
+    A request/response channel between two worker processes of an agent, over one end of a socket pair.
+
+    Each side registers the methods the other side may call. `call` sends a request frame and waits for the
+    matching response frame, and requests are served concurrently, so a slow method does not hold up the
+    channel. Arguments and results must be JSON serializable.
+
+    Attributes:
+        sock (socket): This side's end of the socket pair.
+        methods (dict): The methods served to the other side, by name.
+        closed (Event): Set once the other side closed the channel.
+    """
+
+    def __init__(self, sock: socket.socket):
+        """
+        Args:
+            sock (socket): This side's end of the socket pair, created before forking the workers.
+        """
+        self.sock = sock
+        self.methods = {}
+        self._writer = None
+        self._opening = None
+        self._pending = {}
+        self._ids = itertools.count()
+        self.closed = asyncio.Event()
+
+    def register(self, name: str, method):
+        """
+        Serves a coroutine function to the other side.
+
+        Args:
+            name (str): The name the other side calls the method by.
+            method (Callable): The coroutine function.
+        """
+        self.methods[name] = method
+
+    async def start(self):
+        """
+        Starts receiving requests and responses on the event loop of this worker. Later calls wait for the first.
+        """
+        if self._opening is None:
+            self._opening = asyncio.ensure_future(self._open())
+        await self._opening
+
+    async def _open(self):
+        reader, self._writer = await asyncio.open_unix_connection(sock=self.sock)
+        asyncio.create_task(self._receive(reader))
+
+    async def call(self, method: str, *args):
+        """
+        Calls a method of the other side.
+
+        Args:
+            method (str): The name the method is registered under.
+            *args: The JSON serializable arguments.
+
+        Returns:
+            The result of the method.
+
+        Raises:
+            RuntimeError: If the method raised an exception, or the channel is closed.
+        """
+        await self.start()
+        request_id = next(self._ids)
+        result = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = result
+        self._send(IPC_REQUEST, {"id": request_id, "method": method, "args": args})
+        return await result
+
+    def _send(self, kind: int, body: dict):
+        self._writer.write(encode_frame(kind, json.dumps(body).encode("utf-8")))
+
+    async def _receive(self, reader):
+        decoder = FrameDecoder()
+        try:
+            while data := await reader.read(65536):
+                for kind, payload in decoder.feed(data):
+                    body = json.loads(payload)
+                    if kind == IPC_REQUEST:
+                        asyncio.create_task(self._serve(body))
+                    elif (result := self._pending.pop(body["id"], None)) is not None and not result.done():
+                        if "error" in body:
+                            result.set_exception(RuntimeError(body["error"]))
+                        else:
+                            result.set_result(body["result"])
+        except ConnectionError:
+            pass
+        finally:
+            for result in self._pending.values():
+                if not result.done():
+                    result.set_exception(RuntimeError("IPC channel closed"))
+            self._pending.clear()
+            self.closed.set()
+
+    def close(self):
+        """
+        Closes this side of the channel, the other side sees it closed.
+        """
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            self.sock.close()
+
+    async def _serve(self, request: dict):
+        try:
+            response = {"id": request["id"], "result": await self.methods[request["method"]](*request["args"])}
+        except Exception as e:
+            response = {"id": request["id"], "error": f"{type(e).__name__}: {e}"}
+        self._send(IPC_RESPONSE, response)
@@ -0,0 +1,283 @@
+import asyncio
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from message import Message
+
+# Record header: record type, sequence number, payload length, CRC32 of the payload
+RECORD_HEADER = struct.Struct("!BQII")
+RECORD_APPEND = 1
+RECORD_ACK = 2
+
+SEGMENT_SUFFIX = ".log"
+
+
+def dump_message(message: Message) -> bytes:
+    """
+    Encodes a message as a journal payload.
+
+    Args:
+        message (Message): The message to encode.
+
+    Returns:
+        bytes: The payload.
+    """
+    return json.dumps(message.fields()).encode("utf-8")
+
+
+def load_message(payload: bytes) -> Message:
+    """
+    Decodes a journal payload into a message.
+
+    Args:
+        payload (bytes): The payload.
+
+    Returns:
+        Message: The decoded message.
+    """
+    fields = json.loads(payload)
+    # Written by this agent, the sender was recorded by the transport that received the message
+    return Message.from_dict(fields, fields.get("sender"))
+
+
+def _fsync(fd: int):
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Journal:
+    """
+    An append-only, segmented log of queued messages, persisting a queue across restarts.
+
+    Every queued message is appended as a record with a sequence number, and an acknowledgement record is
+    appended once the message has been delivered. Appends are buffered and made durable by group commit: `sync`
+    waits for the next commit, which flushes and fsyncs every record appended so far in one go, so concurrent
+    writers share a single fsync. Segments are rolled once they exceed `segment_size` and read back through
+    `mmap`. The oldest segment is deleted once all its messages are acknowledged, or compacted by copying its
+    few remaining unacknowledged messages into the active segment.
+
+    Attributes:
+        directory (str): The directory holding the segment files.
+        segment_size (int): The size, in bytes, above which the active segment is rolled.
+        sync_interval (float): The time, in seconds, appends are collected before a group commit.
+    """
+
+    def __init__(self, directory: str, segment_size: int = None, sync_interval: float = None):
+        """
+        Opens the journal, recovering the unacknowledged messages of existing segments.
+
+        Args:
+            directory (str): The directory holding the segment files, created if needed.
+            segment_size (int, optional): Defaults to `JOURNAL_SEGMENT_SIZE`, or 16 MiB.
+            sync_interval (float, optional): Defaults to `JOURNAL_SYNC_INTERVAL`, or 5 ms.
+        """
+        self.directory = directory
+        self.segment_size = segment_size or int(os.getenv("JOURNAL_SEGMENT_SIZE", 16 * 1024 * 1024))
+        self.sync_interval = sync_interval if sync_interval is not None else float(
+            os.getenv("JOURNAL_SYNC_INTERVAL", 0.005))
+        os.makedirs(directory, exist_ok=True)
+        self._segments = []
+        self._live = {}
+        self._segment_records = {}
+        self._segment_live = {}
+        self._next_seq = 1
+        self._pending_sync = None
+        self._recover()
+        self._open_segment(self._next_seq)
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:020d}{SEGMENT_SUFFIX}")
+
+    def _recover(self):
+        segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                          if name.endswith(SEGMENT_SUFFIX))
+        acked = set()
+        for segment in segments:
+            self._segments.append(segment)
+            self._segment_records[segment] = 0
+            self._segment_live[segment] = 0
+            for kind, seq, offset, _ in self._read_segment(segment, truncate=True):
+                self._next_seq = max(self._next_seq, seq + 1)
+                if kind == RECORD_APPEND:
+                    self._segment_records[segment] += 1
+                    if seq in self._live:
+                        self._segment_live[self._live[seq][0]] -= 1
+                    self._live[seq] = (segment, offset)
+                    self._segment_live[segment] += 1
+                else:
+                    acked.add(seq)
+        for seq in acked:
+            location = self._live.pop(seq, None)
+            if location is not None:
+                self._segment_live[location[0]] -= 1
+
+    def _read_segment(self, segment: int, truncate: bool = False):
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+        if size == 0:
+            return []
+        records = []
+        with open(path, "r+b") as segment_file, mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            offset = 0
+            while offset + RECORD_HEADER.size <= size:
+                kind, seq, length, checksum = RECORD_HEADER.unpack_from(view, offset)
+                end = offset + RECORD_HEADER.size + length
+                if kind not in (RECORD_APPEND, RECORD_ACK) or end > size or \
+                        zlib.crc32(view[offset + RECORD_HEADER.size:end]) != checksum:
+                    break
+                records.append((kind, seq, offset, length))
+                offset = end
+        if truncate and offset < size:
+            # A torn write at the tail of the segment, drop it
+            with open(path, "r+b") as segment_file:
+                segment_file.truncate(offset)
+        return records
+
+    def _read_payloads(self, segment: int, offsets: list) -> list:
+        with open(self._segment_path(segment), "rb") as segment_file, \
+                mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ) as view:
+            payloads = []
+            for offset in offsets:
+                _, _, length, _ = RECORD_HEADER.unpack_from(view, offset)
+                start = offset + RECORD_HEADER.size
+                payloads.append(view[start:start + length])
+            return payloads
+
+    def _open_segment(self, segment: int):
+        if not self._segments or self._segments[-1] != segment:
+            self._segments.append(segment)
+            self._segment_records[segment] = 0
+            self._segment_live[segment] = 0
+        self._active = segment
+        self._file = open(self._segment_path(segment), "ab")
+        self._offset = self._file.tell()
+
+    def _write(self, kind: int, seq: int, payload: bytes = b"") -> int:
+        offset = self._offset
+        self._file.write(RECORD_HEADER.pack(kind, seq, len(payload), zlib.crc32(payload)))
+        self._file.write(payload)
+        self._offset += RECORD_HEADER.size + len(payload)
+        return offset
+
+    def append(self, payload: bytes) -> int:
+        """
+        Appends a message payload. The record is durable once a following `sync` returns.
+
+        Args:
+            payload (bytes): The encoded message.
+
+        Returns:
+            int: The sequence number of the record.
+        """
+        seq = self._next_seq
+        self._next_seq += 1
+        self._live[seq] = (self._active, self._write(RECORD_APPEND, seq, payload))
+        self._segment_records[self._active] += 1
+        self._segment_live[self._active] += 1
+        if self._offset >= self.segment_size:
+            self._roll()
+        return seq
+
+    def ack(self, seq: int):
+        """
+        Records that a message was delivered, so that it is not replayed.
+
+        Args:
+            seq (int): The sequence number returned by `append`.
+        """
+        location = self._live.pop(seq, None)
+        if location is None:
+            return
+        self._segment_live[location[0]] -= 1
+        self._write(RECORD_ACK, seq)
+
+    def unacked(self) -> list:
+        """
+        Reads back every message not acknowledged yet, in append order.
+
+        Returns:
+            list: (sequence number, payload) tuples.
+        """
+        self._file.flush()
+        by_segment = {}
+        for seq, (segment, offset) in sorted(self._live.items()):
+            by_segment.setdefault(segment, []).append((seq, offset))
+        records = []
+        for segment, entries in by_segment.items():
+            payloads = self._read_payloads(segment, [offset for _, offset in entries])
+            records.extend(zip((seq for seq, _ in entries), payloads))
+        records.sort(key=lambda record: record[0])
+        return records
+
+    def schedule_sync(self) -> asyncio.Future:
+        """
+        Schedules a group commit of every record appended so far, without waiting for it.
+
+        Returns:
+            Future: Resolved once the records are on disk.
+        """
+        if self._pending_sync is None:
+            loop = asyncio.get_running_loop()
+            self._pending_sync = loop.create_future()
+            loop.call_later(self.sync_interval, lambda: asyncio.ensure_future(self._commit()))
+        return self._pending_sync
+
+    async def sync(self):
+        """
+        Waits until every record appended so far is on disk. Concurrent callers share one group commit.
+        """
+        await asyncio.shield(self.schedule_sync())
+
+    async def _commit(self):
+        pending, self._pending_sync = self._pending_sync, None
+        if pending is None:
+            # Committed by `close`
+            return
+        try:
+            self._file.flush()
+            await asyncio.get_running_loop().run_in_executor(None, _fsync, os.dup(self._file.fileno()))
+            pending.set_result(None)
+        except Exception as e:
+            pending.set_exception(e)
+
+    def _roll(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        self._open_segment(self._next_seq)
+        self._compact()
+
+    def _compact(self):
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            live = self._segment_live[oldest]
+            if live and live * 2 > self._segment_records[oldest]:
+                return
+            moved = [(seq, location[1]) for seq, location in self._live.items() if location[0] == oldest]
+            payloads = self._read_payloads(oldest, [offset for _, offset in moved]) if moved else []
+            for (seq, _), payload in zip(moved, payloads):
+                self._live[seq] = (self._active, self._write(RECORD_APPEND, seq, payload))
+                self._segment_records[self._active] += 1
+                self._segment_live[self._active] += 1
+            if moved:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            self._segments.pop(0)
+            del self._segment_records[oldest], self._segment_live[oldest]
+            os.remove(self._segment_path(oldest))
+
+    def close(self):
+        """
+        Flushes and closes the active segment.
+        """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        pending, self._pending_sync = self._pending_sync, None
+        if pending is not None and not pending.done():
+            pending.set_result(None)
@@ -0,0 +1,213 @@
+import asyncio
+import os
+import time
+from collections import deque
+
+# How the next lane to serve is chosen
+SCHEDULING_WEIGHTED = "weighted"
+SCHEDULING_STRICT = "strict"
+SCHEDULING_POLICIES = (SCHEDULING_WEIGHTED, SCHEDULING_STRICT)
+
+
+def parse_lanes(spec: str) -> list:
+    """
+    Parses a lane specification of the form `name=weight,name=weight,...`, highest priority first.
+
+    Args:
+        spec (str): The specification. A lane without `=weight` has weight 1.
+
+    Returns:
+        list: The (name, weight) tuples.
+
+    Raises:
+        ValueError: If a weight is not a positive integer or a lane is declared twice.
+    """
+    lanes = []
+    for entry in (spec or "").split(","):
+        if not entry.strip():
+            continue
+        name, _, weight = entry.partition("=")
+        name = name.strip()
+        weight = int(weight) if weight.strip() else 1
+        if weight < 1 or any(name == other for other, _ in lanes):
+            raise ValueError(f"Invalid inbox lane {entry.strip()}, expected name=weight with a positive weight")
+        lanes.append((name, weight))
+    return lanes
+
+
+def inbox_lanes():
+    """
+    Creates the lanes of an inbox from the environment: `INBOX_LANES`, `INBOX_SCHEDULING` and
+    `INBOX_LANE_MAX_WAIT`.
+
+    Returns:
+        PriorityLanes: The lanes.
+
+    Raises:
+        ValueError: If the lanes or the scheduling policy are invalid.
+    """
+    scheduling = os.getenv("INBOX_SCHEDULING", SCHEDULING_WEIGHTED).lower()
+    if scheduling not in SCHEDULING_POLICIES:
+        raise ValueError(f"Unknown INBOX_SCHEDULING {scheduling}, expected one of {', '.join(SCHEDULING_POLICIES)}")
+    return PriorityLanes(parse_lanes(os.getenv("INBOX_LANES", "high=4,normal=1")), scheduling,
+                         float(os.getenv("INBOX_LANE_MAX_WAIT", 1.0)))
+
+
+class Lane:
+    """
+    A first-in first-out queue of messages of one priority.
+
+    Attributes:
+        name (str): The lane name.
+        weight (int): The share of dequeues the lane gets under weighted scheduling.
+        served (int): The number of messages dequeued from the lane.
+        max_wait (float): The longest time, in seconds, a message waited in the lane.
+    """
+
+    def __init__(self, name: str, weight: int):
+        self.name = name
+        self.weight = weight
+        self.served = 0
+        self.max_wait = 0.0
+        self.entries = deque()
+        self.current = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def pop(self):
+        enqueued_at, message = self.entries.popleft()
+        self.served += 1
+        self.max_wait = max(self.max_wait, time.monotonic() - enqueued_at)
+        return message
+
+
+class PriorityLanes:
+    """
+    The queue behind an inbox, split into lanes so that important messages are not stuck behind chatter.
+
+    A message goes into the lane named by its `priority` field, or else the lane the `classifier` picks for it,
+    or else the last (lowest priority) lane. `weighted` scheduling serves the non-empty lanes in proportion to
+    their weights, interleaved (smooth weighted round robin), so every lane keeps its share. `strict` scheduling
+    always serves the highest priority non-empty lane, except that a lower lane whose oldest message has waited
+    longer than `max_wait` is served first, so it is never starved. Each lane is first-in first-out.
+
+    Attributes:
+        lanes (list): The lanes, highest priority first.
+        scheduling (str): The scheduling policy, one of `SCHEDULING_POLICIES`.
+        max_wait (float): The wait, in seconds, after which strict scheduling serves a lower lane.
+        classifier (Callable): Takes a message and returns a lane name or None. Set it with `set_classifier`.
+    """
+
+    def __init__(self, lanes: list = None, scheduling: str = SCHEDULING_WEIGHTED, max_wait: float = 1.0):
+        """
+        Args:
+            lanes (list, optional): The (name, weight) tuples, highest priority first. Defaults to one lane.
+            scheduling (str, optional): The scheduling policy. Defaults to `weighted`.
+            max_wait (float, optional): The starvation limit of strict scheduling. Defaults to 1 second.
+        """
+        self.lanes = [Lane(name, weight) for name, weight in lanes or [("normal", 1)]]
+        self.scheduling = scheduling
+        self.max_wait = max_wait
+        self.classifier = None
+        self._by_name = {lane.name: lane for lane in self.lanes}
+        self._count = 0
+        self._nonempty = asyncio.Event()
+
+    def set_classifier(self, classifier):
+        """
+        Sets the classifier and moves the queued messages to the lanes it picks, keeping their order.
+
+        Args:
+            classifier (Callable): Takes a message and returns a lane name or None.
+        """
+        self.classifier = classifier
+        entries = sorted((entry for lane in self.lanes for entry in lane.entries), key=lambda entry: entry[0])
+        for lane in self.lanes:
+            lane.entries.clear()
+        for entry in entries:
+            self.lane_of(entry[1]).entries.append(entry)
+
+    def lane_of(self, message) -> Lane:
+        """
+        Returns the lane a message belongs to.
+
+        Args:
+            message (Message): The message.
+
+        Returns:
+            Lane: The lane named by the message's priority or the classifier, or the lowest priority lane.
+        """
+        lane = self._by_name.get(message.priority)
+        if lane is None and self.classifier is not None:
+            lane = self._by_name.get(self.classifier(message))
+        return lane if lane is not None else self.lanes[-1]
+
+    def lane(self, name: str) -> Lane:
+        return self._by_name[name]
+
+    def depths(self) -> dict:
+        """
+        Returns the number of queued messages, by lane name.
+        """
+        return {lane.name: len(lane) for lane in self.lanes}
+
+    def put_nowait(self, message):
+        self.lane_of(message).entries.append((time.monotonic(), message))
+        self._count += 1
+        self._nonempty.set()
+
+    def get_nowait(self):
+        """
+        Dequeues the next message according to the scheduling policy.
+
+        Raises:
+            asyncio.QueueEmpty: If every lane is empty.
+        """
+        if not self._count:
+            raise asyncio.QueueEmpty()
+        self._count -= 1
+        return self._next_lane().pop()
+
+    async def get(self):
+        while not self._count:
+            self._nonempty.clear()
+            await self._nonempty.wait()
+        return self.get_nowait()
+
+    def evict(self):
+        """
+        Dequeues the oldest message of the lowest priority non-empty lane, to make room for another one.
+
+        Raises:
+            asyncio.QueueEmpty: If every lane is empty.
+        """
+        for lane in reversed(self.lanes):
+            if lane.entries:
+                self._count -= 1
+                return lane.entries.popleft()[1]
+        raise asyncio.QueueEmpty()
+
+    def _next_lane(self) -> Lane:
+        ready = [lane for lane in self.lanes if lane.entries]
+        if len(ready) == 1:
+            return ready[0]
+        if self.scheduling == SCHEDULING_STRICT:
+            deadline = time.monotonic() - self.max_wait
+            starved = [lane for lane in ready[1:] if lane.entries[0][0] < deadline]
+            return min(starved, key=lambda lane: lane.entries[0][0]) if starved else ready[0]
+        total = 0
+        chosen = None
+        for lane in ready:
+            lane.current += lane.weight
+            total += lane.weight
+            if chosen is None or lane.current > chosen.current:
+                chosen = lane
+        chosen.current -= total
+        return chosen
+
+    def qsize(self) -> int:
+        return self._count
+
+    def empty(self) -> bool:
+        return not self._count
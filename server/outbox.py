@@ -0,0 +1,131 @@
+import asyncio
+from collections import deque
+
+from message import Message
+from server.journal import Journal, load_message
+from server.overflow import OVERFLOW_BLOCK, OVERFLOW_DROP_NEWEST, OVERFLOW_SPILL, SpillFile
+
+
+class Outbox:
+    """
+    The queue of messages waiting to be sent to the peer.
+
+    Transports take entries out of the outbox to send them and report back: `ack` once the peer acknowledged
+    them, or `requeue` if the delivery failed, which puts them back at the head of the outbox. With a journal,
+    every queued message is persisted until it is acknowledged, and unacknowledged messages are restored when
+    the agent restarts, giving at-least-once delivery.
+
+    A bounded outbox holds at most `capacity` messages waiting to be sent, and a message queued while it is full
+    is handled according to the `overflow` policy: `block` makes `put` wait until the transport takes messages
+    out, `drop_oldest` and `drop_newest` discard a message, and `spill` appends it to a `SpillFile` that refills
+    the outbox as it drains.
+
+    Attributes:
+        journal (Journal): The persistent journal behind the outbox, or None to keep it in memory only.
+        capacity (int): The maximum number of queued messages, 0 for unbounded.
+        overflow (str): The overflow policy, one of `server.overflow.OVERFLOW_POLICIES`.
+        dropped (int): The number of messages discarded by the overflow policy.
+    """
+
+    def __init__(self, journal: Journal = None, capacity: int = 0, overflow: str = OVERFLOW_BLOCK):
+        """
+        Initializes the outbox, restoring the unacknowledged messages of the journal.
+
+        Args:
+            journal (Journal, optional): The persistent journal. Defaults to None.
+            capacity (int, optional): The maximum number of queued messages. Defaults to 0, unbounded.
+            overflow (str, optional): The overflow policy. Defaults to `block`.
+        """
+        self.journal = journal
+        self.capacity = capacity
+        self.overflow = overflow
+        self.spill = SpillFile() if capacity and overflow == OVERFLOW_SPILL else None
+        self.dropped = 0
+        self._entries = deque()
+        self._space = asyncio.Event()
+        if journal is not None:
+            # Restored messages were accepted before the restart, they are never dropped
+            for seq, payload in journal.unacked():
+                if self.spill is not None and len(self._entries) >= capacity:
+                    self.spill.append(seq, payload)
+                else:
+                    self._entries.append((seq, load_message(payload)))
+
+    async def put(self, message: Message):
+        """
+        Queues a message. When the outbox is journaled, the message is persisted by the next group commit, which
+        `take` callers wait for with `sync` before sending.
+
+        Args:
+            message (Message): The message to send.
+        """
+        if self.capacity and self.overflow != OVERFLOW_SPILL:
+            while self.overflow == OVERFLOW_BLOCK and len(self._entries) >= self.capacity:
+                self._space.clear()
+                await self._space.wait()
+            if len(self._entries) >= self.capacity:
+                self.dropped += 1
+                if self.overflow == OVERFLOW_DROP_NEWEST:
+                    return
+                self.ack([self._entries.popleft()])
+        # Outgoing messages are persisted in their wire form, encoded once for every peer and the transport
+        payload = message.to_json() if self.journal is not None or self.spill is not None else None
+        seq = None
+        if self.journal is not None:
+            seq = self.journal.append(payload)
+            self.journal.schedule_sync()
+        if self.spill is not None and (len(self._entries) >= self.capacity or self.spill):
+            self.spill.append(seq, payload)
+        else:
+            self._entries.append((seq, message))
+
+    async def sync(self):
+        """
+        Waits until every queued message is persisted. Returns immediately without a journal.
+        """
+        if self.journal is not None:
+            await self.journal.sync()
+
+    def take(self, limit: int = None) -> list:
+        """
+        Removes entries from the head of the outbox for sending.
+
+        Args:
+            limit (int, optional): The maximum number of entries. Defaults to every queued entry.
+
+        Returns:
+            list: (sequence number, Message) entries, to be passed back to `ack` or `requeue`.
+        """
+        count = len(self._entries) if limit is None else min(limit, len(self._entries))
+        entries = [self._entries.popleft() for _ in range(count)]
+        if self.spill:
+            for seq, payload in self.spill.pop(self.capacity - len(self._entries)):
+                self._entries.append((seq, load_message(payload)))
+        self._space.set()
+        return entries
+
+    def ack(self, entries: list):
+        """
+        Marks entries as delivered.
+
+        Args:
+            entries (list): Entries returned by `take`.
+        """
+        if self.journal is not None:
+            for seq, _ in entries:
+                self.journal.ack(seq)
+
+    def requeue(self, entries: list):
+        """
+        Puts entries whose delivery failed back at the head of the outbox, in their original order.
+
+        Args:
+            entries (list): Entries returned by `take`.
+        """
+        self._entries.extendleft(reversed(entries))
+
+    def empty(self) -> bool:
+        return not self._entries
+
+    def qsize(self) -> int:
+        return len(self._entries) + (len(self.spill) if self.spill is not None else 0)
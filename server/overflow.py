@@ -0,0 +1,99 @@
+import os
+import struct
+import tempfile
+
+# What a bounded queue does with a message that arrives while it is full
+OVERFLOW_BLOCK = "block"
+OVERFLOW_DROP_OLDEST = "drop_oldest"
+OVERFLOW_DROP_NEWEST = "drop_newest"
+OVERFLOW_SPILL = "spill"
+OVERFLOW_POLICIES = (OVERFLOW_BLOCK, OVERFLOW_DROP_OLDEST, OVERFLOW_DROP_NEWEST, OVERFLOW_SPILL)
+
+# Spill record header: journal sequence number (-1 for none), payload length
+SPILL_HEADER = struct.Struct("!qI")
+
+
+def queue_limits(name: str) -> tuple:
+    """
+    Reads the capacity and overflow policy of a queue from the environment.
+
+    Args:
+        name (str): The queue name, `INBOX` or `OUTBOX`, prefixing the `_CAPACITY` and `_OVERFLOW` variables.
+
+    Returns:
+        tuple: The capacity (0 for unbounded) and the overflow policy.
+
+    Raises:
+        ValueError: If the overflow policy is unknown.
+    """
+    capacity = int(os.getenv(f"{name}_CAPACITY", 10000))
+    overflow = os.getenv(f"{name}_OVERFLOW", OVERFLOW_BLOCK).lower()
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError(f"Unknown {name}_OVERFLOW policy {overflow}, expected one of {', '.join(OVERFLOW_POLICIES)}")
+    return capacity, overflow
+
+
+class SpillFile:
+    """
+    A first-in first-out file of messages that did not fit in a full queue.
+
+    The file is anonymous and removed when closed: spilled messages only extend the memory of a queue, those of
+    a journaled queue are restored from its journal after a restart. Records are appended at the end and read
+    from a cursor, and the file is truncated whenever the cursor catches up.
+
+    Attributes:
+        directory (str): The directory the file is created in, `SPILL_DIR` or the system temporary directory.
+    """
+
+    def __init__(self, directory: str = None):
+        """
+        Creates the spill file.
+
+        Args:
+            directory (str, optional): Defaults to `SPILL_DIR`, or the system temporary directory.
+        """
+        self.directory = directory or os.getenv("SPILL_DIR") or None
+        self._file = tempfile.TemporaryFile(dir=self.directory)
+        self._read_offset = 0
+        self._count = 0
+
+    def append(self, seq, payload: bytes):
+        """
+        Adds a message at the end of the file.
+
+        Args:
+            seq (int): The journal sequence number of the message, or None.
+            payload (bytes): The encoded message.
+        """
+        self._file.seek(0, os.SEEK_END)
+        self._file.write(SPILL_HEADER.pack(-1 if seq is None else seq, len(payload)) + payload)
+        self._count += 1
+
+    def pop(self, count: int) -> list:
+        """
+        Removes messages from the head of the file.
+
+        Args:
+            count (int): The maximum number of messages.
+
+        Returns:
+            list: (sequence number, payload) tuples, oldest first.
+        """
+        records = []
+        self._file.seek(self._read_offset)
+        while self._count and len(records) < count:
+            seq, length = SPILL_HEADER.unpack(self._file.read(SPILL_HEADER.size))
+            records.append((None if seq < 0 else seq, self._file.read(length)))
+            self._count -= 1
+        self._read_offset = self._file.tell()
+        if not self._count:
+            self._file.seek(0)
+            self._file.truncate()
+            self._read_offset = 0
+        return records
+
+    def close(self):
+        self._file.close()
+
+    def __len__(self) -> int:
+        return self._count
@@ -0,0 +1,155 @@
+import os
+import random
+
+from helpers.metrics import metrics
+from server.outbox import Outbox
+
+# Destination of messages sent to every registered peer
+BROADCAST = "*"
+# Name of the peer configured with OUTBOX_HOST and OUTBOX_PORT
+DEFAULT_PEER = "outbox"
+
+
+def parse_peers(spec: str) -> list:
+    """
+    Parses a peer list of the form `name=host:port,name=host:port`.
+
+    Args:
+        spec (str): The peer list, usually the `PEERS` environment variable.
+
+    Returns:
+        list: (name, host, port) tuples.
+
+    Raises:
+        ValueError: If an entry is malformed.
+    """
+    peers = []
+    for entry in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, sep, address = entry.partition("=")
+        host, _, port = address.rpartition(":")
+        if not sep or not name or not host or not port.isdigit():
+            raise ValueError(f"Invalid peer {entry}, expected name=host:port")
+        peers.append((name.strip(), host.strip(), int(port)))
+    return peers
+
+
+class Backoff:
+    """
+    Exponentially growing, jittered delays between reconnection attempts.
+
+    Attributes:
+        initial (float): The delay, in seconds, before the first retry.
+        maximum (float): The upper bound of the delay, in seconds.
+        attempts (int): The number of failed attempts since the last reset.
+    """
+
+    def __init__(self, initial: float = None, maximum: float = None):
+        """
+        Args:
+            initial (float, optional): Defaults to `PEER_RETRY_MIN`, or 0.5 seconds.
+            maximum (float, optional): Defaults to `PEER_RETRY_MAX`, or 30 seconds.
+        """
+        self.initial = initial or float(os.getenv("PEER_RETRY_MIN", 0.5))
+        self.maximum = maximum or float(os.getenv("PEER_RETRY_MAX", 30))
+        self.attempts = 0
+
+    def next(self) -> float:
+        """
+        Records a failed attempt.
+
+        Returns:
+            float: The delay before the next attempt, between half and all of the exponential bound.
+        """
+        bound = min(self.maximum, self.initial * 2 ** self.attempts)
+        self.attempts += 1
+        return random.uniform(bound / 2, bound)
+
+    def reset(self):
+        self.attempts = 0
+
+
+class Peer:
+    """
+    A remote agent messages are sent to, with its own outbox.
+
+    Transports subclass it to keep the state of their connection to the peer.
+
+    Attributes:
+        name (str): The name the peer is addressed by in message destinations.
+        host (str): The host address of the peer's server.
+        port (int): The port number of the peer's server.
+        outbox (Outbox): The messages waiting to be sent to the peer.
+        is_connected (bool): Whether the last connection attempt or delivery to the peer succeeded.
+        backoff (Backoff): The delays between reconnection attempts.
+        sent_total (Counter): The number of messages the peer acknowledged, `agent_messages_sent_total{peer=...}`.
+    """
+
+    def __init__(self, name: str, host: str, port: int, outbox: Outbox):
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.outbox = outbox
+        self.is_connected = False
+        self.backoff = Backoff()
+        self.sent_total = metrics.counter("agent_messages_sent_total", "Messages delivered to the peer", peer=name)
+        metrics.gauge("agent_outbox_depth", "Messages waiting in the outbox of the peer", outbox.qsize, peer=name)
+        metrics.gauge("agent_outbox_dropped", "Messages dropped by the overflow policy of the outbox",
+                      lambda: outbox.dropped, peer=name)
+        metrics.gauge("agent_peer_connected", "Whether the peer is connected", lambda: int(self.is_connected),
+                      peer=name)
+
+    def remove_metrics(self):
+        """
+        Removes the metrics of the peer, once it is no longer served by this process.
+        """
+        for name in ("agent_messages_sent_total", "agent_outbox_depth", "agent_outbox_dropped", "agent_peer_connected"):
+            metrics.unregister(name, peer=self.name)
+
+    def __repr__(self):
+        return f"{self.name}={self.host}:{self.port}"
+
+
+class PeerRegistry:
+    """
+    The peers of an agent, resolving message destinations to the peers they are sent to.
+
+    A destination is either a peer name (unicast), a list of peer names (multicast), or `BROADCAST` or None to
+    send to every peer.
+    """
+
+    def __init__(self):
+        self._peers = {}
+
+    def add(self, peer: Peer):
+        """
+        Registers a peer, replacing any peer with the same name.
+
+        Args:
+            peer (Peer): The peer.
+        """
+        self._peers[peer.name] = peer
+
+    def get(self, name: str) -> Peer | None:
+        return self._peers.get(name)
+
+    def resolve(self, destination) -> tuple:
+        """
+        Finds the peers a message is sent to.
+
+        Args:
+            destination (str | list): The message destination.
+
+        Returns:
+            tuple: The list of peers and the list of names that matched no peer.
+        """
+        if destination is None or destination == BROADCAST:
+            return list(self._peers.values()), []
+        names = [destination] if isinstance(destination, str) else list(dict.fromkeys(destination))
+        peers = [self._peers[name] for name in names if name in self._peers]
+        return peers, [name for name in names if name not in self._peers]
+
+    def __iter__(self):
+        return iter(list(self._peers.values()))
+
+    def __len__(self) -> int:
+        return len(self._peers)
@@ -1,82 +1,392 @@
 import asyncio
 import json
+import os
+import time
+from collections import deque
 
+from helpers.logger import DEBUG
 from message import Message
-from server.base_server import BaseServer
+from server.base_server import BaseServer, remote_sender
+from server.framing import (ACK_COUNT, FRAME_ACK, FRAME_CREDIT, FRAME_HELLO, FRAME_PING, FRAME_PONG, PROTOCOL_MAGIC,
+                            UNLIMITED_CREDIT, FrameDecoder, decode_message, encode_ack, encode_credit, encode_frame,
+                            encode_message)
+from server.outbox import Outbox
+from server.peers import Peer
+
+PROTOCOL_NDJSON = 1
+PROTOCOL_FRAMED = 2
+
+
+class SocketPeer(Peer):
+    """
+    A peer messages are sent to over one persistent socket connection.
+
+    Attributes:
+        reader (StreamReader): The reading side of the connection.
+        writer (StreamWriter): The writing side of the connection.
+        protocol (int): The wire protocol negotiated on the connection.
+        in_flight (deque): Outbox entries written to the connection and not acknowledged yet.
+        acked (int): The number of messages the peer acknowledged on the connection.
+        sent (int): The number of messages written to the connection.
+        credit (int): The number of messages the peer accepts on the connection, None until it grants credit.
+        credit_blocked (bool): Whether messages are waiting for more credit.
+        supports_ping (bool): Whether the peer answers health checks.
+        last_seen (float): The monotonic time data was last received from the peer.
+        connect_task (Task): The task connecting to the peer.
+    """
+
+    def __init__(self, name: str, host: str, port: int, outbox: Outbox):
+        super().__init__(name, host, port, outbox)
+        self.reader = None
+        self.writer = None
+        self.protocol = PROTOCOL_NDJSON
+        self.in_flight = deque()
+        self.acked = 0
+        self.sent = 0
+        self.credit = None
+        self.credit_blocked = False
+        self.supports_ping = False
+        self.last_seen = 0.0
+        self.connect_task = None
 
 
 class SocketServerImpl(BaseServer):
+    """
+    Raw socket transport.
+
+    Two wire protocols are supported. Protocol 2 sends length-prefixed binary frames (see `server.framing`);
+    protocol 1 sends one JSON text line per message. A v2 server greets every accepted connection with
+    `PROTOCOL_MAGIC`, and a v2 client answers with the same bytes to switch the connection to frames. Older
+    peers never send or answer the greeting, so both sides fall back to NDJSON.
+
+    In protocol 2 the receiver acknowledges messages with cumulative ACK frames once they are persisted in its
+    inbox. Sent messages stay in flight until acknowledged and are put back in the outbox if the connection is
+    lost, then resent after reconnecting. Protocol 1 peers cannot acknowledge, so a message counts as delivered
+    once it is written.
+
+    Protocol 2 is also credit based: the receiver sends CREDIT frames with the total number of messages it
+    accepts on the connection, starting with the free capacity of its inbox and raised as the inbox drains, and
+    the sender keeps messages in its outbox while it has no credit left. Peers that grant no credit within the
+    negotiation timeout are not limited. A full inbox with the `block` policy stops reading from the connection,
+    which holds back peers of either protocol.
+
+    The server keeps one persistent connection to every peer, reconnecting with exponential backoff, and
+    exchanges HELLO frames with the agent names so received messages carry their sender. Peers that answer
+    HELLO are pinged every `health_interval` seconds, and a connection is dropped and reestablished when the peer
+    stays silent for three intervals. At most `max_inbound` connections from peers are served at once.
+    """
+
+    peer_class = SocketPeer
 
     def __init__(self, host, port, peer_host=None, peer_port=None):
         super().__init__(host, port, peer_host, peer_port)
         self.server = None
-        self.reader = None
-        self.writer = None
+        self.negotiation_timeout = float(os.getenv("SOCKET_NEGOTIATION_TIMEOUT", 1))
+        self.health_interval = float(os.getenv("PEER_HEALTH_INTERVAL", 10))
+        self.max_inbound = int(os.getenv("MAX_INBOUND_CONNECTIONS", 256))
+        self.inbound = set()
+        self.health_task = None
+        self.closing = False
 
     async def start_server(self):
         """Starts the server to listen for incoming connections."""
-        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.server = await asyncio.start_server(self.handle_connection, self.host, self.port,
+                                                 reuse_port=self.reuse_port or None)
         addr = self.server.sockets[0].getsockname()
         self.print(f'Server started and listening at {addr}')
 
     async def handle_connection(self, reader, writer):
-        """Handles incoming connections."""
+        """Handles incoming connections, refusing them beyond `max_inbound` concurrent connections."""
+        if len(self.inbound) >= self.max_inbound:
+            self.print(f"Refusing connection from {writer.get_extra_info('peername')}, "
+                       f"{len(self.inbound)} inbound connections open")
+            writer.close()
+            return
         self.print("Connection established to the outbox agent")
-        # self.reader = reader
-        # self.writer = writer
-        asyncio.create_task(self.receive_message(reader))
+        self.inbound.add(writer)
+        writer.write(PROTOCOL_MAGIC)
+        task = asyncio.create_task(self.receive_message(reader, writer))
+        task.add_done_callback(lambda _: self.close_inbound(writer))
+
+    def close_inbound(self, writer):
+        self.inbound.discard(writer)
+        writer.close()
+
+    async def connect_to_peer(self, peer: SocketPeer):
+        """Connects to a peer as a client, retrying with exponential backoff."""
+        while True:
+            writer = None
+            try:
+                peer.reader, writer = await asyncio.open_connection(peer.host, peer.port)
+                peer.writer = writer
+                peer.protocol = await self.negotiate_protocol(peer)
+                self.print(f"Connected to peer {peer.name} at {peer.host}:{peer.port} using protocol {peer.protocol}")
+                peer.in_flight.clear()
+                peer.acked = 0
+                peer.sent = 0
+                peer.credit = None
+                peer.credit_blocked = False
+                peer.supports_ping = False
+                peer.last_seen = time.monotonic()
+                if peer.protocol == PROTOCOL_FRAMED:
+                    peer.writer.write(encode_frame(FRAME_HELLO, self.name.encode("utf-8")))
+                    asyncio.create_task(self.receive_acks(peer, peer.reader))
+                    asyncio.get_running_loop().call_later(
+                        self.negotiation_timeout, self.assume_unlimited_credit, peer, peer.writer)
+                peer.backoff.reset()
+                peer.is_connected = True
+                return
+            except Exception as e:
+                if writer is not None:
+                    # Connected but the handshake failed, do not leak the socket while retrying
+                    try:
+                        writer.close()
+                        await writer.wait_closed()
+                    except Exception:
+                        pass
+                delay = peer.backoff.next()
+                self.print(
+                    f"Could not connect to outbox agent {peer.name} at {peer.host}:{peer.port} ({e}), Make sure outbox agent is up and running. Retrying after {delay:.1f} seconds...")
+                await asyncio.sleep(delay)
+
+    async def negotiate_protocol(self, peer: SocketPeer) -> int:
+        """Waits for the peer's greeting and selects the framed protocol if the peer supports it."""
+        try:
+            greeting = await asyncio.wait_for(peer.reader.readexactly(len(PROTOCOL_MAGIC)), self.negotiation_timeout)
+        except asyncio.TimeoutError:
+            return PROTOCOL_NDJSON
+        if greeting != PROTOCOL_MAGIC:
+            return PROTOCOL_NDJSON
+        peer.writer.write(PROTOCOL_MAGIC)
+        await peer.writer.drain()
+        return PROTOCOL_FRAMED
 
-    async def connect_to_peer(self):
-        """Connects to the peer server as a client."""
-        if self.peer_host and self.peer_port:
+    async def receive_acks(self, peer: SocketPeer, reader):
+        """Releases in-flight messages as the peer acknowledges them, and tracks the credit it grants."""
+        decoder = FrameDecoder()
+        try:
             while True:
-                try:
-                    self.reader, self.writer = await asyncio.open_connection(self.peer_host, self.peer_port)
-                    self.print(f"Connected to peer at {self.peer_host}:{self.peer_port}")
-                    self.is_connected = True
-                    return
-                except Exception as e:
-                    self.print(
-                        f"Could not connect to outbox agent at {self.peer_host}:{self.peer_port}, Make sure outbox agent is up and running. Retrying after 5 seconds...")
-                    await asyncio.sleep(5)
-
-    async def receive_message(self, reader):
+                data = await reader.read(65536)
+                if not data:
+                    break
+                peer.last_seen = time.monotonic()
+                for kind, payload in decoder.feed(data):
+                    if kind == FRAME_CREDIT:
+                        peer.credit = ACK_COUNT.unpack(payload)[0]
+                    elif kind == FRAME_ACK:
+                        count = ACK_COUNT.unpack(payload)[0]
+                        delivered = [peer.in_flight.popleft() for _ in range(min(count - peer.acked, len(peer.in_flight)))]
+                        peer.acked = count
+                        peer.outbox.ack(delivered)
+                        peer.sent_total.inc(len(delivered))
+                    elif kind == FRAME_HELLO:
+                        peer.supports_ping = True
+                if peer.credit_blocked and peer.credit is not None and peer.credit > peer.sent:
+                    peer.credit_blocked = False
+                    asyncio.create_task(self.flush_peer(peer))
+        except Exception as e:
+            self.print(f"Error receiving acknowledgements from {peer.name}: {e}")
+        if reader is peer.reader:
+            self.connection_lost(peer)
+
+    def assume_unlimited_credit(self, peer: SocketPeer, writer):
+        """Stops waiting for the first credit of a peer that does not implement flow control."""
+        if writer is peer.writer and peer.credit is None:
+            peer.credit = UNLIMITED_CREDIT
+            if peer.credit_blocked:
+                peer.credit_blocked = False
+                asyncio.create_task(self.flush_peer(peer))
+
+    def connection_lost(self, peer: SocketPeer):
+        """Puts unacknowledged messages back in the peer's outbox and reconnects to it."""
+        if not peer.is_connected or self.closing:
+            return
+        peer.is_connected = False
+        peer.outbox.requeue(list(peer.in_flight))
+        peer.in_flight.clear()
+        if peer.writer is not None:
+            peer.writer.close()
+        self.print(f"Connection to peer {peer.name} lost, {peer.outbox.qsize()} messages waiting in the outbox")
+        if peer.connect_task is None or peer.connect_task.done():
+            peer.connect_task = asyncio.create_task(self.connect_to_peer(peer))
+
+    async def check_health(self):
+        """Pings connected peers and drops the connections of peers that stopped answering."""
+        while True:
+            await asyncio.sleep(self.health_interval)
+            now = time.monotonic()
+            for peer in self.peers:
+                if not (peer.is_connected and peer.supports_ping):
+                    continue
+                if now - peer.last_seen > 3 * self.health_interval:
+                    self.print(f"Peer {peer.name} stopped answering health checks")
+                    self.connection_lost(peer)
+                else:
+                    peer.writer.write(encode_frame(FRAME_PING, b""))
+
+    async def receive_message(self, reader, writer):
         """Continuously receives messages from a connected peer."""
+        try:
+            head = await reader.readexactly(len(PROTOCOL_MAGIC))
+        except asyncio.IncompleteReadError:
+            self.print("Connection closed by peer.")
+            return
+        peername = writer.get_extra_info("peername")
+        sender = remote_sender(peername[0] if peername else "unknown")
+        if head == PROTOCOL_MAGIC:
+            await self.receive_frames(reader, writer, sender)
+        else:
+            await self.receive_lines(reader, head, sender)
+
+    async def receive_frames(self, reader, writer, sender: str):
+        """
+        Receives length-prefixed message frames until the peer disconnects, acknowledging each read. Messages are
+        attributed to the name in the peer's HELLO frame, or to `sender` until it arrives.
+        """
+        decoder = FrameDecoder()
+        received = 0
+        granted = self.grant_credit(writer, received, -1)
         while True:
             try:
-                data = await reader.readline()
+                if received >= granted:
+                    # The sender is out of credit until the inbox drains
+                    await self.received_messages.wait_for_room()
+                else:
+                    await self.received_messages.writable()
+                granted = self.grant_credit(writer, received, granted)
+                data = await reader.read(65536)
                 if not data:
                     self.print("Connection closed by peer.")
                     break
-                message = json.loads(data.decode('utf-8').rstrip())
-                self.print(f"Received message: {message}")
-                self.received_messages.put(Message(**message))
+                count = 0
+                for kind, payload in decoder.feed(data):
+                    if kind == FRAME_PING:
+                        writer.write(encode_frame(FRAME_PONG, b""))
+                        continue
+                    if kind == FRAME_HELLO:
+                        sender = payload.decode("utf-8")
+                        writer.write(encode_frame(FRAME_HELLO, self.name.encode("utf-8")))
+                        continue
+                    message = decode_message(kind, payload)
+                    message.sender = sender
+                    self.logger.debug("Received message: %s", message.fields())
+                    self.received_messages.put(message)
+                    count += 1
+                if count:
+                    received += count
+                    self.received_total.inc(count)
+                    await self.received_messages.sync()
+                    writer.write(encode_ack(received))
             except Exception as e:
                 self.print(f"Error receiving message: {e}")
                 break
 
-    async def send_to_outbox(self, message: Message):
-        message_str = json.dumps(message.__dict__)
-        self.sent_messages.put(message_str)
-        self.print(f"Saved message to outbox queue: {message_str}")
+    def grant_credit(self, writer, received: int, granted: int) -> int:
+        """
+        Raises the credit of a connection to the free capacity of the inbox.
+
+        Args:
+            writer (StreamWriter): The connection to the sender.
+            received (int): The number of messages received on the connection.
+            granted (int): The credit granted so far.
+
+        Returns:
+            int: The credit granted now.
+        """
+        free = self.received_messages.free()
+        limit = UNLIMITED_CREDIT if free is None else received + free
+        if limit <= granted:
+            return granted
+        writer.write(encode_credit(limit))
+        return limit
+
+    async def receive_lines(self, reader, head: bytes = b"", sender: str = None):
+        """Receives one JSON message per line until the peer disconnects, attributing them to `sender`."""
+        while True:
+            try:
+                await self.received_messages.writable()
+                data = head + await reader.readline()
+                head = b""
+                if not data:
+                    self.print("Connection closed by peer.")
+                    break
+                message = Message.from_dict(json.loads(data), sender)
+                self.logger.debug("Received message: %s", message.fields())
+                self.received_messages.put(message)
+                self.received_total.inc()
+            except Exception as e:
+                self.print(f"Error receiving message: {e}")
+                break
 
     async def flush_outbox(self):
-        """Continuously sends messages to the peer."""
-        if not self.is_connected:
+        """Sends the queued messages of every connected peer."""
+        await asyncio.gather(*(self.flush_peer(peer) for peer in self.peers))
+
+    async def flush_peer(self, peer: SocketPeer):
+        """Sends every queued message the peer has credit for in a single write."""
+        if not peer.is_connected or peer.outbox.empty():
             return
 
+        await peer.outbox.sync()
+        limit = None
+        if peer.protocol == PROTOCOL_FRAMED:
+            limit = peer.credit - peer.sent if peer.credit is not None else 0
+            if limit <= 0:
+                peer.credit_blocked = True
+                return
+        entries = peer.outbox.take(limit)
+        if limit is not None and not peer.outbox.empty():
+            peer.credit_blocked = True
         try:
-            while not self.sent_messages.empty():
-                message = self.sent_messages.get()
-                self.writer.write((message + "\n").encode('utf-8'))
-                await self.writer.drain()
-                self.print(f"Sent message to agent from outbox queue: {message}")
+            if peer.protocol == PROTOCOL_FRAMED:
+                peer.sent += len(entries)
+                peer.in_flight.extend(entries)
+                peer.writer.writelines([encode_message(message) for _, message in entries])
+            else:
+                peer.writer.writelines([part for _, message in entries for part in (message.to_json(), b"\n")])
+            await peer.writer.drain()
+            if peer.protocol != PROTOCOL_FRAMED:
+                peer.outbox.ack(entries)
+                peer.sent_total.inc(len(entries))
+            if self.logger.enabled(DEBUG):
+                for _, message in entries:
+                    self.logger.debug("Sent message to agent %s from outbox queue: %s", peer.name, message.fields())
         except Exception as e:
-            self.print(f"Error sending message: {e}")
-            self.is_connected = False
+            self.print(f"Error sending message to {peer.name}: {e}")
+            if peer.protocol != PROTOCOL_FRAMED:
+                peer.outbox.requeue(entries)
+            self.connection_lost(peer)
+
+    def pending_messages(self) -> int:
+        """Returns the number of messages waiting in the outboxes or written and not acknowledged yet."""
+        return sum(peer.outbox.qsize() + len(peer.in_flight) for peer in self.peers)
+
+    async def stop_listening(self):
+        """Stops accepting connections and closes the inbound ones."""
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.inbound):
+            writer.close()
+
+    async def close(self):
+        """Closes the connections to the peers, putting unacknowledged messages back in their outboxes."""
+        self.closing = True
+        if self.health_task is not None:
+            self.health_task.cancel()
+        for peer in self.peers:
+            if peer.connect_task is not None:
+                peer.connect_task.cancel()
+            peer.outbox.requeue(list(peer.in_flight))
+            peer.in_flight.clear()
+            peer.is_connected = False
+            if peer.writer is not None:
+                peer.writer.close()
+        await super().close()
 
     async def run(self):
-        """Starts the server and attempts to connect to the peer."""
+        """Starts the server and connects to every peer in the background."""
+        self.received_messages.bind()
         await self.start_server()
-        if self.peer_host and self.peer_port:
-            await self.connect_to_peer()
+        for peer in self.peers:
+            peer.connect_task = asyncio.create_task(self.connect_to_peer(peer))
+        self.health_task = asyncio.create_task(self.check_health())
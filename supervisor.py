@@ -0,0 +1,95 @@
+import os
+import signal
+import socket
+import sys
+import traceback
+
+from helpers.logger import flush_logs
+
+
+class Supervisor:
+    """
+    Runs an agent in several forked worker processes sharing its listening port.
+
+    The agent is forked once it is fully configured, so every worker inherits its own copy of the registered
+    handlers and behaviours and runs them on its own event loop. Worker 0 is the primary worker: it owns the
+    peer connections, the account's nonces and the singleton behaviours. Every secondary worker is connected to
+    the primary worker by a socket pair created before forking, over which it relays its outgoing messages and
+    transfers.
+
+    The supervisor forwards SIGINT and SIGTERM to the workers, which drain their messages and exit. When a
+    worker exits, the others are stopped and the supervisor exits with the worker's status, leaving restarts to
+    the process manager running the agent.
+
+    Attributes:
+        agent (AutonomousAgent): The configured agent to run in every worker.
+        workers (int): The number of worker processes.
+        pids (dict): The worker indexes, by process id.
+    """
+
+    def __init__(self, agent, workers: int):
+        """
+        Args:
+            agent (AutonomousAgent): The configured agent to run in every worker.
+            workers (int): The number of worker processes.
+        """
+        self.agent = agent
+        self.workers = workers
+        self.pids = {}
+
+    def run(self):
+        """
+        Forks the workers and waits until one of them exits.
+        """
+        pairs = [socket.socketpair() for _ in range(1, self.workers)]
+        for index in range(self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self._run_worker(index, pairs)
+            self.pids[pid] = index
+        for primary_end, worker_end in pairs:
+            primary_end.close()
+            worker_end.close()
+        self.agent.print(f"Started {self.workers} workers: {', '.join(map(str, self.pids))}")
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: self._stop(signum))
+        try:
+            pid, status = os.wait()
+        except KeyboardInterrupt:
+            self._stop(signal.SIGINT)
+            pid, status = os.wait()
+        code = os.waitstatus_to_exitcode(status)
+        self.agent.print(f"Worker {self.pids.pop(pid)} exited with status {code}, stopping the other workers")
+        self._stop(signal.SIGTERM)
+        for pid in list(self.pids):
+            os.waitpid(pid, 0)
+        sys.exit(code)
+
+    def _stop(self, signum: int):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def _run_worker(self, index: int, pairs: list):
+        if index == 0:
+            sockets = [primary_end for primary_end, _ in pairs]
+        else:
+            sockets = [pairs[index - 1][1]]
+        for pair in pairs:
+            for end in pair:
+                if end not in sockets:
+                    end.close()
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            self.agent.run_worker(index, sockets)
+        except KeyboardInterrupt:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            flush_logs()
+            os._exit(code)
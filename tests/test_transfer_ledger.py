@@ -0,0 +1,124 @@
+import asyncio
+import os
+
+from helpers.transfer_ledger import (INDEX_NAME, LOG_NAME, MERGING_LOG_NAME, RECORD, STATE_CONFIRMED, STATE_FAILED,
+                                     STATE_PENDING, STATE_SENT, TransferLedger, transfer_key)
+
+
+def tx_hash(i: int) -> str:
+    return "0x" + f"{i + 1:064x}"
+
+
+def test_restart_replays_the_log(tmp_path):
+    async def run():
+        ledger = TransferLedger(str(tmp_path))
+        assert ledger.claim(transfer_key("alice", 1)) is None
+        assert ledger.claim(transfer_key("alice", 2)) is None
+        ledger.record(transfer_key("alice", 2), STATE_SENT, tx_hash(2))
+        await ledger.sync()
+        await ledger.close()
+
+        ledger = TransferLedger(str(tmp_path))
+        assert ledger.get(transfer_key("alice", 1)) == (STATE_PENDING, None)
+        assert ledger.get(transfer_key("alice", 2)) == (STATE_SENT, tx_hash(2))
+        # A message delivered again after the restart is not paid twice
+        assert ledger.claim(transfer_key("alice", 2)) == (STATE_SENT, tx_hash(2))
+        assert ledger.get(transfer_key("bob", 2)) is None
+        await ledger.close()
+
+    asyncio.run(run())
+
+
+def test_restart_drops_a_torn_record(tmp_path):
+    async def run():
+        ledger = TransferLedger(str(tmp_path))
+        ledger.claim(transfer_key("alice", 1))
+        await ledger.close()
+        with open(tmp_path / LOG_NAME, "ab") as log:
+            log.write(b"\x01" * (RECORD.size // 2))
+
+        ledger = TransferLedger(str(tmp_path))
+        assert ledger.get(transfer_key("alice", 1)) == (STATE_PENDING, None)
+        assert os.path.getsize(tmp_path / LOG_NAME) == RECORD.size
+        await ledger.close()
+
+    asyncio.run(run())
+
+
+def test_failed_transfer_can_be_claimed_again(tmp_path):
+    async def run():
+        key = transfer_key("alice", 1)
+        ledger = TransferLedger(str(tmp_path))
+        assert ledger.claim(key) is None
+        ledger.record(key, STATE_FAILED)
+        assert ledger.claim(key) is None
+        ledger.record(key, STATE_FAILED)
+        await ledger.close()
+
+        ledger = TransferLedger(str(tmp_path))
+        assert ledger.get(key) == (STATE_FAILED, None)
+        assert ledger.claim(key) is None
+        ledger.record(key, STATE_CONFIRMED, tx_hash(1))
+        assert ledger.claim(key) == (STATE_CONFIRMED, tx_hash(1))
+        await ledger.close()
+
+    asyncio.run(run())
+
+
+def test_compaction_while_records_are_written(tmp_path):
+    async def run():
+        ledger = TransferLedger(str(tmp_path), compact_records=100)
+        overlapped = 0
+        for i in range(1000):
+            assert ledger.claim(transfer_key("alice", i)) is None
+            ledger.record(transfer_key("alice", i), STATE_SENT, tx_hash(i))
+            if ledger._compaction is not None:
+                overlapped += 1
+            if i % 10 == 0:
+                await asyncio.sleep(0)
+            # Every key stays readable, whether it is in the log, being merged or in the index
+            assert ledger.get(transfer_key("alice", i // 2)) == (STATE_SENT, tx_hash(i // 2))
+        assert overlapped
+        await ledger.close()
+        assert os.path.exists(tmp_path / INDEX_NAME)
+        assert not os.path.exists(tmp_path / MERGING_LOG_NAME)
+
+        ledger = TransferLedger(str(tmp_path), compact_records=100)
+        for i in range(1000):
+            assert ledger.claim(transfer_key("alice", i)) == (STATE_SENT, tx_hash(i))
+        await ledger.close()
+
+    asyncio.run(run())
+
+
+def test_restart_finishes_an_interrupted_compaction(tmp_path):
+    async def run():
+        ledger = TransferLedger(str(tmp_path))
+        for i in range(10):
+            ledger.claim(transfer_key("alice", i))
+        ledger.compact()
+        ledger.record(transfer_key("alice", 0), STATE_SENT, tx_hash(0))
+        # Stopped after the log was set aside, before the merged index was installed
+        ledger._set_log_aside()
+        ledger.claim(transfer_key("alice", 10))
+        ledger._log.flush()
+
+        ledger = TransferLedger(str(tmp_path))
+        assert not os.path.exists(tmp_path / MERGING_LOG_NAME)
+        assert ledger.get(transfer_key("alice", 0)) == (STATE_SENT, tx_hash(0))
+        for i in range(1, 11):
+            assert ledger.get(transfer_key("alice", i)) == (STATE_PENDING, None)
+        await ledger.close()
+
+    asyncio.run(run())
+
+
+def test_memory_ledger_evicts_the_least_recently_used_key():
+    ledger = TransferLedger("memory", cache_size=2)
+    ledger.claim(transfer_key("alice", 1))
+    ledger.claim(transfer_key("alice", 2))
+    assert ledger.get(transfer_key("alice", 1)) is not None
+    ledger.claim(transfer_key("alice", 3))
+    assert ledger.get(transfer_key("alice", 2)) is None
+    assert ledger.get(transfer_key("alice", 1)) is not None
+    assert ledger.directory is None